@@ -0,0 +1,359 @@
+'''
+Benchmarks of the bundled surgeons on synthetic data.
+
+Each case is a merge plan of several models (a surgeon with its options
+for each of them), run at a given number of rows per model. Data of a case
+is generated in one process and merged in another one, so that peak memory
+is that of the merge alone, not of generating the data, nor of another
+case. Results are written as JSON, and two reports can be compared:
+
+  python run-benchmarks.py --sizes=1000,100000 --output=before.json
+  python run-benchmarks.py --sizes=1000,100000 --output=after.json
+  python run-benchmarks.py --compare before.json after.json
+
+Cases run on a temporary SQLite database file. To run them on PostgreSQL
+set TRANSPLANT_BENCHMARK_ENGINE=django.db.backends.postgresql_psycopg2 and
+TRANSPLANT_BENCHMARK_NAME, _USER, _PASSWORD, _HOST and _PORT as needed;
+a test database is created (and destroyed) for each case.
+'''
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+from optparse import OptionParser
+
+from django.conf import settings
+
+# models rows are generated for, with the name of their user field
+PERSON = ('transplant.tests.models.CustomUserFieldNameModel', {'user_field': 'person'})
+ITEM = ('transplant.tests.models.TestModel', {})
+
+def operations(surgeon, models, **kwargs):
+    return tuple((model, surgeon, dict(options, **kwargs)) for model, options in models)
+
+# name: operations of the merge plan of each case
+CASES = (
+    ('default', operations('transplant.surgeons.DefaultSurgeon', (PERSON, ITEM))),
+    ('default-narrow', operations('transplant.surgeons.DefaultSurgeon',
+                                  (PERSON, ITEM), narrow=True)),
+    ('default-chunked', operations('transplant.surgeons.DefaultSurgeon',
+                                   (PERSON, ITEM), narrow=True, chunk_size=1000)),
+    ('batch', operations('transplant.surgeons.BatchSurgeon', (PERSON, ITEM))),
+    ('notifying-batch', operations('transplant.surgeons.NotifyingBatchSurgeon',
+                                   (PERSON, ITEM))),
+    ('unique', (('transplant.tests.models.Rating',
+                 'transplant.surgeons.UniqueSurgeon', {}),)),
+    ('many-to-many', (('transplant.tests.models.Team',
+                       'transplant.surgeons.ManyToManySurgeon',
+                       {'user_field': 'members'}),)),
+    ('mixed', operations('transplant.surgeons.BatchSurgeon', (PERSON,)) +
+              operations('transplant.surgeons.DefaultSurgeon', (ITEM,),
+                         narrow=True, chunk_size=1000) +
+              (('transplant.tests.models.Rating',
+                'transplant.surgeons.UniqueSurgeon', {}),
+               ('transplant.tests.models.Team',
+                'transplant.surgeons.ManyToManySurgeon', {'user_field': 'members'}))),
+)
+
+# number of rows inserted with a single statement (SQLite allows at most
+# 999 query parameters)
+INSERT_CHUNK_SIZE = 300
+
+class StandaloneBenchmarkSuite(object):
+
+    INSTALLED_APPS = (
+        'django.contrib.auth',
+        'django.contrib.contenttypes',
+        'django.contrib.sessions',
+        'django.contrib.admin',
+        'transplant',
+        'transplant.tests',
+    )
+
+    def __init__(self, case, size, users, skew, seed):
+        self.case = case
+        self.size = size
+        self.users = users
+        self.skew = skew
+        self.seed = seed
+
+    def configure(self, name=None, test_name=None):
+        '''
+        Configures settings for the benchmark database, or for the database
+        named name if given.
+        '''
+        env = os.environ.get
+        settings.configure(
+            DEBUG = False,
+            DATABASES = {
+                'default': {
+                    'ENGINE': env('TRANSPLANT_BENCHMARK_ENGINE',
+                                  'django.db.backends.sqlite3'),
+                    'NAME': name or env('TRANSPLANT_BENCHMARK_NAME', ':memory:'),
+                    'TEST_NAME': test_name,
+                    'USER': env('TRANSPLANT_BENCHMARK_USER', ''),
+                    'PASSWORD': env('TRANSPLANT_BENCHMARK_PASSWORD', ''),
+                    'HOST': env('TRANSPLANT_BENCHMARK_HOST', ''),
+                    'PORT': env('TRANSPLANT_BENCHMARK_PORT', ''),
+                }
+            },
+            INSTALLED_APPS = self.INSTALLED_APPS,
+            ROOT_URLCONF = 'transplant.urls'
+        )
+
+    def setup(self, test_name):
+        '''
+        Creates a test database (test_name is used on SQLite) with synthetic
+        data and leaves it for merge(). Returns a dict with the name of the
+        database, primary keys of the receiver and the heaviest donor, and
+        the number of donor's rows.
+        '''
+        engine = os.environ.get('TRANSPLANT_BENCHMARK_ENGINE',
+                                'django.db.backends.sqlite3')
+        if not engine.endswith('sqlite3'):
+            test_name = None
+        self.configure(test_name=test_name)
+        from django.db import connection
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        receiver, donor, rows = self.populate()
+        return {'database': connection.settings_dict['NAME'],
+                'receiver': receiver.pk, 'donor': donor.pk, 'donor_rows': rows}
+
+    def destroy(self, database):
+        '''
+        Destroys the test database created by setup().
+        '''
+        self.configure(name=database)
+        from django.db import connection
+        connection.creation.destroy_test_db(
+            os.environ.get('TRANSPLANT_BENCHMARK_NAME', ':memory:'), verbosity=0)
+
+    def owner(self, random):
+        '''
+        Returns index of the owner of a row. With skew greater than 1 rows
+        are concentrated on first users, user 0 owning most of them.
+        '''
+        return int(self.users * random.random() ** self.skew)
+
+    def populate(self):
+        '''
+        Creates users and self.size rows of each model of the case's plan.
+        Returns (receiver, donor, number of donor's rows).
+        '''
+        from django.contrib.auth.models import User
+        from transplant.tests.models import CustomUserFieldNameModel, Rating
+        from transplant.tests.models import Team, TestModel
+        rng = random.Random(self.seed)
+        self.bulk_create(User, [
+            User(username='user{0}'.format(i), password='!')
+            for i in range(0, self.users)
+        ])
+        pks = list(User.objects.order_by('pk').values_list('pk', flat=True))
+        models = set(model for model, _, _ in dict(CASES)[self.case])
+        rows = 0
+        for model in sorted(models):
+            owners = [pks[self.owner(rng)] for _ in range(0, self.size)]
+            rows += owners.count(pks[0])
+            if model.endswith('CustomUserFieldNameModel'):
+                self.bulk_create(CustomUserFieldNameModel, [
+                    CustomUserFieldNameModel(pk=i + 1, person_id=owner)
+                    for i, owner in enumerate(owners)
+                ])
+            elif model.endswith('TestModel'):
+                self.bulk_create(TestModel, [
+                    TestModel(pk=i + 1, user_id=owner)
+                    for i, owner in enumerate(owners)
+                ])
+            elif model.endswith('Rating'):
+                ratings = [Rating(user_id=owner, item=str(i), score=1)
+                           for i, owner in enumerate(owners)]
+                # every tenth of donor's items is rated by receiver too
+                ratings.extend(
+                    Rating(user_id=pks[1], item=r.item, score=2)
+                    for r in ratings[::10] if r.user_id == pks[0]
+                )
+                self.bulk_create(Rating, ratings)
+            else:
+                teams = max(self.size // 10, 1)
+                self.bulk_create(Team, [Team(pk=i + 1) for i in range(0, teams)])
+                team_pks = list(Team.objects.values_list('pk', flat=True))
+                through = Team.members.through
+                pairs = set((team_pks[i % teams], owner) for i, owner in enumerate(owners))
+                self.bulk_create(through, [
+                    through(team_id=team, user_id=user) for team, user in pairs
+                ])
+        donor, receiver = User.objects.get(pk=pks[0]), User.objects.get(pk=pks[1])
+        return receiver, donor, rows
+
+    def bulk_create(self, model, objs):
+        '''
+        Inserts objs in chunks. Objects should differ in at least one field
+        (e.g. have explicit primary keys), Django 1.4 inserts multiple rows
+        on SQLite with SELECT ... UNION, which drops duplicates.
+        '''
+        for start in range(0, len(objs), INSERT_CHUNK_SIZE):
+            model.objects.bulk_create(objs[start:start + INSERT_CHUNK_SIZE])
+
+    def merge(self, database, receiver, donor):
+        '''
+        Merges donor into receiver (primary keys of users in database
+        created by setup()) with the case's plan, see MergePlan.merge.
+        Time is the sum of the operations' wall times, lock time is the time
+        from the start of the merge to the end of its commit, as locks taken
+        by the first write are held until then. Queries are counted without
+        keeping their SQL (see transplant.instrumentation.QueryCounter).
+        '''
+        self.configure(name=database)
+        from django.contrib.auth.models import User
+        from transplant.plan import MergePlan
+        plan = MergePlan(dict(CASES)[self.case])
+        receiver, donor = User.objects.get(pk=receiver), User.objects.get(pk=donor)
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        stats = plan.merge(receiver, donor)
+        return {
+            'case': self.case,
+            'size': self.size,
+            'changed_rows': stats.rows,
+            'time': sum(operation['time'] for operation in stats.operations),
+            'lock_time': stats.time,
+            'queries': stats.queries,
+            'operations': stats.operations,
+            'rss_before': rss_before,
+            'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }
+
+def run_stage(case, size, options, *args):
+    '''
+    Runs a stage of a case in a new process, returns its output.
+    '''
+    args = [sys.executable, __file__, '--run-case', case, '--sizes', str(size),
+            '--users', str(options.users), '--skew', str(options.skew),
+            '--seed', str(options.seed)] + list(args)
+    output = subprocess.check_output(args)
+    return json.loads(output.splitlines()[-1])
+
+def run_case(case, size, options):
+    '''
+    Generates data of a single case in one process and merges it in another
+    one, returns the measurements.
+    '''
+    directory = tempfile.mkdtemp(prefix='transplant-benchmark-')
+    try:
+        setup = run_stage(case, size, options, '--stage', 'setup', '--database',
+                          os.path.join(directory, 'benchmark.db'))
+        try:
+            result = run_stage(case, size, options, '--stage', 'merge',
+                               '--database', setup['database'],
+                               '--receiver', str(setup['receiver']),
+                               '--donor', str(setup['donor']))
+        finally:
+            run_stage(case, size, options, '--stage', 'destroy',
+                      '--database', setup['database'])
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    result['donor_rows'] = setup['donor_rows']
+    return result
+
+def environment():
+    import django
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=open(os.devnull, 'w'),
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'engine': os.environ.get('TRANSPLANT_BENCHMARK_ENGINE',
+                                 'django.db.backends.sqlite3'),
+    }
+
+def compare(old_path, new_path):
+    '''
+    Prints time, lock time and query count ratios of cases present in both
+    reports.
+    '''
+    with open(old_path) as f:
+        old = dict(((r['case'], r['size']), r) for r in json.load(f)['results'])
+    with open(new_path) as f:
+        new = json.load(f)['results']
+    print '{0:<18} {1:>9} {2:>10} {3:>10} {4:>12}'.format(
+        'case', 'size', 'time', 'lock time', 'queries')
+    for result in new:
+        before = old.get((result['case'], result['size']))
+        if before is None:
+            continue
+        ratios = []
+        for key in ('time', 'lock_time'):
+            ratios.append('{0:.2f}x'.format(result[key] / before[key]) if before[key] else '-')
+        print '{0:<18} {1:>9} {2:>10} {3:>10} {4:>12}'.format(
+            result['case'], result['size'], ratios[0], ratios[1],
+            '{0} -> {1}'.format(before['queries'], result['queries']))
+
+def main():
+    parser = OptionParser(usage='%prog [options] | --compare OLD NEW')
+    parser.add_option('--sizes', default='1000,10000',
+        help='Comma separated numbers of rows per model (default: 1000,10000).')
+    parser.add_option('--cases', default=','.join(name for name, _ in CASES),
+        help='Comma separated cases to run (default: all).')
+    parser.add_option('--users', type='int', default=1000,
+        help='Number of users owning the rows (default: 1000).')
+    parser.add_option('--skew', type='float', default=2.0,
+        help='Skew of rows per user, 1 is uniform (default: 2).')
+    parser.add_option('--seed', type='int', default=0)
+    parser.add_option('--output', help='File to write the JSON report to.')
+    parser.add_option('--compare', action='store_true', default=False,
+        help='Compare two JSON reports given as arguments.')
+    parser.add_option('--run-case', dest='run_case', help='Used internally.')
+    parser.add_option('--stage', choices=('setup', 'merge', 'destroy'),
+        help='Used internally.')
+    parser.add_option('--database', help='Used internally.')
+    parser.add_option('--receiver', type='int', help='Used internally.')
+    parser.add_option('--donor', type='int', help='Used internally.')
+    options, args = parser.parse_args()
+
+    if options.compare:
+        if len(args) != 2:
+            parser.error('--compare expects two reports.')
+        compare(*args)
+        return
+    sizes = [int(size) for size in options.sizes.split(',')]
+    if options.run_case:
+        suite = StandaloneBenchmarkSuite(options.run_case, sizes[0],
+                                         options.users, options.skew, options.seed)
+        if options.stage == 'setup':
+            result = suite.setup(options.database)
+        elif options.stage == 'merge':
+            result = suite.merge(options.database, options.receiver, options.donor)
+        else:
+            result = suite.destroy(options.database)
+        print json.dumps(result)
+        return
+    results = []
+    for size in sizes:
+        for case in options.cases.split(','):
+            result = run_case(case, size, options)
+            sys.stderr.write('{case} ({size} rows, {donor_rows} of donor): '
+                             '{time:.3f}s, {queries} queries\n'.format(**result))
+            results.append(result)
+    report = json.dumps({
+        'environment': environment(),
+        'options': {'users': options.users, 'skew': options.skew, 'seed': options.seed},
+        'results': results,
+    }, indent=2)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(report)
+    else:
+        print report
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,6 @@
+import os
 import sys
+import tempfile
 from django.conf import settings
  
 
@@ -30,7 +32,15 @@ class StandaloneTestSuite(object):
                     'PASSWORD': '',
                     'HOST': '',
                     'PORT': '',
-                }
+                },
+                # used by tests of merges across databases, a file so that
+                # it can be shared by threads
+                'other': {
+                    'ENGINE': 'django.db.backends.sqlite3',
+                    'NAME': ':memory:',
+                    'TEST_NAME': os.path.join(tempfile.gettempdir(),
+                                              'transplant-tests-other.db'),
+                },
             },
             INSTALLED_APPS = self.INSTALLED_APPS + self.apps,
             ROOT_URLCONF = 'transplant.urls'
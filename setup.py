@@ -31,6 +31,8 @@ setup(name='django-transplant',
       keywords='django, user, account, merge',
       url='https://github.com/lolek09/django-transplant',
       packages=['transplant',
+                'transplant.management',
+                'transplant.management.commands',
                 'transplant.tests'],
       package_data={'social_auth':['locale/*/LC_MESSAGES/*']},
       long_description=long_description(),
@@ -0,0 +1,75 @@
+'''
+Validation of transplant's settings, so that a misconfigured operation is
+reported when a process starts rather than during a merge. Run it with the
+transplant_check management command, or call validate_settings() from your
+WSGI script. transplant_worker and transplant_merge validate settings
+before doing anything.
+'''
+import django
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models.fields import FieldDoesNotExist
+
+from conf import app_settings
+from surgeons import BatchSurgeon, DefaultSurgeon
+from surgery import Surgery
+
+def check_operations(operations):
+    '''
+    Returns a list of error messages for (model, surgeon, kwargs) triples of
+    operations: paths of models and surgeons that cannot be imported,
+    missing managers, invalid surgeon arguments, and user fields that are
+    not relations to User.
+    '''
+    errors = []
+    for index, operation in enumerate(operations):
+        prefix = 'TRANSPLANT_OPERATIONS[{0}]'.format(index)
+        try:
+            model, surgeon, kwargs = operation
+            surgery = Surgery(model, surgeon, **dict(kwargs))
+        except (ImproperlyConfigured, TypeError, ValueError) as e:
+            errors.append('{0}: {1}'.format(prefix, e))
+            continue
+        error = check_user_field(surgery.surgeon)
+        if error is not None:
+            errors.append('{0}: {1}'.format(prefix, error))
+    return errors
+
+def check_user_field(surgeon):
+    '''
+    Returns an error message if user_field of a DefaultSurgeon or
+    a BatchSurgeon (or their subclasses) is not a ForeignKey to User, or
+    None. Other surgeons validate their fields when they are created.
+    '''
+    if not isinstance(surgeon, (DefaultSurgeon, BatchSurgeon)):
+        return None
+    model = surgeon.manager.model
+    try:
+        field = model._meta.get_field(surgeon.user_field)
+    except FieldDoesNotExist:
+        return "Model '{0}' has no field '{1}'.".format(
+            model.__name__, surgeon.user_field)
+    if getattr(field, 'rel', None) is None or field.rel.to is not User:
+        return "Field '{0}' of model '{1}' is not a ForeignKey to User.".format(
+            surgeon.user_field, model.__name__)
+    return None
+
+def validate_settings():
+    '''
+    Raises ImproperlyConfigured listing all errors of
+    settings.TRANSPLANT_OPERATIONS.
+    '''
+    errors = check_operations(app_settings.TRANSPLANT_OPERATIONS)
+    if errors:
+        raise ImproperlyConfigured(
+            'Invalid transplant settings:\n{0}'.format('\n'.join(errors)))
+
+if django.VERSION >= (1, 7):
+    from django.core import checks
+
+    @checks.register()
+    def transplant_check(app_configs=None, **kwargs):
+        return [
+            checks.Error(error, id='transplant.E001')
+            for error in check_operations(app_settings.TRANSPLANT_OPERATIONS)
+        ]
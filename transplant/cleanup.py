@@ -0,0 +1,90 @@
+'''
+Cleanup done once a merge is committed: deleting sessions of donors (see
+settings.TRANSPLANT_REVOKE_SESSIONS) and cached per-user data of all merged
+accounts (see settings.TRANSPLANT_CACHE_KEYS).
+'''
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.importlib import import_module
+
+from conf import app_settings
+from utils import raw_delete
+
+# session engines storing sessions in the database, and prefixes of cache
+# keys of engines storing them in the cache
+DB_ENGINES = (
+    'django.contrib.sessions.backends.db',
+    'django.contrib.sessions.backends.cached_db',
+)
+CACHE_PREFIXES = {
+    'django.contrib.sessions.backends.cache': 'django.contrib.sessions.cache',
+    'django.contrib.sessions.backends.cached_db': 'django.contrib.sessions.cached_db',
+}
+
+def index_session(sender, request, user, **kwargs):
+    '''
+    Records the key of the session user logged in with. Connected to
+    user_logged_in.
+    '''
+    from models import UserSession
+    session_key = getattr(getattr(request, 'session', None), 'session_key', None)
+    if not app_settings.TRANSPLANT_REVOKE_SESSIONS or not session_key:
+        return
+    UserSession.objects.filter(session_key=session_key).exclude(user=user).delete()
+    UserSession.objects.get_or_create(session_key=session_key, defaults={'user': user})
+
+def unindex_session(sender, request, user, **kwargs):
+    '''
+    Forgets the session user logged out of. Connected to user_logged_out.
+    '''
+    from models import UserSession
+    session_key = getattr(getattr(request, 'session', None), 'session_key', None)
+    if session_key:
+        raw_delete(UserSession.objects.filter(session_key=session_key))
+
+def revoke_sessions(users):
+    '''
+    Deletes all recorded sessions of users. Sessions stored in the database
+    are deleted with a single DELETE. Returns a list of cache keys of
+    sessions stored in the cache, for the caller to delete.
+    '''
+    from django.contrib.sessions.models import Session
+    from models import UserSession
+    index = UserSession.objects.filter(user__in=users)
+    session_keys = list(index.values_list('session_key', flat=True))
+    if not session_keys:
+        return []
+    engine = settings.SESSION_ENGINE
+    if engine in DB_ENGINES:
+        raw_delete(Session.objects.filter(session_key__in=session_keys))
+    cache_keys = []
+    if engine in CACHE_PREFIXES:
+        cache_keys = [CACHE_PREFIXES[engine] + key for key in session_keys]
+    elif engine not in DB_ENGINES:
+        store = import_module(engine).SessionStore()
+        for session_key in session_keys:
+            store.delete(session_key)
+    raw_delete(index)
+    return cache_keys
+
+def user_cache_keys(users):
+    '''
+    Returns keys of settings.TRANSPLANT_CACHE_KEYS formatted with each of
+    users.
+    '''
+    return [key.format(user=user) for user in users
+            for key in app_settings.TRANSPLANT_CACHE_KEYS]
+
+def cleanup_after_merge(sender, stats, **kwargs):
+    '''
+    Revokes sessions of donors of a committed merge, and deletes cached data
+    of donors and receivers with a single delete_many() call. Connected to
+    merge_committed.
+    '''
+    donors = list(stats.mapping)
+    keys = []
+    if app_settings.TRANSPLANT_REVOKE_SESSIONS:
+        keys.extend(revoke_sessions(donors))
+    keys.extend(user_cache_keys(donors + list(set(stats.mapping.values()))))
+    if keys:
+        cache.delete_many(keys)
@@ -0,0 +1,48 @@
+'''
+Lazy access to settings of transplant. app_settings.TRANSPLANT_<NAME> is the
+project's setting if it is given, or the default from transplant.settings.
+Each value is resolved on first access and cached until any setting
+changes (setting_changed, sent e.g. by override_settings).
+'''
+from django.conf import settings
+from django.test.signals import setting_changed
+
+import settings as defaults
+
+class AppSettings(object):
+    '''
+    Accessor of transplant's settings, see the module's docstring.
+    '''
+    prefix = 'TRANSPLANT_'
+
+    def __init__(self, defaults):
+        self.defaults = defaults
+        self.cache = {}
+
+    def __getattr__(self, name):
+        if not name.startswith(self.prefix):
+            raise AttributeError(name)
+        try:
+            return self.cache[name]
+        except KeyError:
+            pass
+        if hasattr(settings, name):
+            value = getattr(settings, name)
+        elif hasattr(self.defaults, name):
+            value = getattr(self.defaults, name)
+        else:
+            raise AttributeError("No setting '{0}'.".format(name))
+        if name == 'TRANSPLANT_SUCCESS_URL' and value is None:
+            value = settings.LOGIN_REDIRECT_URL
+        self.cache[name] = value
+        return value
+
+    def clear(self, **kwargs):
+        '''
+        Drops cached values. Connected to setting_changed.
+        '''
+        self.cache.clear()
+
+app_settings = AppSettings(defaults)
+
+setting_changed.connect(app_settings.clear, dispatch_uid='transplant.conf.clear')
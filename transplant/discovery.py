@@ -0,0 +1,48 @@
+'''
+Builds merge operations by introspecting installed models, see
+settings.TRANSPLANT_AUTODISCOVER.
+'''
+from django.contrib.auth.models import User
+from django.db.models import get_models, ForeignKey
+
+from surgeons import unique_keys
+
+def discover_operations(exclude=()):
+    '''
+    Returns a list of operations in the format of TRANSPLANT_OPERATIONS, one
+    for each ForeignKey (and OneToOneField) pointing at User in installed
+    models, except models in exclude and transplant's own models. Objects
+    are moved with BatchSurgeon using the model's base manager, so that
+    no objects are left behind by a filtering default manager. Fields which
+    have to be unique (OneToOneFields, fields in unique_together) are
+    merged with UniqueSurgeon, keeping receiver's objects on conflict.
+
+    ManyToManyFields pointing at User are merged with ManyToManySurgeon.
+    Fields with a custom through model are skipped, as the through model's
+    own ForeignKey to User is discovered.
+    '''
+    operations = []
+    for model in get_models():
+        if model in exclude or model._meta.proxy:
+            continue
+        if model._meta.app_label == 'transplant':
+            continue
+        for field in model._meta.local_fields:
+            if isinstance(field, ForeignKey) and field.rel.to is User:
+                if unique_keys(model, field.name):
+                    surgeon = 'transplant.surgeons.UniqueSurgeon'
+                else:
+                    surgeon = 'transplant.surgeons.BatchSurgeon'
+                operations.append((
+                    '{0}.{1}'.format(model.__module__, model.__name__),
+                    surgeon,
+                    {'user_field': field.name, 'manager': '_base_manager'},
+                ))
+        for field in model._meta.local_many_to_many:
+            if field.rel.to is User and field.rel.through._meta.auto_created:
+                operations.append((
+                    '{0}.{1}'.format(model.__module__, model.__name__),
+                    'transplant.surgeons.ManyToManySurgeon',
+                    {'user_field': field.name, 'manager': '_base_manager'},
+                ))
+    return operations
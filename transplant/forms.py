@@ -2,9 +2,11 @@
 Currently contains just one form:
   - UserMergeForm
   It's basically an authentication form with an extra checkbox for warning
-  confirmation.
+  confirmation, and a hidden token identifying the merge request.
 '''
-from django.forms import BooleanField
+import uuid
+
+from django.forms import BooleanField, CharField, HiddenInput
 from django.utils.translation import ugettext as _
 from django.contrib.auth.forms import AuthenticationForm
 
@@ -15,4 +17,11 @@ class UserMergeForm(AuthenticationForm):
     
     warning_accepted = BooleanField(
         label = _('I understand the warning.'),
-    )
\ No newline at end of file
+    )
+    # submitting the same form twice requests the same merge (see
+    # transplant.guard)
+    token = CharField(widget=HiddenInput, max_length=64, required=False)
+    
+    def __init__(self, *args, **kwargs):
+        super(UserMergeForm, self).__init__(*args, **kwargs)
+        self.fields['token'].initial = uuid.uuid4().hex
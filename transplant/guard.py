@@ -0,0 +1,74 @@
+'''
+Functions guarding against duplicate merges, e.g. a merge form submitted
+twice: each request is recorded as a MergeRequest identified by a token,
+which also locks the (receiver, donor) pair while the merge is running.
+'''
+import uuid
+from datetime import timedelta
+
+from django.db import transaction, IntegrityError
+from django.utils import timezone
+
+from conf import app_settings
+from models import MergeJob, MergeRequest
+
+class MergeFailed(Exception):
+    '''
+    Raised for a repeated request of a merge that failed.
+    '''
+
+def lock_key(receiver, donor):
+    '''
+    Returns the lock key of a pair of users. Keys are built from sorted
+    primary keys, so that a merge of B into A and a merge of A into B lock
+    each other out.
+    '''
+    return '{0}:{1}'.format(*sorted([receiver.pk, donor.pk]))
+
+def start_merge(receiver, donor, token=None):
+    '''
+    Records a merge of donor into receiver requested with token (a new
+    token by default), locking the pair. Returns (merge_request, created).
+
+    If a merge was already requested with token, or a merge of the pair is
+    running, returns that request with created False instead, so that the
+    caller reports its outcome rather than merging again. Requests still
+    running after settings.TRANSPLANT_MERGE_LOCK_TIMEOUT seconds are marked
+    as failed and do not block the pair any more.
+    '''
+    token = token or uuid.uuid4().hex
+    lock = lock_key(receiver, donor)
+    while True:
+        sid = transaction.savepoint()
+        try:
+            merge_request = MergeRequest.objects.create(
+                token=token, receiver=receiver, donor=donor, lock=lock)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+        else:
+            transaction.savepoint_commit(sid)
+            transaction.commit_unless_managed()
+            return merge_request, True
+        existing = list(MergeRequest.objects.filter(token=token)) or \
+                   list(MergeRequest.objects.filter(lock=lock))
+        if not existing:
+            # the running merge of the pair has just finished
+            continue
+        expired = timezone.now() - timedelta(
+            seconds=app_settings.TRANSPLANT_MERGE_LOCK_TIMEOUT)
+        if existing[0].lock is not None and existing[0].created < expired:
+            finish_merge(existing[0], MergeJob.FAILED, 'Merge lock expired.')
+            continue
+        return existing[0], False
+
+def finish_merge(merge_request, status, error=''):
+    '''
+    Records the outcome of a merge request and releases its lock.
+    '''
+    merge_request.status = status
+    merge_request.error = error
+    merge_request.finished = timezone.now()
+    merge_request.lock = None
+    MergeRequest.objects.filter(pk=merge_request.pk).update(
+        status=status, error=error, finished=merge_request.finished, lock=None)
+    transaction.commit_unless_managed()
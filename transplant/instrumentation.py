@@ -0,0 +1,206 @@
+'''
+Helpers measuring merges: MergeStats collected by transplant.plan.MergePlan,
+and adapters reporting them to a logger or a statsd client.
+'''
+import logging
+
+from django.conf import settings
+from django.db import connections
+
+from signals import operation_finished, merge_committed, merge_rolled_back
+
+class MergeStats(object):
+    '''
+    Timings, row counts and query counts of a single merge. 'mapping' is
+    a dict {donor: receiver} of merged users, 'operations' a list with
+    a dict for each finished operation, with keys:
+      - 'model' and 'surgeon', names of the model and surgeon class,
+      - 'time', wall time in seconds,
+      - 'rows', number of changed rows reported by the surgeon,
+      - 'queries', number of SQL queries issued.
+    'time' is the wall time of the whole merge, 'retries' the number of
+    times the merge was run again after a deadlock, 'journal' the
+    transplant.models.MergeJournal recorded by the merge, if any.
+    '''
+    def __init__(self):
+        self.mapping = {}
+        self.operations = []
+        self.time = 0.0
+        self.retries = 0
+        self.journal = None
+
+    @property
+    def rows(self):
+        return sum(operation['rows'] or 0 for operation in self.operations)
+
+    @property
+    def queries(self):
+        return sum(operation['queries'] for operation in self.operations)
+
+    def as_dict(self):
+        return {
+            'time': self.time,
+            'rows': self.rows,
+            'queries': self.queries,
+            'retries': self.retries,
+            'operations': self.operations,
+        }
+
+class QueryCounter(object):
+    '''
+    Context manager counting SQL queries issued on connection 'using', for
+    example::
+
+      with QueryCounter('default') as counter:
+          ...
+      print counter.count
+
+    Cursors of the connection are wrapped with CountingCursorWrapper, which
+    only increments the counter, so memory use does not grow with the number
+    of queries. SQL of the queries is also kept as counter.queries if
+    keep_queries is True, by default only when the connection logs queries
+    anyway (DEBUG is True).
+    '''
+    def __init__(self, using, keep_queries=None):
+        self.connection = connections[using]
+        if keep_queries is None:
+            use_debug_cursor = self.connection.use_debug_cursor
+            keep_queries = use_debug_cursor or (use_debug_cursor is None and
+                                                settings.DEBUG)
+        self.keep_queries = keep_queries
+        self.count = 0
+        self.queries = []
+
+    def __enter__(self):
+        # cursor() of the connection, or of an enclosing counter
+        self.patched = self.connection.__dict__.get('cursor')
+        self.make_cursor = self.connection.cursor
+        self.connection.cursor = self.cursor
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.patched is None:
+            del self.connection.cursor
+        else:
+            self.connection.cursor = self.patched
+
+    def cursor(self):
+        return CountingCursorWrapper(self.make_cursor(), self)
+
+    def executed(self, cursor, sql, params=None):
+        '''
+        Called by CountingCursorWrapper after each query. params is None for
+        executemany() calls, whose SQL is kept without parameters.
+        '''
+        self.count += 1
+        if self.keep_queries and params is None:
+            self.queries.append(sql)
+        elif self.keep_queries:
+            self.queries.append(self.connection.ops.last_executed_query(
+                cursor, sql, params))
+
+class CountingCursorWrapper(object):
+    '''
+    Cursor reporting each execute() and executemany() call to a QueryCounter.
+    '''
+    def __init__(self, cursor, counter):
+        self.cursor = cursor
+        self.counter = counter
+
+    def execute(self, sql, params=()):
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            self.counter.executed(self.cursor, sql, params)
+
+    def executemany(self, sql, param_list):
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            self.counter.executed(self.cursor, sql)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+class SignalAdapter(object):
+    '''
+    Base class of adapters reporting merges. Subclasses override
+    operation_finished(), merge_committed() and merge_rolled_back(), which
+    are connected to the signals of the same names with connect().
+    '''
+    def connect(self):
+        operation_finished.connect(self.operation_finished, weak=False)
+        merge_committed.connect(self.merge_committed, weak=False)
+        merge_rolled_back.connect(self.merge_rolled_back, weak=False)
+
+    def disconnect(self):
+        operation_finished.disconnect(self.operation_finished)
+        merge_committed.disconnect(self.merge_committed)
+        merge_rolled_back.disconnect(self.merge_rolled_back)
+
+    def operation_finished(self, sender, stats, index, surgery, operation, **kwargs):
+        pass
+
+    def merge_committed(self, sender, stats, **kwargs):
+        pass
+
+    def merge_rolled_back(self, sender, stats, exception, **kwargs):
+        pass
+
+class LoggingAdapter(SignalAdapter):
+    '''
+    Logs every finished operation (at DEBUG level) and every committed
+    (INFO) or rolled back (WARNING) merge with 'logger', a logger or its
+    name.
+    '''
+    def __init__(self, logger='transplant'):
+        if isinstance(logger, basestring):
+            logger = logging.getLogger(logger)
+        self.logger = logger
+
+    def operation_finished(self, sender, stats, index, surgery, operation, **kwargs):
+        self.logger.debug(
+            'Operation %s (%s on %s): %.3fs, %s rows, %s queries', index,
+            operation['surgeon'], operation['model'], operation['time'],
+            operation['rows'], operation['queries']
+        )
+
+    def merge_committed(self, sender, stats, **kwargs):
+        self.logger.info(
+            'Merge of %s donors committed: %.3fs, %s rows, %s queries',
+            len(stats.mapping), stats.time, stats.rows, stats.queries
+        )
+
+    def merge_rolled_back(self, sender, stats, exception, **kwargs):
+        self.logger.warning(
+            'Merge of %s donors rolled back after %s operations: %s',
+            len(stats.mapping), len(stats.operations), exception
+        )
+
+class StatsdAdapter(SignalAdapter):
+    '''
+    Reports merges to 'client', an object with timing(stat, milliseconds)
+    and incr(stat, count) methods, like statsd.StatsClient. Stats are named
+    '<prefix>.<app_label>.<Model>.time', '.rows' and '.queries' for
+    operations, and '<prefix>.merge.time', '<prefix>.merge.committed' and
+    '<prefix>.merge.rolled_back' for whole merges.
+    '''
+    def __init__(self, client, prefix='transplant'):
+        self.client = client
+        self.prefix = prefix
+
+    def operation_finished(self, sender, stats, index, surgery, operation, **kwargs):
+        stat = '{0}.{1}'.format(self.prefix, operation['model'])
+        self.client.timing(stat + '.time', operation['time'] * 1000)
+        self.client.incr(stat + '.rows', operation['rows'] or 0)
+        self.client.incr(stat + '.queries', operation['queries'])
+
+    def merge_committed(self, sender, stats, **kwargs):
+        self.client.timing(self.prefix + '.merge.time', stats.time * 1000)
+        self.client.incr(self.prefix + '.merge.committed', 1)
+
+    def merge_rolled_back(self, sender, stats, exception, **kwargs):
+        self.client.incr(self.prefix + '.merge.rolled_back', 1)
@@ -0,0 +1,153 @@
+'''
+Functions for queueing merges as MergeJob objects and performing them
+outside of the request/response cycle (see transplant_worker command).
+'''
+import logging
+import threading
+import traceback
+
+from django.db import connections, load_backend, router, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from conf import app_settings
+from models import MergeJob, MergeRequest
+from plan import get_merge_plan
+from utils import save_fields, update_sql
+
+logger = logging.getLogger('transplant')
+
+def enqueue_merge(receiver, donor, journaled=None, merge_request=None):
+    '''
+    Queues a merge of donor into receiver. Returns a new MergeJob. The merge
+    is journaled (see MergePlan.merge_journaled) if journaled is True, by
+    default if settings.TRANSPLANT_JOURNALED is True.
+    
+    If merge_request is given (see transplant.guard) the job is set as its
+    job in the transaction creating the job, so that run_job() finds the
+    request to release even if a worker finishes the job right away.
+    '''
+    if journaled is None:
+        journaled = app_settings.TRANSPLANT_JOURNALED
+    with transaction.commit_on_success(using=router.db_for_write(MergeJob)):
+        job = MergeJob.objects.create(receiver=receiver, donor=donor,
+                                      operations=len(get_merge_plan()),
+                                      journaled=journaled)
+        if merge_request is not None:
+            merge_request.job = job
+            save_fields(merge_request, ['job'])
+    return job
+
+def merge_in_progress(user):
+    '''
+    Returns True if a journaled merge of user (as the donor or the
+    receiver) has started but is not done yet, or has failed, so that
+    objects of user may be split between the two accounts.
+    '''
+    return MergeJob.objects.filter(
+        Q(donor=user) | Q(receiver=user), journaled=True,
+        status__in=(MergeJob.RUNNING, MergeJob.FAILED)
+    ).exists()
+
+def progress_connection():
+    '''
+    Returns a new connection to the database of MergeJob, so that progress
+    of a job is committed while the merge transaction is still open. Returns
+    None on SQLite, where a second writer would wait for the merge to commit
+    (or, in memory, would not see the same database).
+    '''
+    alias = router.db_for_write(MergeJob)
+    settings_dict = connections.databases[alias]
+    if settings_dict['ENGINE'].endswith('sqlite3'):
+        return None
+    backend = load_backend(settings_dict['ENGINE'])
+    return backend.DatabaseWrapper(settings_dict, alias, allow_thread_sharing=True)
+
+def record_progress(connection, job):
+    '''
+    Writes job.completed_operations with an UPDATE committed on connection
+    (see progress_connection()).
+    '''
+    queryset = MergeJob._base_manager.using(connection.alias).filter(pk=job.pk)
+    sql, params = update_sql(queryset, completed_operations=job.completed_operations)
+    connection.cursor().execute(sql, params)
+    connection._commit()
+
+def run_job(job, plan=None):
+    '''
+    Performs a claimed MergeJob using plan (by default the plan built from
+    settings.TRANSPLANT_OPERATIONS) in a single transaction. Records the
+    outcome on the job, and returns True if the merge succeeded. Number of
+    completed operations is recorded as each of them finishes (see
+    progress_connection()).
+    '''
+    if plan is None:
+        plan = get_merge_plan()
+    job.operations = len(plan)
+    job.completed_operations = 0
+    # operations on different databases may finish in any order, from
+    # threads of their own, and all of them run again if the merge is retried
+    completed = set()
+    lock = threading.Lock()
+    progress = progress_connection()
+    def callback(index, surgery):
+        with lock:
+            completed.add(index)
+            job.completed_operations = len(completed)
+            if progress is None:
+                return
+            try:
+                record_progress(progress, job)
+            except Exception as e:
+                # progress is informational, it must not fail the merge
+                logger.warning('Could not record progress of job %s: %s', job.pk, e)
+    try:
+        if job.journaled:
+            plan.merge_journaled(job, app_settings.TRANSPLANT_JOURNAL_CHUNK_SIZE,
+                                 callback=callback)
+        else:
+            plan.merge(job.receiver, job.donor, callback=callback)
+    except Exception:
+        job.status = MergeJob.FAILED
+        job.error = traceback.format_exc()
+    else:
+        job.status = MergeJob.DONE
+    finally:
+        if progress is not None:
+            progress.close()
+    job.finished = timezone.now()
+    job.save()
+    # release merge requests waiting for the job (see transplant.guard)
+    MergeRequest.objects.filter(job=job, lock__isnull=False).update(
+        lock=None, status=job.status, error=job.error, finished=job.finished)
+    return job.status == MergeJob.DONE
+
+def run_next_job():
+    '''
+    Claims and performs the oldest queued MergeJob. Returns the job, or None
+    if the queue is empty.
+    '''
+    while True:
+        jobs = list(MergeJob.objects.filter(status=MergeJob.QUEUED)[:1])
+        if not jobs:
+            return None
+        job = jobs[0]
+        if job.claim():
+            run_job(job)
+            return job
+
+def resume_jobs():
+    '''
+    Performs journaled jobs that failed or were left running (e.g. by
+    a worker that crashed), continuing from their last checkpoints. Returns
+    the list of jobs. Make sure no other worker is running these jobs.
+    '''
+    jobs = list(MergeJob.objects.filter(
+        status__in=(MergeJob.RUNNING, MergeJob.FAILED), journaled=True
+    ))
+    for job in jobs:
+        job.status = MergeJob.RUNNING
+        job.error = ''
+        job.save()
+        run_job(job)
+    return jobs
@@ -0,0 +1,103 @@
+'''
+Functions recording merges in a MergeJournal (see
+settings.TRANSPLANT_UNDO_JOURNAL) and undoing them.
+'''
+import sys
+
+from django.contrib.auth.models import User
+from django.db import connections, router, transaction
+from django.db.models import get_model
+from django.utils import timezone
+
+from models import MergeJournal, JournalEntry
+from utils import pack_pks, ranges_q, save_fields, unpack_ranges
+
+# number of pk ranges in a single UPDATE on SQLite, which allows at most 999
+# query parameters
+SQLITE_RANGES = 400
+
+def record_journal(receiver, donor, records):
+    '''
+    Creates a MergeJournal of a merge of donor into receiver. records is
+    a list of (rows, record) returned by Surgeon.merge_recording for each
+    operation of the plan. Returns the journal.
+    '''
+    journal = MergeJournal(receiver=receiver, donor=donor)
+    entries = []
+    for operation, (rows, record) in enumerate(records):
+        if record is None:
+            journal.complete = journal.complete and not rows
+            continue
+        model, field, pks = record
+        journal.complete = journal.complete and rows == len(pks)
+        if pks:
+            entries.append(JournalEntry(
+                operation=operation,
+                model='{0}.{1}'.format(model._meta.app_label, model._meta.object_name),
+                field=field, pks=pack_pks(pks), rows=len(pks),
+            ))
+    journal.save()
+    for entry in entries:
+        entry.journal = journal
+    JournalEntry.objects.bulk_create(entries)
+    return journal
+
+def unmerge(journal):
+    '''
+    Moves objects recorded in journal back from the receiver to the donor,
+    with a single UPDATE per entry, and activates the donor again. Only
+    objects still related to the receiver are moved back. All databases
+    involved are updated in a transaction of their own, committed once all
+    updates succeeded. Returns the number of objects moved back.
+
+    Raises ValueError if the journal was already undone.
+    '''
+    if journal.undone is not None:
+        raise ValueError('Merge journal {0} was already undone.'.format(journal.pk))
+    entries = list(journal.entries.all())
+    aliases = [router.db_for_write(User)]
+    for entry in entries:
+        alias = router.db_for_write(get_model(*entry.model.split('.')))
+        if alias not in aliases:
+            aliases.append(alias)
+    for alias in aliases:
+        transaction.enter_transaction_management(using=alias)
+        transaction.managed(True, using=alias)
+    try:
+        try:
+            rows = sum(move_back(journal, entry) for entry in entries)
+            donor = journal.donor
+            donor.is_active = True
+            save_fields(donor, ['is_active'])
+            journal.undone = timezone.now()
+            save_fields(journal, ['undone'])
+            for alias in aliases:
+                transaction.commit(using=alias)
+        except:
+            exc_info = sys.exc_info()
+            for alias in aliases:
+                transaction.rollback(using=alias)
+            raise exc_info[0], exc_info[1], exc_info[2]
+    finally:
+        for alias in aliases:
+            transaction.leave_transaction_management(using=alias)
+    return rows
+
+def move_back(journal, entry):
+    '''
+    Sets entry.field of recorded objects owned by the receiver back to the
+    donor. Returns the number of updated rows.
+    '''
+    model = get_model(*entry.model.split('.'))
+    alias = router.db_for_write(model)
+    queryset = model._base_manager.using(alias).filter(
+        **{entry.field: journal.receiver_id})
+    ranges = unpack_ranges(entry.pks)
+    size = len(ranges)
+    if connections[alias].vendor == 'sqlite':
+        size = SQLITE_RANGES
+    rows = 0
+    for start in range(0, len(ranges), size):
+        rows += queryset.filter(ranges_q(ranges[start:start + size])).update(
+            **{entry.field: journal.donor_id})
+    return rows
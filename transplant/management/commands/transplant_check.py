@@ -0,0 +1,15 @@
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import NoArgsCommand, CommandError
+
+from transplant.checks import validate_settings
+
+class Command(NoArgsCommand):
+    help = 'Validates settings.TRANSPLANT_OPERATIONS.'
+
+    def handle_noargs(self, **options):
+        try:
+            validate_settings()
+        except ImproperlyConfigured as e:
+            raise CommandError(str(e))
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write('Transplant settings are valid.\n')
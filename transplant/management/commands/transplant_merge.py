@@ -0,0 +1,203 @@
+import csv
+import json
+import os
+from collections import deque
+from itertools import islice
+from multiprocessing import Pool
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.utils.encoding import force_unicode
+
+from transplant.checks import validate_settings
+from transplant.plan import get_merge_plan
+
+def read_pairs(stream, format):
+    '''
+    Yields (receiver, donor) pairs read from stream. In 'csv' format each
+    row holds receiver and donor, in 'jsonl' format each line is an object
+    with 'receiver' and 'donor' keys.
+    '''
+    if format == 'csv':
+        for row in csv.reader(stream):
+            if row:
+                yield row[0].strip(), row[1].strip()
+    else:
+        for line in stream:
+            if line.strip():
+                record = json.loads(line)
+                yield record['receiver'], record['donor']
+
+def get_users(values, field):
+    '''
+    Returns a dict mapping given values of field to User objects.
+    '''
+    lookup = {'{0}__in'.format(field): list(set(values))}
+    return dict(
+        (force_unicode(getattr(user, field)), user)
+        for user in User.objects.filter(**lookup)
+    )
+
+def merge_pairs(pairs, field):
+    '''
+    Merges each (number, receiver, donor) triple in pairs, in a single
+    transaction per database (see MergePlan.merge_pairs). Returns a list of
+    (number, error message) tuples for pairs that could not be merged.
+    '''
+    values = []
+    for _, receiver, donor in pairs:
+        values.extend([force_unicode(receiver), force_unicode(donor)])
+    users = get_users(values, field)
+    errors = []
+    merges = []
+    for number, receiver, donor in pairs:
+        missing = [v for v in (receiver, donor) if force_unicode(v) not in users]
+        if missing:
+            errors.append((number, u"user '{0}' does not exist".format(missing[0])))
+        else:
+            merges.append((number, users[force_unicode(receiver)],
+                           users[force_unicode(donor)]))
+    error = None
+    try:
+        get_merge_plan().merge_pairs([(receiver, donor) for _, receiver, donor in merges])
+    except Exception as e:
+        error = e
+    if error is not None and len(merges) > 1:
+        # find out which pairs failed by merging them one by one
+        for number, receiver, donor in merges:
+            errors.extend(merge_pairs([(number, receiver.pk, donor.pk)], 'pk'))
+    elif error is not None:
+        errors.append((merges[0][0], force_unicode(error)))
+    return errors
+
+def dry_run_pairs(pairs, field):
+    '''
+    Yields (number, report) for each (number, receiver, donor) triple in
+    pairs, where report is a dict as returned by MergePlan.dry_run (or
+    an error message).
+    '''
+    values = []
+    for _, receiver, donor in pairs:
+        values.extend([force_unicode(receiver), force_unicode(donor)])
+    users = get_users(values, field)
+    plan = get_merge_plan()
+    for number, receiver, donor in pairs:
+        missing = [v for v in (receiver, donor) if force_unicode(v) not in users]
+        if missing:
+            yield number, {'error': u"user '{0}' does not exist".format(missing[0])}
+        else:
+            yield number, {'receiver': receiver, 'donor': donor, 'operations':
+                plan.dry_run(users[force_unicode(receiver)], users[force_unicode(donor)])}
+
+def merge_batch(batch):
+    '''
+    Merges a batch of pairs, returns (first number, size, errors).
+    '''
+    start, pairs, field = batch
+    return start, len(pairs), merge_pairs(pairs, field)
+
+def close_connections():
+    for connection in connections.all():
+        connection.close()
+
+class Command(BaseCommand):
+    args = '<file>'
+    help = ('Merges (receiver, donor) pairs read from a CSV or JSON lines file '
+            'using settings.TRANSPLANT_OPERATIONS.')
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', choices=('csv', 'jsonl'),
+            help='Format of the file, guessed from its extension by default.'),
+        make_option('--field', dest='field', default='pk',
+            help='User field identifying users in the file (default: pk).'),
+        make_option('--batch-size', type='int', dest='batch_size', default=100,
+            help='Number of pairs merged in a single transaction.'),
+        make_option('--processes', type='int', dest='processes', default=1,
+            help='Number of processes merging batches in parallel. Pairs '
+                 'in the file must be independent of each other.'),
+        make_option('--progress-file', dest='progress_file',
+            help='File storing the number of pairs processed so far.'),
+        make_option('--resume', action='store_true', dest='resume', default=False,
+            help='Skip pairs already processed according to --progress-file.'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Do not merge, print a JSON line per pair with row counts, '
+                 'statements and query plans of each operation.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Expected a single file name.')
+        path = args[0]
+        format = options['format']
+        if format is None:
+            format = 'csv' if path.endswith('.csv') else 'jsonl'
+        if options['resume'] and not options['progress_file']:
+            raise CommandError('--resume requires --progress-file.')
+        try:
+            validate_settings()
+        except ImproperlyConfigured as e:
+            raise CommandError(str(e))
+        skip = 0
+        if options['resume'] and os.path.exists(options['progress_file']):
+            with open(options['progress_file']) as progress:
+                skip = int(progress.read().strip() or 0)
+        self.verbosity = int(options.get('verbosity', 1))
+        self.progress_file = options['progress_file']
+        self.failures = 0
+
+        with open(path, 'rb') as stream:
+            pairs = islice(read_pairs(stream, format), skip, None)
+            batches = self.batches(pairs, skip, options['batch_size'], options['field'])
+            if options['dry_run']:
+                for _, batch, field in batches:
+                    for number, report in dry_run_pairs(batch, field):
+                        report['pair'] = number + 1
+                        self.stdout.write(json.dumps(report, default=force_unicode) + '\n')
+                return
+            elif options['processes'] > 1:
+                self.merge_in_pool(batches, options['processes'])
+            else:
+                for batch in batches:
+                    self.batch_done(*merge_batch(batch))
+        if self.failures:
+            raise CommandError('{0} pairs could not be merged.'.format(self.failures))
+
+    def batches(self, pairs, start, size, field):
+        while True:
+            batch = [(start + i, r, d) for i, (r, d) in enumerate(islice(pairs, size))]
+            if not batch:
+                return
+            yield start, batch, field
+            start += len(batch)
+
+    def merge_in_pool(self, batches, processes):
+        '''
+        Merges batches in a pool of processes, keeping at most two batches
+        per process in flight. Results are handled in order, so that the
+        progress file always points after a contiguous range of batches.
+        '''
+        close_connections()
+        pool = Pool(processes, initializer=close_connections)
+        pending = deque()
+        try:
+            for batch in batches:
+                pending.append(pool.apply_async(merge_batch, (batch,)))
+                if len(pending) >= 2 * processes:
+                    self.batch_done(*pending.popleft().get())
+            while pending:
+                self.batch_done(*pending.popleft().get())
+        finally:
+            pool.terminate()
+
+    def batch_done(self, start, size, errors):
+        for number, message in errors:
+            self.stderr.write('Pair {0}: {1}\n'.format(number + 1, message))
+        self.failures += len(errors)
+        if self.progress_file:
+            with open(self.progress_file, 'w') as progress:
+                progress.write('{0}\n'.format(start + size))
+        if self.verbosity > 0:
+            self.stdout.write('Processed {0} pairs, {1} failed.\n'.format(
+                start + size, self.failures))
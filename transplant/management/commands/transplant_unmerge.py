@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from transplant.journal import unmerge
+from transplant.models import MergeJournal
+
+class Command(BaseCommand):
+    args = '<journal id> [<journal id> ...]'
+    help = ('Undoes merges recorded in given MergeJournals (see '
+            'settings.TRANSPLANT_UNDO_JOURNAL), moving objects back to donors.')
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError('Expected at least one journal id.')
+        try:
+            pks = [int(pk) for pk in args]
+        except ValueError:
+            raise CommandError('Journal ids must be integers.')
+        verbosity = int(options.get('verbosity', 1))
+        journals = MergeJournal.objects.in_bulk(pks)
+        missing = [pk for pk in pks if pk not in journals]
+        if missing:
+            raise CommandError('Merge journal {0} does not exist.'.format(missing[0]))
+        for pk in pks:
+            journal = journals[pk]
+            try:
+                rows = unmerge(journal)
+            except ValueError as e:
+                raise CommandError(str(e))
+            if verbosity > 0:
+                self.stdout.write('Merge journal {0}: moved back {1} objects{2}.\n'.format(
+                    pk, rows, '' if journal.complete else ' (merge was not fully recorded)'))
@@ -0,0 +1,41 @@
+import time
+from optparse import make_option
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import NoArgsCommand, CommandError
+
+from transplant.checks import validate_settings
+from transplant.jobs import resume_jobs, run_next_job
+
+class Command(NoArgsCommand):
+    help = 'Performs merges queued as MergeJob objects.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--once', action='store_true', dest='once', default=False,
+            help='Exit when the queue is empty instead of waiting for new jobs.'),
+        make_option('--sleep', type='float', dest='sleep', default=5.0,
+            help='Seconds to wait before polling an empty queue again.'),
+        make_option('--resume', action='store_true', dest='resume', default=False,
+            help='First resume journaled jobs that failed or were left running '
+                 'by a worker that crashed. Do not use it while other workers '
+                 'are running.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        try:
+            validate_settings()
+        except ImproperlyConfigured as e:
+            raise CommandError(str(e))
+        if options['resume']:
+            for job in resume_jobs():
+                if verbosity > 0:
+                    self.stdout.write('Resumed merge job {0}: {1}\n'.format(
+                        job.pk, job.status))
+        while True:
+            job = run_next_job()
+            if job is None:
+                if options['once']:
+                    return
+                time.sleep(options['sleep'])
+            elif verbosity > 0:
+                self.stdout.write('Merge job {0}: {1}\n'.format(job.pk, job.status))
@@ -1 +1,167 @@
+'''
+Contains MergeJob model, a database-backed queue of merges to be performed
+by the transplant_worker management command, MergeCheckpoint recording
+progress of journaled merges, MergeJournal recording merges so that
+they can be undone, MergeRequest guarding against duplicate merges, and
+UserSession indexing sessions by user.
+'''
+from django.db import models
+from django.contrib.auth.models import User
+from django.utils import timezone
 
+class MergeJob(models.Model):
+    '''
+    A merge of donor into receiver, queued by TransplantMergeView when
+    settings.TRANSPLANT_ASYNC is True and performed by transplant_worker.
+    '''
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    receiver = models.ForeignKey(User, related_name='+')
+    donor = models.ForeignKey(User, related_name='+')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+                              default=QUEUED, db_index=True)
+    # journaled jobs are merged in chunks, each in a transaction of its own
+    # (see transplant.plan.MergePlan.merge_journaled)
+    journaled = models.BooleanField(default=False)
+    # number of operations in the plan and number of operations done
+    operations = models.PositiveIntegerField(default=0)
+    completed_operations = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(default=timezone.now)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ('pk',)
+
+    def claim(self):
+        '''
+        Marks a queued job as running. Returns False if the job was claimed
+        by someone else in the meantime.
+        '''
+        started = timezone.now()
+        claimed = MergeJob.objects.filter(pk=self.pk, status=self.QUEUED).update(
+            status=self.RUNNING, started=started
+        )
+        if claimed:
+            self.status = self.RUNNING
+            self.started = started
+        return bool(claimed)
+
+    def operation_statuses(self):
+        '''
+        Returns a list with status of each operation: 'done', 'running',
+        'failed' or 'pending'. Operations of a failed job are rolled back.
+        '''
+        statuses = []
+        for index in range(self.operations):
+            if index < self.completed_operations:
+                statuses.append(self.DONE)
+            elif index == self.completed_operations and self.status in (
+                    self.RUNNING, self.FAILED):
+                statuses.append(self.status)
+            else:
+                statuses.append('pending')
+        return statuses
+
+class MergeCheckpoint(models.Model):
+    '''
+    Progress of a single operation of a journaled MergeJob: number of
+    chunks committed and rows moved so far, and whether the operation is
+    done.
+    '''
+    job = models.ForeignKey(MergeJob, related_name='checkpoints')
+    operation = models.PositiveIntegerField()
+    chunks = models.PositiveIntegerField(default=0)
+    rows = models.PositiveIntegerField(default=0)
+    done = models.BooleanField(default=False)
+
+    class Meta:
+        ordering = ('job', 'operation')
+        unique_together = ('job', 'operation')
+
+class MergeJournal(models.Model):
+    '''
+    A merge of donor into receiver recorded when
+    settings.TRANSPLANT_UNDO_JOURNAL is True, with a JournalEntry for each
+    operation that moved objects. See transplant.journal.unmerge.
+    '''
+    receiver = models.ForeignKey(User, related_name='+')
+    donor = models.ForeignKey(User, related_name='+')
+    created = models.DateTimeField(default=timezone.now)
+    undone = models.DateTimeField(null=True, blank=True)
+    # False if the merge deleted objects (e.g. duplicates removed by
+    # UniqueSurgeon), or ran surgeons that do not record moved objects, so
+    # that it can be undone only partially
+    complete = models.BooleanField(default=True)
+
+    class Meta:
+        ordering = ('pk',)
+
+class JournalEntry(models.Model):
+    '''
+    Objects of a model moved by a single operation of a journaled merge:
+    'field' of objects with primary keys 'pks' was changed from donor to
+    receiver. Primary keys are stored as ranges (see
+    transplant.utils.pack_pks), so that the entry stays small even for
+    millions of objects.
+    '''
+    journal = models.ForeignKey(MergeJournal, related_name='entries')
+    operation = models.PositiveIntegerField()
+    model = models.CharField(max_length=200)
+    field = models.CharField(max_length=100)
+    pks = models.TextField()
+    rows = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        ordering = ('journal', 'operation')
+
+class MergeRequest(models.Model):
+    '''
+    A merge requested through TransplantMergeView, identified by the token
+    of the submitted form. While the merge is running, 'lock' holds a key of
+    the (receiver, donor) pair, so that a unique index lets only one merge
+    of the pair run at a time. See transplant.guard.
+    '''
+    token = models.CharField(max_length=64, unique=True)
+    receiver = models.ForeignKey(User, related_name='+')
+    donor = models.ForeignKey(User, related_name='+')
+    status = models.CharField(max_length=10, choices=MergeJob.STATUS_CHOICES,
+                              default=MergeJob.RUNNING)
+    lock = models.CharField(max_length=50, unique=True, null=True, blank=True)
+    # job performing the merge if it was queued (see settings.TRANSPLANT_ASYNC)
+    job = models.ForeignKey(MergeJob, null=True, blank=True, related_name='+')
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(default=timezone.now)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ('pk',)
+
+class UserSession(models.Model):
+    '''
+    Key of a session a user logged in with, recorded when
+    settings.TRANSPLANT_REVOKE_SESSIONS is True, so that sessions of a donor
+    can be found without decoding every session (see transplant.cleanup).
+    '''
+    user = models.ForeignKey(User, related_name='+')
+    session_key = models.CharField(max_length=40, unique=True)
+    created = models.DateTimeField(default=timezone.now)
+
+from django.contrib.auth.signals import user_logged_in, user_logged_out
+
+from cleanup import index_session, unindex_session, cleanup_after_merge
+from signals import merge_committed
+
+user_logged_in.connect(index_session, dispatch_uid='transplant.index_session')
+user_logged_out.connect(unindex_session, dispatch_uid='transplant.unindex_session')
+merge_committed.connect(cleanup_after_merge, dispatch_uid='transplant.cleanup_after_merge')
@@ -0,0 +1,628 @@
+'''
+This module contains MergePlan class and helpers for accessing the merge plan
+compiled from settings.TRANSPLANT_OPERATIONS.
+'''
+import logging
+import random
+import sys
+import threading
+import time
+from collections import OrderedDict
+from functools import partial
+from operator import itemgetter
+
+from django.contrib.auth.models import User
+from django.db import connection, connections, router, transaction
+from django.test.signals import setting_changed
+from django.utils import timezone
+
+from conf import app_settings
+from discovery import discover_operations
+from instrumentation import MergeStats, QueryCounter
+from signals import merge_started, operation_started, operation_finished
+from signals import merge_committed, merge_rolled_back
+from surgery import Surgery
+from utils import execute_combined, is_retryable, save_fields, update_objects
+
+logger = logging.getLogger('transplant')
+
+class MergePlan(object):
+    '''
+    A resolved list of Surgery objects. Building a Surgery imports the model,
+    the manager and the surgeon class, so a plan should be built once and
+    reused for every merge.
+    '''
+    def __init__(self, operations):
+        '''
+        Builds a Surgery for each (model, surgeon, kwargs) triple in
+        operations, raising ImproperlyConfigured if any of them is invalid.
+        '''
+        self.surgeries = []
+        for model, surgeon, kwargs in operations:
+            self.surgeries.append(Surgery(model, surgeon, **dict(kwargs)))
+
+    def __len__(self):
+        return len(self.surgeries)
+
+    def __iter__(self):
+        return iter(self.surgeries)
+
+    def perform(self, receiver, donor, callback=None, stats=None):
+        '''
+        Runs every surgery of the plan and finalizes the donor. No
+        transaction management is done here, callers that batch many merges
+        in one transaction should use this method.
+
+        If callback is given, callback(index, surgery) is called after each
+        surgery is done.
+
+        Returns a transplant.instrumentation.MergeStats with timings, row
+        counts and query counts of each surgery (stats, if given, is filled
+        in instead of a new one).
+
+        Does nothing if receiver and donor are the same account.
+        '''
+        return self.perform_many(receiver, [donor], callback=callback, stats=stats)
+
+    def perform_many(self, receiver, donors, callback=None, stats=None):
+        '''
+        Works like perform(), but merges all donors into receiver in a single
+        pass over the surgeries (see Surgeon.merge_many).
+        '''
+        return self.run(self.steps_many(receiver, donors), callback, stats)
+
+    def perform_mapping(self, mapping, callback=None, stats=None):
+        '''
+        Works like perform(), but merges each donor into its receiver in
+        a single pass over the surgeries (see Surgeon.merge_mapping). mapping
+        is a dict {donor: receiver}, chains like {a: b, b: c} are resolved so
+        that both a and b are merged into c.
+        '''
+        return self.run(self.steps_mapping(mapping), callback, stats)
+
+    def steps_many(self, receiver, donors):
+        '''
+        Returns (mapping, call, finalize) of a merge of donors into receiver,
+        where mapping is {donor: receiver}, call(surgery) runs a surgery and
+        finalize() finalizes the donors.
+        '''
+        donors = [donor for donor in donors if donor.pk != receiver.pk]
+        mapping = dict((donor, receiver) for donor in donors)
+        if len(donors) == 1 and app_settings.TRANSPLANT_UNDO_JOURNAL:
+            return (mapping,) + self.steps_recording(receiver, donors[0])
+        if len(donors) == 1:
+            call = lambda surgery: surgery.merge(receiver, donors[0])
+            finalize = lambda: self.finalize(receiver, donors[0])
+        else:
+            call = lambda surgery: surgery.merge_many(receiver, donors)
+            finalize = lambda: self.finalize_many(receiver, donors)
+        if app_settings.TRANSPLANT_COMBINE_UPDATES:
+            call = self.combining(call, receiver, donors)
+        return mapping, call, finalize
+
+    def steps_pairs(self, pairs):
+        '''
+        Returns (mapping, call, finalize) of merges of each (receiver, donor)
+        in pairs, which every surgery runs one after another (see
+        steps_many()). finalize() returns the journal of the last pair, if
+        any.
+        '''
+        steps = [self.steps_many(receiver, [donor]) for receiver, donor in pairs]
+        steps = [pair_steps for pair_steps in steps if pair_steps[0]]
+        mapping = {}
+        for pair_mapping, _, _ in steps:
+            mapping.update(pair_mapping)
+        def call(surgery):
+            return sum(pair_call(surgery) or 0 for _, pair_call, _ in steps)
+        def finalize():
+            journals = [pair_finalize() for _, _, pair_finalize in steps]
+            return journals[-1] if journals else None
+        return mapping, call, finalize
+
+    def steps_recording(self, receiver, donor):
+        '''
+        Returns (call, finalize) of a merge of donor into receiver, that
+        records objects moved by each surgery (see Surgeon.merge_recording).
+        finalize() writes them to a new MergeJournal and returns it.
+        '''
+        from journal import record_journal
+        records = {}
+        def call(surgery):
+            records[surgery] = surgery.merge_recording(receiver, donor)
+            return records[surgery][0]
+        def finalize():
+            self.finalize(receiver, donor)
+            return record_journal(receiver, donor,
+                                  [records[surgery] for surgery in self.surgeries])
+        return call, finalize
+
+    def combining(self, call, receiver, donors):
+        '''
+        Wraps call(surgery), so that consecutive surgeries of a database
+        merging with a single UPDATE (see Surgeon.update_statement) send
+        their statements together (see transplant.utils.execute_combined).
+        The batch is executed by the first surgery of each such run, and the
+        other surgeries of the run report their rows from it, so that
+        surgeries still take effect in plan order.
+        '''
+        runs = {}
+        for alias, surgeries in self.groups():
+            run = []
+            for _, surgery in surgeries + [(None, None)]:
+                statement = None
+                if surgery is not None:
+                    statement = surgery.update_statement(receiver, donors, alias)
+                if statement is not None:
+                    run.append((surgery, statement))
+                    continue
+                if len(run) > 1:
+                    runs[run[0][0]] = (alias, run)
+                run = []
+        results = {}
+        def combined_call(surgery):
+            if surgery in runs:
+                alias, run = runs[surgery]
+                rows = execute_combined(alias, [statement for _, statement in run])
+                results.update(zip([other for other, _ in run], rows))
+            if surgery in results:
+                return results.pop(surgery)
+            return call(surgery)
+        return combined_call
+
+    def steps_mapping(self, mapping):
+        '''
+        Like steps_many(), but for a mapping {donor: receiver}.
+        '''
+        mapping = resolve_mapping(mapping)
+        return (mapping, lambda surgery: surgery.merge_mapping(mapping),
+                lambda: self.finalize_mapping(mapping))
+
+    def run(self, steps, callback=None, stats=None, atomic=False):
+        '''
+        Runs steps of a merge (see steps_many()) and returns its stats. If
+        atomic is True surgeries run in a transaction per database (see
+        run_atomic()), and merge_committed or merge_rolled_back is sent.
+
+        Atomic merges that fail with a deadlock or a serialization failure
+        (see transplant.utils.is_retryable) are rolled back and run again,
+        up to settings.TRANSPLANT_DEADLOCK_RETRIES times, waiting
+        retry_delay() in between. stats.retries counts these attempts.
+        '''
+        if stats is None:
+            stats = MergeStats()
+        mapping, call, finalize = steps
+        if not mapping:
+            return stats
+        stats.mapping = mapping
+        merge_started.send(sender=self.__class__, stats=stats)
+        started = time.time()
+        try:
+            if atomic:
+                while True:
+                    try:
+                        self.run_atomic(stats, call, finalize, callback)
+                        break
+                    except Exception as e:
+                        if not is_retryable(e) or \
+                                stats.retries >= app_settings.TRANSPLANT_DEADLOCK_RETRIES:
+                            raise
+                    time.sleep(self.retry_delay(stats.retries))
+                    stats.retries += 1
+                    stats.operations = []
+            else:
+                self.run_group(stats, list(enumerate(self.surgeries)), call, callback)
+                stats.journal = finalize()
+        except:
+            exc_info = sys.exc_info()
+            stats.time = time.time() - started
+            if atomic:
+                send_robust(merge_rolled_back, stats=stats, exception=exc_info[1])
+            raise exc_info[0], exc_info[1], exc_info[2]
+        stats.time = time.time() - started
+        if atomic:
+            send_robust(merge_committed, stats=stats)
+        return stats
+
+    def retry_delay(self, retries):
+        '''
+        Returns seconds to wait before running a merge again after given
+        number of retries: settings.TRANSPLANT_RETRY_DELAY doubled with each
+        retry, with random jitter so that merges which deadlocked each other
+        do not collide again.
+        '''
+        return app_settings.TRANSPLANT_RETRY_DELAY * 2 ** retries * random.uniform(0.5, 1.5)
+
+    def lock_users(self, alias, mapping):
+        '''
+        Locks rows of all receivers and donors of mapping with SELECT ... FOR
+        UPDATE, in primary key order, so that concurrent merges sharing
+        users wait for each other instead of deadlocking. Does nothing on
+        databases without row locks.
+        '''
+        if not connections[alias].features.has_select_for_update:
+            return
+        pks = set(donor.pk for donor in mapping) | set(r.pk for r in mapping.values())
+        list(User._base_manager.using(alias).select_for_update().filter(
+            pk__in=pks).order_by('pk').values_list('pk', flat=True))
+
+    def run_group(self, stats, surgeries, call, callback):
+        '''
+        Runs call(surgery) for each (index, surgery) in surgeries.
+        '''
+        for index, surgery in surgeries:
+            self.operate(stats, index, surgery, call)
+            if callback is not None:
+                callback(index, surgery)
+
+    def run_atomic(self, stats, call, finalize, callback):
+        '''
+        Runs surgeries grouped by database (see groups()), each database in
+        a transaction of its own. Receivers and donors are locked first (see
+        lock_users()). The database of User is used from the
+        calling thread, other ones from threads of their own (see
+        runs_concurrently()). Donors are finalized once all groups
+        succeeded, and transactions are committed, or all of them are rolled
+        back if any group fails.
+
+        This is not a two-phase commit: if committing one database fails,
+        databases committed before it are not rolled back.
+        '''
+        local, workers = [], []
+        for position, (alias, surgeries) in enumerate(self.groups()):
+            if position == 0 or not runs_concurrently(alias):
+                local.append((alias, surgeries))
+            else:
+                workers.append(AliasTransaction(
+                    alias, partial(self.run_group, stats, surgeries, call, callback)
+                ))
+        for alias, _ in local:
+            transaction.enter_transaction_management(using=alias)
+            transaction.managed(True, using=alias)
+        exc_info = None
+        started = []
+        try:
+            try:
+                self.lock_users(local[0][0], stats.mapping)
+                for worker in workers:
+                    worker.start()
+                    started.append(worker)
+                for _, surgeries in local:
+                    self.run_group(stats, surgeries, call, callback)
+            except:
+                exc_info = sys.exc_info()
+            for worker in started:
+                worker.ready.wait()
+                exc_info = exc_info or worker.exc_info
+            if exc_info is None:
+                try:
+                    # finalize() may read results of surgeries run by workers
+                    stats.journal = finalize()
+                    for alias, _ in local:
+                        transaction.commit(using=alias)
+                except:
+                    exc_info = sys.exc_info()
+            if exc_info is not None:
+                for alias, _ in local:
+                    transaction.rollback(using=alias)
+        finally:
+            for worker in started:
+                worker.finish(commit=exc_info is None)
+            for alias, _ in local:
+                transaction.leave_transaction_management(using=alias)
+        for worker in started:
+            exc_info = exc_info or worker.exc_info
+        stats.operations.sort(key=itemgetter('index'))
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def groups(self):
+        '''
+        Returns a list of (alias, [(index, surgery), ...]) with surgeries
+        grouped by the database their model is written to, according to
+        database routers. The database of User, where donors are finalized,
+        comes first.
+        '''
+        groups = OrderedDict([(router.db_for_write(User), [])])
+        for index, surgery in enumerate(self.surgeries):
+            alias = router.db_for_write(surgery.model)
+            groups.setdefault(alias, []).append((index, surgery))
+        return groups.items()
+
+    def operate(self, stats, index, surgery, call):
+        '''
+        Calls call(surgery), recording its wall time, changed rows and issued
+        queries in stats. Sends operation_started and operation_finished
+        around it.
+        '''
+        operation_started.send(sender=self.__class__, stats=stats, index=index,
+                               surgery=surgery)
+        started = time.time()
+        with QueryCounter(router.db_for_write(surgery.model)) as counter:
+            rows = call(surgery)
+        operation = {
+            'index': index,
+            'model': '{0}.{1}'.format(surgery.model._meta.app_label,
+                                      surgery.model.__name__),
+            'surgeon': surgery.surgeon.__class__.__name__,
+            'time': time.time() - started,
+            'rows': rows,
+            'queries': counter.count,
+        }
+        stats.operations.append(operation)
+        operation_finished.send(sender=self.__class__, stats=stats, index=index,
+                                surgery=surgery, operation=operation)
+
+    def finalize(self, receiver, donor):
+        '''
+        Called once per merge after all surgeries are done. Sets
+        donor.is_active to False, writing only this column.
+        '''
+        donor.is_active = False
+        save_fields(donor, ['is_active'])
+
+    def finalize_many(self, receiver, donors):
+        '''
+        Like finalize(), but deactivates all donors with a single UPDATE.
+        '''
+        update_objects(donors, is_active=False)
+
+    def finalize_mapping(self, mapping):
+        '''
+        Like finalize(), but deactivates all donors of mapping with a single
+        UPDATE.
+        '''
+        update_objects(mapping.keys(), is_active=False)
+
+    def merge(self, receiver, donor, callback=None):
+        '''
+        Runs every surgery of the plan in a single transaction (one per
+        database, see run_atomic()). The transaction is rolled back and the
+        exception re-raised if any of the surgeries fails. Sends
+        merge_committed or merge_rolled_back, and returns MergeStats of the
+        merge (see perform()).
+        '''
+        return self.merge_many(receiver, [donor], callback=callback)
+
+    def merge_many(self, receiver, donors, callback=None):
+        '''
+        Like merge(), but merges all donors into receiver.
+        '''
+        return self.run(self.steps_many(receiver, donors), callback, atomic=True)
+
+    def merge_mapping(self, mapping, callback=None):
+        '''
+        Like merge(), but merges each donor into its receiver, mapping is
+        a dict {donor: receiver}.
+        '''
+        return self.run(self.steps_mapping(mapping), callback, atomic=True)
+
+    def merge_pairs(self, pairs, callback=None):
+        '''
+        Like merge(), but merges each (receiver, donor) in pairs, in the
+        given order, in a single transaction per database.
+        '''
+        return self.run(self.steps_pairs(pairs), callback, atomic=True)
+
+    def merge_journaled(self, job, chunk_size=1000, callback=None):
+        '''
+        Merges job.donor into job.receiver (job is a running MergeJob) in
+        many short transactions instead of a single one: each surgery moves
+        donor's objects in chunks of chunk_size (see Surgeon.merge_chunk),
+        and every chunk is committed together with a MergeCheckpoint of its
+        operation. The donor is finalized, and the job marked as done, in
+        the last transaction.
+
+        Chunks only move objects still owned by the donor, so a merge that
+        was interrupted can be resumed by calling this method again: done
+        operations are skipped and the others continue where they stopped.
+        While it runs, objects are split between the two users, use
+        transplant.jobs.merge_in_progress() to tell readers about it.
+        '''
+        from models import MergeCheckpoint
+        receiver, donor = job.receiver, job.donor
+        checkpoints = dict((c.operation, c) for c in job.checkpoints.all())
+        stats = MergeStats()
+        stats.mapping = {donor: receiver}
+        merge_started.send(sender=self.__class__, stats=stats)
+        started = time.time()
+        for index, surgery in enumerate(self.surgeries):
+            checkpoint = checkpoints.get(index)
+            if checkpoint is None:
+                checkpoint = MergeCheckpoint(job=job, operation=index)
+            if not checkpoint.done:
+                def call(surgery):
+                    return self.merge_chunks(surgery, receiver, donor, chunk_size,
+                                             checkpoint)
+                self.operate(stats, index, surgery, call)
+            if callback is not None:
+                callback(index, surgery)
+        # MergeJob is stored with users, so the donor is finalized
+        # together with marking the job done
+        alias = router.db_for_write(User)
+        with transaction.commit_manually(using=alias):
+            try:
+                self.finalize(receiver, donor)
+                job.status = job.DONE
+                job.finished = timezone.now()
+                job.save()
+            except:
+                transaction.rollback(using=alias)
+                raise
+            transaction.commit(using=alias)
+        stats.time = time.time() - started
+        send_robust(merge_committed, stats=stats)
+        return stats
+
+    def merge_chunks(self, surgery, receiver, donor, chunk_size, checkpoint):
+        '''
+        Runs surgery chunk by chunk until it is done, committing each chunk
+        together with checkpoint. Surgery.start_chunks is called in the
+        transaction of the first chunk. If the checkpoint is stored in another
+        database than the surgery's model, it is saved once the chunk is
+        committed: a chunk committed without its checkpoint is harmless, as
+        chunks only move objects still owned by the donor. Returns the number
+        of moved rows.
+        '''
+        from models import MergeCheckpoint
+        alias = router.db_for_write(surgery.model)
+        checkpoint_alias = router.db_for_write(MergeCheckpoint)
+        rows = 0
+        while not checkpoint.done:
+            with transaction.commit_manually(using=alias):
+                try:
+                    if not checkpoint.chunks:
+                        surgery.start_chunks(receiver, donor)
+                    moved = surgery.merge_chunk(receiver, donor, chunk_size) or 0
+                    checkpoint.chunks += 1
+                    checkpoint.rows += moved
+                    checkpoint.done = moved < chunk_size
+                    if checkpoint_alias == alias:
+                        checkpoint.save()
+                except:
+                    transaction.rollback(using=alias)
+                    raise
+                transaction.commit(using=alias)
+            if checkpoint_alias != alias:
+                with transaction.commit_on_success(using=checkpoint_alias):
+                    checkpoint.save()
+            rows += moved
+        return rows
+
+    def dry_run(self, receiver, donor):
+        '''
+        Returns a list with a report of each surgery (see Surgery.dry_run),
+        without changing anything. Reports are gathered in a transaction
+        that is always rolled back, on PostgreSQL it is also read-only.
+        '''
+        with transaction.commit_manually():
+            try:
+                if connection.vendor == 'postgresql':
+                    connection.cursor().execute('SET TRANSACTION READ ONLY')
+                return [surgery.dry_run(receiver, donor)
+                        for surgery in self.surgeries]
+            finally:
+                transaction.rollback()
+
+class AliasTransaction(threading.Thread):
+    '''
+    Calls work() in a transaction on database alias, in a thread of its
+    own. Once work is done (or failed) 'ready' is set, and the thread waits
+    for finish() to commit or roll back the transaction. 'exc_info' holds
+    the exception raised by work() or by the commit, if any.
+    '''
+    def __init__(self, alias, work):
+        threading.Thread.__init__(self, name='transplant-{0}'.format(alias))
+        self.daemon = True
+        self.alias = alias
+        self.work = work
+        self.exc_info = None
+        self.commit = False
+        self.ready = threading.Event()
+        self.finished = threading.Event()
+
+    def run(self):
+        transaction.enter_transaction_management(using=self.alias)
+        transaction.managed(True, using=self.alias)
+        try:
+            try:
+                self.work()
+            except:
+                self.exc_info = sys.exc_info()
+            self.ready.set()
+            self.finished.wait()
+            if self.commit and self.exc_info is None:
+                try:
+                    transaction.commit(using=self.alias)
+                except:
+                    self.exc_info = sys.exc_info()
+            if not self.commit or self.exc_info is not None:
+                transaction.rollback(using=self.alias)
+        finally:
+            self.ready.set()
+            transaction.leave_transaction_management(using=self.alias)
+            connections[self.alias].close()
+
+    def finish(self, commit):
+        '''
+        Commits (or rolls back) the transaction and waits for the thread.
+        '''
+        self.commit = commit
+        self.finished.set()
+        self.join()
+
+def send_robust(signal, **kwargs):
+    '''
+    Sends signal once a merge was committed or rolled back. The merge cannot
+    be undone by then, so exceptions raised by receivers (e.g. session
+    cleanup, see transplant.cleanup) are logged instead of being raised.
+    '''
+    for receiver, result in signal.send_robust(sender=MergePlan, **kwargs):
+        if isinstance(result, Exception):
+            logger.error('Receiver %r of a merge signal failed: %s', receiver, result)
+
+def runs_concurrently(alias):
+    '''
+    Returns True if merges may use database alias from a thread of its own:
+    settings.TRANSPLANT_CONCURRENT_ALIASES is True and the database is not
+    an in-memory SQLite database (which is private to a connection).
+    '''
+    if not app_settings.TRANSPLANT_CONCURRENT_ALIASES:
+        return False
+    database = connections.databases[alias]
+    return not (database['ENGINE'].endswith('sqlite3') and
+                database['NAME'] in ('', ':memory:'))
+
+def resolve_mapping(mapping):
+    '''
+    Returns a copy of mapping {donor: receiver} where each donor points to
+    its final receiver, following chains: {a: b, b: c} becomes {a: c, b: c}.
+    Pairs of the same account are dropped. Raises ValueError if mapping
+    contains a cycle.
+    '''
+    receivers = dict((donor.pk, receiver) for donor, receiver in mapping.items())
+    resolved = {}
+    for donor, receiver in mapping.items():
+        seen = set([donor.pk])
+        while receiver.pk in receivers and receivers[receiver.pk].pk != receiver.pk:
+            if receiver.pk in seen:
+                raise ValueError('Merge mapping contains a cycle.')
+            seen.add(receiver.pk)
+            receiver = receivers[receiver.pk]
+        if receiver.pk != donor.pk:
+            resolved[donor] = receiver
+    return resolved
+
+_merge_plan = None
+
+# settings the merge plan is built from
+PLAN_SETTINGS = ('TRANSPLANT_OPERATIONS', 'TRANSPLANT_AUTODISCOVER')
+
+def get_merge_plan():
+    '''
+    Returns the MergePlan for settings.TRANSPLANT_OPERATIONS. The plan is
+    built on first use and cached until the setting changes.
+
+    If settings.TRANSPLANT_AUTODISCOVER is True the plan also includes
+    operations discovered from installed models (see
+    transplant.discovery), except for models which already have an
+    operation in TRANSPLANT_OPERATIONS.
+    '''
+    global _merge_plan
+    if _merge_plan is None:
+        operations = list(app_settings.TRANSPLANT_OPERATIONS)
+        if app_settings.TRANSPLANT_AUTODISCOVER:
+            configured = [surgery.model for surgery in MergePlan(operations)]
+            operations = discover_operations(exclude=configured) + operations
+        _merge_plan = MergePlan(operations)
+    return _merge_plan
+
+def clear_merge_plan(**kwargs):
+    '''
+    Drops the cached MergePlan, so that the next call to get_merge_plan()
+    builds it again.
+    '''
+    global _merge_plan
+    if kwargs.get('setting', 'TRANSPLANT_OPERATIONS') in PLAN_SETTINGS:
+        _merge_plan = None
+
+setting_changed.connect(clear_merge_plan)
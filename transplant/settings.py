@@ -1,7 +1,8 @@
 # DO NOT EDIT THIS FILE! THIS FILE IS INTENDED AS DEFAULT SETTINGS MODULE
 # TO OVERRIDE ANY OF THEM EDIT YOUR PROJECT'S MAIN SETTINGS FILE
-
-from django.conf import settings
+#
+# Values are read through transplant.conf.app_settings, which falls back to
+# this module for settings the project does not define.
 
 # Provide tuples in format
 # ('model.class.you.WantToMerge', 'surgeon.you.use.Surgeon', {'option': None})
@@ -18,9 +19,15 @@ from django.conf import settings
 # )
 TRANSPLANT_OPERATIONS = ()
 
-# URL that the user will be redirected to on transplant success. Defaults
-# to django.conf.settings.LOGIN_REDIRECT_URL
-TRANSPLANT_SUCCESS_URL = settings.LOGIN_REDIRECT_URL
+# If True, operations are also discovered from installed models: every
+# ForeignKey and OneToOneField pointing at User is merged with BatchSurgeon.
+# Operations given in TRANSPLANT_OPERATIONS take precedence over discovered
+# ones for the same model, e.g. use NopSurgeon to leave a model out.
+TRANSPLANT_AUTODISCOVER = False
+
+# URL that the user will be redirected to on transplant success. None means
+# django.conf.settings.LOGIN_REDIRECT_URL
+TRANSPLANT_SUCCESS_URL = None
 
 # If DEBUG is True this setting takes no effect, and any exception raised
 # during merge is re-raised.
@@ -29,3 +36,55 @@ TRANSPLANT_SUCCESS_URL = settings.LOGIN_REDIRECT_URL
 # If TRANSPLANT_FAILURE_URL is None any exception raised during merge is
 # re-raised. Default is None (500 error on failure).
 TRANSPLANT_FAILURE_URL = None
+
+# If True merges queued by TransplantMergeView are journaled: donor's objects
+# are moved in chunks of TRANSPLANT_JOURNAL_CHUNK_SIZE, each chunk committed
+# in a transaction of its own, so that an interrupted merge can be resumed
+# (see the --resume option of transplant_worker).
+TRANSPLANT_JOURNALED = False
+TRANSPLANT_JOURNAL_CHUNK_SIZE = 1000
+
+# If True merges performed by TransplantMergeView, MergePlan.merge() and
+# transplant_worker record primary keys of moved objects in
+# a transplant.models.MergeJournal, so that they can be undone with the
+# transplant_unmerge management command. Only merges of a single donor that
+# are not journaled (see TRANSPLANT_JOURNALED) are recorded.
+TRANSPLANT_UNDO_JOURNAL = False
+
+# If True operations of a merge that move objects with a single UPDATE
+# (BatchSurgeon) send their statements together, one batch per run of such
+# operations following one another on a database: a chain of data-modifying
+# CTEs on PostgreSQL, costing a single round trip.
+# Other databases execute the statements one after another.
+TRANSPLANT_COMBINE_UPDATES = False
+
+# If True keys of sessions users log in with are recorded, and sessions of
+# donors are deleted once a merge is committed.
+TRANSPLANT_REVOKE_SESSIONS = False
+
+# Keys of per-user cache entries deleted from the default cache for both the
+# receiver and the donor once a merge is committed. Each key is formatted
+# with the user, e.g. 'profile:{user.pk}'.
+TRANSPLANT_CACHE_KEYS = ()
+
+# Seconds after which a merge requested through TransplantMergeView that is
+# still running (e.g. its process crashed) no longer blocks other merges of
+# the same accounts.
+TRANSPLANT_MERGE_LOCK_TIMEOUT = 3600
+
+# If True operations on models routed to databases other than the one of User
+# run concurrently, each database in a thread and a transaction of its own.
+# Transactions are committed only when operations on all databases succeeded.
+TRANSPLANT_CONCURRENT_ALIASES = True
+
+# Number of times a merge is run again when it fails with a deadlock or
+# a serialization failure, and seconds to wait before the first retry (the
+# delay doubles with each retry, with random jitter).
+TRANSPLANT_DEADLOCK_RETRIES = 3
+TRANSPLANT_RETRY_DELAY = 0.05
+
+# If True TransplantMergeView does not perform the merge, but queues it as
+# a transplant.models.MergeJob. Queued jobs are performed by the
+# transplant_worker management command, and their status is available as
+# JSON at the 'transplant_job_status' URL.
+TRANSPLANT_ASYNC = False
@@ -0,0 +1,22 @@
+'''
+Signals sent by django-transplant.
+'''
+from django.dispatch import Signal
+
+# Sent by transplant.surgeons.NotifyingBatchSurgeon after it moved a batch of
+# objects from donor to receiver. The sender is the model class, 'pks' is the
+# list of primary keys of the moved objects.
+post_batch_merge = Signal(providing_args=['receiver', 'donor', 'pks'])
+
+# Sent by transplant.plan.MergePlan during a merge. The sender is the
+# MergePlan class, 'stats' is a transplant.instrumentation.MergeStats object
+# collecting timings, row counts and query counts of the merge.
+merge_started = Signal(providing_args=['stats'])
+operation_started = Signal(providing_args=['stats', 'index', 'surgery'])
+# 'operation' is the dict appended to stats.operations
+operation_finished = Signal(
+    providing_args=['stats', 'index', 'surgery', 'operation'])
+# sent by MergePlan.merge(), merge_many() and merge_mapping() only, perform()
+# leaves transactions to its caller
+merge_committed = Signal(providing_args=['stats'])
+merge_rolled_back = Signal(providing_args=['stats', 'exception'])
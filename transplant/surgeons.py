@@ -2,6 +2,34 @@
 This module contains Surgeon classes. Surgeon objects perform operation on
 models' managers and user instances when performing an account merge.
 '''
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, router, transaction
+
+from signals import post_batch_merge
+from utils import chunked, max_params, save_fields, update_returning, update_sql
+
+def is_filtered(manager):
+    '''
+    Returns True if queryset of manager does not include all rows of its
+    model's table.
+    '''
+    query = manager.all().query
+    return bool(query.where or query.extra)
+
+def unique_keys(model, user_field):
+    '''
+    Returns a list of tuples of fields which, together with user_field, have
+    to be unique for model (an empty tuple if user_field itself is unique,
+    e.g. a OneToOneField).
+    '''
+    keys = []
+    if model._meta.get_field(user_field).unique:
+        keys.append(())
+    for fields in model._meta.unique_together:
+        if user_field in fields:
+            keys.append(tuple(f for f in fields if f != user_field))
+    return keys
 
 class NopSurgeon:
     '''
@@ -14,49 +42,873 @@ class NopSurgeon:
 
     def merge(self, receiver, donor):
         '''
-        Merges two users. In this implementation this method does nothing.
+        Merges two users. Returns the number of changed rows (None if not
+        known). In this implementation this method does nothing.
+        '''
+        return 0
+
+    def merge_many(self, receiver, donors):
+        '''
+        Merges all donors into receiver. This implementation calls merge()
+        for each donor, subclasses should do it in a single pass.
+        '''
+        return sum(self.merge(receiver, donor) or 0 for donor in donors)
+
+    def merge_mapping(self, mapping):
+        '''
+        Merges each donor into its receiver, mapping is a dict
+        {donor: receiver}. This implementation calls merge() for each pair,
+        subclasses should do it in a single pass.
+        '''
+        return sum(
+            self.merge(receiver, donor) or 0 for donor, receiver in mapping.items()
+        )
+
+    def merge_recording(self, receiver, donor):
+        '''
+        Works like merge(), but also tells which objects were moved, so that
+        the merge can be undone (see transplant.journal). Returns
+        (rows, record), where record is (model, field, pks): primary keys of
+        model's objects whose field was changed from donor to receiver.
+        record is None if the surgeon cannot tell, as in this implementation.
+        '''
+        return self.merge(receiver, donor), None
+
+    def update_statement(self, receiver, donors, using):
+        '''
+        Returns (sql, params) of a single UPDATE moving objects of donors to
+        receiver on database 'using', so that MergePlan can send it together
+        with statements of other surgeons (see
+        settings.TRANSPLANT_COMBINE_UPDATES). Returns None if the surgeon
+        does not merge with a single UPDATE, as in this implementation.
+        '''
+        return None
+
+    def merge_chunk(self, receiver, donor, size):
+        '''
+        Moves at most size of donor's objects to receiver, and returns the
+        number of moved objects. Used by journaled merges, which call it
+        until it returns less than size, each call in a transaction of its
+        own. This implementation merges all objects at once, subclasses
+        moving objects one chunk at a time should override it.
+        '''
+        self.merge(receiver, donor)
+        return 0
+
+    def start_chunks(self, receiver, donor):
+        '''
+        Called by journaled merges once per operation, before the first
+        chunk is moved (see merge_chunk()) and in the transaction of that
+        chunk. This implementation does nothing.
         '''
         pass
 
+    def dry_run(self, receiver, donor):
+        '''
+        Describes what merge() would do, without changing the database.
+        Returns a dict with keys:
+          - 'strategy', a short description of how objects are merged,
+          - 'queryset' of rows that would be changed (or None),
+          - 'statements', a list of (sql, params) of writes merge() would
+            issue.
+        '''
+        return {'strategy': 'nothing', 'queryset': None, 'statements': []}
+
+    def donors_per_lookup(self, using):
+        '''
+        Returns how many donors fit in a single user_field__in lookup on
+        the manager's queryset on database 'using', or None if there is no
+        limit. One parameter is left for a further condition (e.g. the pk of
+        the last object of a chunk).
+        '''
+        limit = max_params(using)
+        if limit is None:
+            return None
+        return limit - len(self.manager.all().query.sql_with_params()[1]) - 1
+
 class DefaultSurgeon(NopSurgeon):
     '''
     This class merges two users by setting user (or a field given as
     'user_field') to receiver on all objects in given manager and calling
-    save() on each of them (so that all signals etc. are fired)
+    save() on each of them (so that all signals are fired)
+
+    If 'chunk_size' is given, objects are loaded in chunks of this size,
+    walking the manager in primary key order, so that at most one chunk of
+    objects is held in memory.
+
+    If 'narrow' is True, only the primary key, 'user_field' and fields
+    listed in 'signal_fields' are loaded, and only 'user_field' is written
+    back (see transplant.utils.save_fields). Signals are still sent for
+    each object. List in 'signal_fields' all fields your signal handlers
+    read, other fields are loaded with an extra query on access.
+
+    Surgeons do not deactivate the donor, this is done once per merge by
+    transplant.plan.MergePlan.
     '''
+    def __init__(self, manager, user_field='user', chunk_size=None,
+                 narrow=False, signal_fields=()):
+        NopSurgeon.__init__(self, manager, user_field=user_field)
+        self.chunk_size = chunk_size
+        self.narrow = narrow
+        self.signal_fields = tuple(signal_fields)
     
     def merge(self, receiver, donor):
         '''
-        Sets donor.is_active to false.
-        
         Iterates over given manager and changes 'user_field' field value
         to self.receiver. Calls save on each objects separately.
         '''
-        if receiver is donor:
-            return
-        donor.is_active = False
-        donor.save()
-        
+        return self.merge_many(receiver, [donor])
+    
+    def merge_many(self, receiver, donors):
+        '''
+        Works like merge(), but moves objects of all donors with a single
+        scan over the manager.
+        '''
+        return self.merge_mapping(dict(
+            (donor, receiver) for donor in donors if donor.pk != receiver.pk
+        ))
+    
+    def merge_mapping(self, mapping):
+        '''
+        Moves objects of each donor to its receiver with a single scan over
+        the manager (one for each chunk of donors on SQLite).
+        '''
+        receivers = dict(
+            (donor.pk, receiver) for donor, receiver in mapping.items()
+            if donor.pk != receiver.pk
+        )
+        return self.move(receivers)
+    
+    def merge_recording(self, receiver, donor):
+        moved = []
+        if receiver.pk != donor.pk:
+            self.move({donor.pk: receiver}, moved)
+        return len(moved), (self.manager.model, self.user_field, moved)
+    
+    def move(self, receivers, moved=None):
+        '''
+        Moves objects of each donor to its receiver, receivers is a dict
+        {donor's pk: receiver}. Returns the number of moved objects. If
+        moved is a list, primary keys of moved objects are appended to it.
+        '''
+        if not receivers:
+            return 0
+        attname = self.manager.model._meta.get_field(self.user_field).attname
+        size = self.donors_per_lookup(self.manager.db)
+        rows = 0
+        for donor_pks in chunked(receivers.keys(), size):
+            kw = {'{0}__in'.format(self.user_field): donor_pks}
+            queryset = self.manager.filter(**kw)
+            if self.narrow:
+                queryset = queryset.only(self.user_field, *self.signal_fields)
+            for obj in self.iterate(queryset):
+                setattr(obj, self.user_field, receivers[getattr(obj, attname)])
+                self.save(obj)
+                rows += 1
+                if moved is not None:
+                    moved.append(obj.pk)
+        return rows
+    
+    def merge_chunk(self, receiver, donor, size):
         kw = {'{0}'.format(self.user_field): donor}
-        for obj in self.manager.filter(**kw):
+        queryset = self.manager.filter(**kw).order_by('pk')
+        if self.narrow:
+            queryset = queryset.only(self.user_field, *self.signal_fields)
+        objs = list(queryset[:size])
+        for obj in objs:
             setattr(obj, self.user_field, receiver)
+            self.save(obj)
+        return len(objs)
+    
+    def dry_run(self, receiver, donor):
+        '''
+        Reports the UPDATE issued for a single object, of all its columns
+        (just 'user_field' if the surgeon is narrow). It is repeated once
+        per object, with the object's values in place of '<field>' params.
+        '''
+        kw = {'{0}'.format(self.user_field): donor}
+        queryset = self.manager.filter(**kw)
+        strategy = 'save() of each object'
+        if self.narrow:
+            strategy = 'UPDATE of {0} of each object'.format(self.user_field)
+        if self.chunk_size:
+            strategy += ', in chunks of {0}'.format(self.chunk_size)
+        strategy += ', statements repeat once per object'
+        return {'strategy': strategy, 'queryset': queryset,
+                'statements': self.object_statements(receiver)}
+    
+    def object_statements(self, receiver):
+        '''
+        Returns (sql, params) of UPDATE statements saving a single object
+        moved to receiver, one for each table of the model (and its parents)
+        with columns to write. Params other than the receiver are
+        placeholders, like '<pk>'.
+        '''
+        model = self.manager.model
+        qn = connections[router.db_for_write(model)].ops.quote_name
+        user_field = model._meta.get_field(self.user_field)
+        statements = []
+        for table_model in [model] + list(model._meta.get_parent_list()):
+            fields = [f for f in table_model._meta.local_fields if not f.primary_key
+                      and (f is user_field or not self.narrow)]
+            if not fields:
+                continue
+            sql = 'UPDATE {0} SET {1} WHERE {2} = %s'.format(
+                qn(table_model._meta.db_table),
+                ', '.join('{0} = %s'.format(qn(f.column)) for f in fields),
+                qn(table_model._meta.pk.column))
+            params = [receiver.pk if f is user_field else '<{0}>'.format(f.attname)
+                      for f in fields]
+            statements.append((sql, params + ['<pk>']))
+        return statements
+    
+    def save(self, obj):
+        '''
+        Saves obj after its 'user_field' was changed. Writes just this field
+        if the surgeon is narrow.
+        '''
+        if self.narrow:
+            save_fields(obj, [self.user_field])
+        else:
             obj.save()
+    
+    def iterate(self, queryset):
+        '''
+        Yields objects from queryset, one chunk at a time if chunk_size
+        is set. Chunks are fetched with keyset pagination on the primary key
+        (pk > last pk of the previous chunk), so objects that no longer match
+        the queryset once saved are not skipped nor fetched twice.
+        '''
+        if not self.chunk_size:
+            for obj in queryset:
+                yield obj
+            return
+        queryset = queryset.order_by('pk')
+        last_pk = None
+        while True:
+            if last_pk is not None:
+                chunk = list(queryset.filter(pk__gt=last_pk)[:self.chunk_size])
+            else:
+                chunk = list(queryset[:self.chunk_size])
+            for obj in chunk:
+                yield obj
+            if len(chunk) < self.chunk_size:
+                return
+            last_pk = chunk[-1].pk
+            del chunk
 
 class BatchSurgeon(NopSurgeon):
     '''
     Merges two users just like DefaultSurgeon does but without calling
     save on each instance.
     '''
+    # Maximum number of (donor, receiver) pairs in a single statement issued
+    # by merge_mapping(). None means no limit, except on SQLite where chunks
+    # are sized to its limit of query parameters (see mapping_size()).
+    mapping_chunk_size = None
     
     def merge(self, receiver, donor):
-        if receiver is donor:
-            return
-        donor.is_active = False
-        donor.save()
-        
+        if receiver.pk == donor.pk:
+            return 0
         filter_kwargs = {'{0}'.format(self.user_field): donor}
         update_kwargs = {'{0}'.format(self.user_field): receiver}
         
-        self.manager.filter(**filter_kwargs).update(**update_kwargs)
+        return self.manager.filter(**filter_kwargs).update(**update_kwargs)
+    
+    def merge_many(self, receiver, donors):
+        '''
+        Moves objects of all donors to receiver with a single UPDATE.
+        '''
+        donors = [donor for donor in donors if donor.pk != receiver.pk]
+        if not donors:
+            return 0
+        filter_kwargs = {'{0}__in'.format(self.user_field): donors}
+        update_kwargs = {'{0}'.format(self.user_field): receiver}
+        
+        return self.manager.filter(**filter_kwargs).update(**update_kwargs)
+    
+    def merge_mapping(self, mapping):
+        '''
+        Moves objects of each donor to its receiver with a single
+        UPDATE ... SET user_field = CASE user_field WHEN donor THEN receiver
+        ... END statement (split into chunks, see mapping_size()).
+        '''
+        pairs = [
+            (donor.pk, receiver.pk) for donor, receiver in mapping.items()
+            if donor.pk != receiver.pk
+        ]
+        if not pairs:
+            return 0
+        model = self.manager.model
+        using = router.db_for_write(model)
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        column = qn(model._meta.get_field(self.user_field).column)
+        size = self.mapping_size(using, pairs[0][0])
+        cursor = connection.cursor()
+        rows = 0
+        for chunk in chunked(pairs, size):
+            donors = [donor for donor, _ in chunk]
+            sql = 'UPDATE {0} SET {1} = CASE {1} {2} END WHERE {1} IN ({3})'.format(
+                qn(model._meta.db_table),
+                column,
+                ' '.join(['WHEN %s THEN %s'] * len(chunk)),
+                ', '.join(['%s'] * len(chunk)),
+            )
+            params = [pk for pair in chunk for pk in pair] + donors
+            restriction, restriction_params = self.restrict(using, donors)
+            cursor.execute(sql + restriction, params + restriction_params)
+            rows += cursor.rowcount
+        transaction.commit_unless_managed(using=using)
+        return rows
+    
+    def mapping_size(self, using, donor_pk):
+        '''
+        Returns how many (donor, receiver) pairs merge_mapping() puts in a
+        single statement on database 'using': mapping_chunk_size if set,
+        otherwise as many as fit in the limit of query parameters (None if
+        there is no limit). donor_pk is a sample donor for restrict().
+        '''
+        if self.mapping_chunk_size is not None:
+            return self.mapping_chunk_size
+        limit = max_params(using)
+        if limit is None:
+            return None
+        # each pair takes three params (WHEN, THEN and IN), restrict() adds
+        # one more per donor on top of the manager's own params
+        restriction_params = self.restrict(using, [donor_pk])[1]
+        if not restriction_params:
+            return limit // 3
+        return (limit - len(restriction_params) + 1) // 4
+    
+    def update_statement(self, receiver, donors, using):
+        '''
+        Returns the UPDATE issued by merge_many(). Subclasses that override
+        merge() or merge_many() (e.g. to send signals) are not combined, and
+        neither are models whose update touches parent tables.
+        '''
+        cls = self.__class__
+        if cls.merge.im_func is not BatchSurgeon.merge.im_func or \
+                cls.merge_many.im_func is not BatchSurgeon.merge_many.im_func:
+            return None
+        donors = [donor for donor in donors if donor.pk != receiver.pk]
+        if not donors:
+            return None
+        filter_kwargs = {'{0}__in'.format(self.user_field): donors}
+        update_kwargs = {'{0}'.format(self.user_field): receiver}
+        return update_sql(self.manager.using(using).filter(**filter_kwargs),
+                          **update_kwargs)
+    
+    def merge_recording(self, receiver, donor):
+        '''
+        Moves donor's objects with a single UPDATE ... RETURNING on
+        PostgreSQL. Elsewhere primary keys of donor's objects are selected
+        (and locked, where supported) first.
+        '''
+        moved = []
+        if receiver.pk != donor.pk:
+            filter_kwargs = {'{0}'.format(self.user_field): donor}
+            update_kwargs = {'{0}'.format(self.user_field): receiver}
+            queryset = self.manager.filter(**filter_kwargs)
+            moved = update_returning(queryset, **update_kwargs)
+        return len(moved), (self.manager.model, self.user_field, moved)
+    
+    def merge_chunk(self, receiver, donor, size):
+        '''
+        Moves a chunk of donor's objects with a single UPDATE of their primary
+        keys, which are selected first.
+        '''
+        if receiver.pk == donor.pk:
+            return 0
+        pks = self.chunk_pks(donor, size)
+        if pks:
+            update_kwargs = {'{0}'.format(self.user_field): receiver}
+            self.manager.filter(pk__in=pks).update(**update_kwargs)
+        return len(pks)
+    
+    def chunk_pks(self, donor, size):
+        '''
+        Returns primary keys of at most size of donor's objects.
+        '''
+        filter_kwargs = {'{0}'.format(self.user_field): donor}
+        return list(self.manager.filter(**filter_kwargs).order_by('pk').values_list(
+            'pk', flat=True)[:size])
+    
+    def dry_run(self, receiver, donor):
+        filter_kwargs = {'{0}'.format(self.user_field): donor}
+        update_kwargs = {'{0}'.format(self.user_field): receiver}
+        queryset = self.manager.filter(**filter_kwargs)
+        return {
+            'strategy': 'single UPDATE',
+            'queryset': queryset,
+            'statements': [update_sql(queryset, **update_kwargs)],
+        }
+    
+    def restrict(self, using, donors):
+        '''
+        Returns SQL (and its params) to be appended to the WHERE clause of a
+        raw statement, so that it affects only objects of donors available
+        through self.manager. Returns an empty string for managers that do
+        not filter their queryset.
+        '''
+        if not is_filtered(self.manager):
+            return '', []
+        kw = {'{0}__in'.format(self.user_field): donors}
+        queryset = self.manager.using(using).filter(**kw)
+        connection = connections[using]
+        pk = connection.ops.quote_name(self.manager.model._meta.pk.column)
+        if connection.features.update_can_self_select:
+            sql, params = queryset.values('pk').query.sql_with_params()
+            return ' AND {0} IN ({1})'.format(pk, sql), list(params)
+        pks = list(queryset.values_list('pk', flat=True)) or [None]
+        return ' AND {0} IN ({1})'.format(pk, ', '.join(['%s'] * len(pks))), pks
+
+class NotifyingBatchSurgeon(BatchSurgeon):
+    '''
+    Merges two users just like BatchSurgeon does, with a single UPDATE.
+    Instead of per-object signals it sends one
+    transplant.signals.post_batch_merge signal with primary keys of all
+    moved objects, so that listeners can act on the whole batch at once.
+    '''
+    
+    def merge(self, receiver, donor):
+        return self.merge_recording(receiver, donor)[0]
+    
+    def merge_recording(self, receiver, donor):
+        rows, record = BatchSurgeon.merge_recording(self, receiver, donor)
+        if rows:
+            post_batch_merge.send(
+                sender=self.manager.model,
+                receiver=receiver,
+                donor=donor,
+                pks=record[2],
+            )
+        return rows, record
+    
+    def merge_many(self, receiver, donors):
+        '''
+        Moves objects of all donors to receiver with a single UPDATE, and
+        sends post_batch_merge once for each donor that had any objects.
+        '''
+        donors = [donor for donor in donors if donor.pk != receiver.pk]
+        filter_kwargs = {'{0}__in'.format(self.user_field): donors}
+        rows = self.manager.filter(**filter_kwargs).values_list('pk', self.user_field)
+        pks = {}
+        for pk, donor_pk in rows:
+            pks.setdefault(donor_pk, []).append(pk)
+        if not pks:
+            return 0
+        BatchSurgeon.merge_many(self, receiver, donors)
+        for donor in donors:
+            if donor.pk in pks:
+                post_batch_merge.send(
+                    sender=self.manager.model,
+                    receiver=receiver,
+                    donor=donor,
+                    pks=pks[donor.pk],
+                )
+        return sum(len(donor_pks) for donor_pks in pks.values())
+    
+    def merge_mapping(self, mapping):
+        '''
+        Moves objects of each donor to its receiver with a single UPDATE, and
+        sends post_batch_merge once for each donor that had any objects.
+        '''
+        mapping = dict(
+            (donor, receiver) for donor, receiver in mapping.items()
+            if donor.pk != receiver.pk
+        )
+        pks = {}
+        size = self.donors_per_lookup(self.manager.db)
+        for donors in chunked(mapping.keys(), size):
+            filter_kwargs = {'{0}__in'.format(self.user_field): donors}
+            rows = self.manager.filter(**filter_kwargs).values_list(
+                'pk', self.user_field)
+            for pk, donor_pk in rows:
+                pks.setdefault(donor_pk, []).append(pk)
+        if not pks:
+            return 0
+        BatchSurgeon.merge_mapping(self, mapping)
+        for donor, receiver in mapping.items():
+            if donor.pk in pks:
+                post_batch_merge.send(
+                    sender=self.manager.model,
+                    receiver=receiver,
+                    donor=donor,
+                    pks=pks[donor.pk],
+                )
+        return sum(len(donor_pks) for donor_pks in pks.values())
+
+    def merge_chunk(self, receiver, donor, size):
+        '''
+        Moves a chunk of donor's objects and sends post_batch_merge for it.
+        '''
+        if receiver.pk == donor.pk:
+            return 0
+        pks = self.chunk_pks(donor, size)
+        if pks:
+            update_kwargs = {'{0}'.format(self.user_field): receiver}
+            self.manager.filter(pk__in=pks).update(**update_kwargs)
+            post_batch_merge.send(
+                sender=self.manager.model,
+                receiver=receiver,
+                donor=donor,
+                pks=pks,
+            )
+        return len(pks)
+
+    def dry_run(self, receiver, donor):
+        description = BatchSurgeon.dry_run(self, receiver, donor)
+        description['strategy'] = 'single UPDATE and a post_batch_merge signal'
+        return description
+
+class ManyToManySurgeon(NopSurgeon):
+    '''
+    Merges relations stored in the through table of a ManyToManyField given
+    as 'user_field'. The field may point at User (e.g. Team.members) or be
+    defined on User itself.
+
+    Donor's rows are moved to receiver with set-based SQL, a fixed number of
+    statements regardless of the number of rows: rows of objects that are
+    already related to receiver are left behind and deleted, so that no
+    duplicate pairs are created. Rows are updated in place, so extra columns
+    of custom through models are kept. No signals (m2m_changed) are sent.
+    '''
+    def __init__(self, manager, user_field='user'):
+        NopSurgeon.__init__(self, manager, user_field=user_field)
+        model = manager.model
+        field = model._meta.get_field(user_field)
+        if not hasattr(field.rel, 'through'):
+            raise ImproperlyConfigured(
+                "Field '{0}' of model '{1}' is not a ManyToManyField.".format(
+                    user_field, model.__name__)
+            )
+        # (user field name, user column, other column) of the through table
+        self.sides = []
+        if field.rel.to is User:
+            self.sides.append((field.m2m_reverse_field_name(),
+                               field.m2m_reverse_name(), field.m2m_column_name()))
+        if model is User:
+            self.sides.append((field.m2m_field_name(),
+                               field.m2m_column_name(), field.m2m_reverse_name()))
+        if not self.sides:
+            raise ImproperlyConfigured(
+                "Field '{0}' of model '{1}' is not related to User.".format(
+                    user_field, model.__name__)
+            )
+        self.field = field
+    
+    def merge(self, receiver, donor):
+        if receiver.pk == donor.pk:
+            return 0
+        using = router.db_for_write(self.field.rel.through)
+        cursor = connections[using].cursor()
+        rows = 0
+        for sql, params in self.statements(receiver, donor, using):
+            cursor.execute(sql, params)
+            rows += cursor.rowcount
+        transaction.commit_unless_managed(using=using)
+        return rows
+    
+    def merge_recording(self, receiver, donor):
+        '''
+        Records primary keys of through table rows moved to receiver. Rows
+        left behind as duplicates are deleted and cannot be restored. Not
+        supported for fields between User and User.
+        '''
+        if len(self.sides) != 1 or receiver.pk == donor.pk:
+            return self.merge(receiver, donor), None
+        through = self.field.rel.through
+        name, _, other_column = self.sides[0]
+        other = [f.name for f in through._meta.fields if f.column == other_column][0]
+        related = through._default_manager.filter(**{name: receiver}).values_list(
+            other, flat=True)
+        queryset = through._default_manager.filter(**{name: donor}).exclude(
+            **{'{0}__in'.format(other): related})
+        if self.manager.model is not User and is_filtered(self.manager):
+            queryset = queryset.filter(**{'{0}__in'.format(other): self.manager.all()})
+        moved = list(queryset.values_list('pk', flat=True))
+        return self.merge(receiver, donor), (through, name, moved)
+    
+    def statements(self, receiver, donor, using):
+        '''
+        Returns a list of (sql, params) of statements moving donor's rows of
+        the through table to receiver.
+        '''
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        table = qn(self.field.rel.through._meta.db_table)
+        statements = []
+        for _, user_column, other_column in self.sides:
+            user_column, other_column = qn(user_column), qn(other_column)
+            related = 'SELECT {0} FROM {1} WHERE {2} = %s'.format(
+                other_column, table, user_column)
+            if not connection.features.update_can_self_select:
+                related = 'SELECT {0} FROM ({1}) AS related'.format(
+                    other_column, related)
+            sql = ('UPDATE {0} SET {1} = %s WHERE {1} = %s '
+                   'AND {2} NOT IN ({3})').format(table, user_column, other_column, related)
+            restriction, restriction_params = self.restrict(using, other_column)
+            statements.append((sql + restriction,
+                               [receiver.pk, donor.pk, receiver.pk] + restriction_params))
+            sql = 'DELETE FROM {0} WHERE {1} = %s'.format(table, user_column)
+            statements.append((sql + restriction, [donor.pk] + restriction_params))
+        return statements
+    
+    def dry_run(self, receiver, donor):
+        through = self.field.rel.through
+        lookup = dict((name, donor) for name, _, _ in self.sides[:1])
+        return {
+            'strategy': 'set-based UPDATE and DELETE of through table rows',
+            'queryset': through._default_manager.filter(**lookup),
+            'statements': self.statements(receiver, donor, router.db_for_write(through)),
+        }
+    
+    def restrict(self, using, column):
+        '''
+        Returns SQL (and its params) to be appended to the WHERE clause, so
+        that only rows of objects available through self.manager are
+        affected. Returns an empty string for managers that do not filter
+        their queryset, or if the field is defined on User.
+        '''
+        if self.manager.model is User or not is_filtered(self.manager):
+            return '', []
+        queryset = self.manager.using(using).all()
+        sql, params = queryset.values('pk').query.sql_with_params()
+        return ' AND {0} IN ({1})'.format(column, sql), list(params)
+
+class UniqueSurgeon(BatchSurgeon):
+    '''
+    Merges objects with a unique constraint on 'user_field' (a OneToOneField,
+    or a field listed in unique_together), just like BatchSurgeon does, but
+    resolves conflicts instead of failing with IntegrityError.
+
+    Conflicting pairs of receiver's and donor's objects are found with
+    a single query. For each pair one object is kept and the other one
+    deleted, depending on 'policy':
+      - 'keep_receiver' (default) keeps receiver's object,
+      - 'keep_donor' keeps donor's object,
+      - 'newest' keeps the object with greater 'newest_field' value (the
+        primary key by default),
+      - a callable is called as policy(receiver_object, donor_object) and
+        should return the object to keep.
+    Losing objects are deleted in bulk before the remaining ones are moved.
+
+    Fields making up the unique constraint are found in the model's meta
+    options, or can be given as 'unique_fields' (not including
+    'user_field').
+    '''
+    KEEP_RECEIVER = 'keep_receiver'
+    KEEP_DONOR = 'keep_donor'
+    NEWEST = 'newest'
+    
+    def __init__(self, manager, user_field='user', policy=KEEP_RECEIVER,
+                 unique_fields=None, newest_field='pk'):
+        BatchSurgeon.__init__(self, manager, user_field=user_field)
+        model = manager.model
+        if unique_fields is None:
+            self.keys = unique_keys(model, user_field)
+        else:
+            self.keys = [tuple(unique_fields)]
+        if not self.keys:
+            raise ImproperlyConfigured(
+                "Field '{0}' of model '{1}' is not unique.".format(
+                    user_field, model.__name__)
+            )
+        if policy not in (self.KEEP_RECEIVER, self.KEEP_DONOR, self.NEWEST) \
+                and not callable(policy):
+            raise ImproperlyConfigured(
+                "Unknown conflict policy '{0}'.".format(policy)
+            )
+        self.policy = policy
+        self.newest_field = newest_field
+    
+    def merge(self, receiver, donor):
+        if receiver.pk == donor.pk:
+            return 0
+        losers = self.losers(self.conflicts(receiver, donor))
+        if losers:
+            self.manager.model._base_manager.filter(pk__in=losers).delete()
+        return len(losers) + BatchSurgeon.merge(self, receiver, donor)
+    
+    def merge_recording(self, receiver, donor):
+        '''
+        Records objects moved to receiver. Objects deleted due to conflicts
+        cannot be restored.
+        '''
+        if receiver.pk == donor.pk:
+            return 0, (self.manager.model, self.user_field, [])
+        losers = self.losers(self.conflicts(receiver, donor))
+        if losers:
+            self.manager.model._base_manager.filter(pk__in=losers).delete()
+        rows, record = BatchSurgeon.merge_recording(self, receiver, donor)
+        return len(losers) + rows, record
+    
+    def start_chunks(self, receiver, donor):
+        '''
+        Resolves all conflicts before the first chunk of donor's objects is
+        moved, so that chunks are moved just like BatchSurgeon moves them.
+        '''
+        if receiver.pk == donor.pk:
+            return
+        losers = self.losers(self.conflicts(receiver, donor))
+        if losers:
+            self.manager.model._base_manager.filter(pk__in=losers).delete()
+    
+    def merge_many(self, receiver, donors):
+        '''
+        Donors may conflict with each other, so they are merged one by one.
+        '''
+        return NopSurgeon.merge_many(self, receiver, donors)
+    
+    def merge_mapping(self, mapping):
+        return NopSurgeon.merge_mapping(self, mapping)
+    
+    def dry_run(self, receiver, donor):
+        description = BatchSurgeon.dry_run(self, receiver, donor)
+        losers = self.losers(self.conflicts(receiver, donor))
+        strategy = 'DELETE of {0} conflicting objects ({1}) and single UPDATE'
+        description['strategy'] = strategy.format(len(losers), self.policy)
+        if losers:
+            description['statements'].insert(0, (
+                'DELETE FROM {0} WHERE {1} IN ({2})'.format(
+                    self.manager.model._meta.db_table,
+                    self.manager.model._meta.pk.column,
+                    ', '.join(['%s'] * len(losers))),
+                losers
+            ))
+        return description
+    
+    def conflicts(self, receiver, donor):
+        '''
+        Returns a list of (receiver's row, donor's row) pairs that would
+        violate a unique constraint if donor's objects were moved. Rows are
+        tuples (pk, newest_field value).
+        '''
+        model = self.manager.model
+        key_fields = sorted(set(f for key in self.keys for f in key))
+        fields = ['pk', self.newest_field, self.user_field] + key_fields
+        kw = {'{0}__in'.format(self.user_field): [receiver, donor]}
+        rows = model._base_manager.filter(**kw).values_list(*fields)
+        if is_filtered(self.manager):
+            movable = set(self.manager.filter(
+                **{self.user_field: donor}).values_list('pk', flat=True))
+        else:
+            movable = None
+        received = [dict() for _ in self.keys]
+        donated = []
+        for row in rows:
+            values = dict(zip(key_fields, row[3:]))
+            if row[2] == receiver.pk:
+                for index, key in enumerate(self.keys):
+                    received[index][tuple(values[f] for f in key)] = row[:2]
+            elif movable is None or row[0] in movable:
+                donated.append((row[:2], values))
+        conflicts = []
+        for row, values in donated:
+            for index, key in enumerate(self.keys):
+                value = tuple(values[f] for f in key)
+                if None not in value and value in received[index]:
+                    conflicts.append((received[index][value], row))
+        return conflicts
+    
+    def losers(self, conflicts):
+        '''
+        Applies the policy to conflicting pairs, returns primary keys of
+        objects to be deleted.
+        '''
+        if callable(self.policy) and conflicts:
+            objects = self.manager.model._base_manager.in_bulk(
+                [row[0] for pair in conflicts for row in pair]
+            )
+        losers = set()
+        for (receiver_pk, receiver_value), (donor_pk, donor_value) in conflicts:
+            if self.policy == self.KEEP_RECEIVER:
+                keep_donor = False
+            elif self.policy == self.KEEP_DONOR:
+                keep_donor = True
+            elif self.policy == self.NEWEST:
+                keep_donor = donor_value is not None and (
+                    receiver_value is None or donor_value > receiver_value)
+            else:
+                donor_object = objects[donor_pk]
+                kept = self.policy(objects[receiver_pk], donor_object)
+                keep_donor = kept is donor_object
+            losers.add(receiver_pk if keep_donor else donor_pk)
+        return list(losers)
+
+class GenericForeignKeySurgeon(NopSurgeon):
+    '''
+    Merges objects pointing at users through a GenericForeignKey given as
+    'user_field' (e.g. comments, activity stream entries or audit logs).
+    Donor's objects are moved with a single UPDATE of the object id column,
+    restricted to the content type of User, so that an index on
+    (content type, object id) is used. No signals are sent.
+
+    The ContentType of User is looked up once per process.
+    '''
+    def __init__(self, manager, user_field='content_object'):
+        NopSurgeon.__init__(self, manager, user_field=user_field)
+        model = manager.model
+        fields = [f for f in model._meta.virtual_fields if f.name == user_field]
+        if not fields or not hasattr(fields[0], 'fk_field'):
+            raise ImproperlyConfigured(
+                "Field '{0}' of model '{1}' is not a GenericForeignKey.".format(
+                    user_field, model.__name__)
+            )
+        self.ct_field = model._meta.get_field(fields[0].ct_field).attname
+        self.fk_field = fields[0].fk_field
+    
+    def content_type_id(self):
+        '''
+        Returns the primary key of the ContentType of User. ContentTypeManager
+        caches it for the lifetime of the process.
+        '''
+        from django.contrib.contenttypes.models import ContentType
+        return ContentType.objects.get_for_model(User).pk
+    
+    def queryset(self, donors):
+        return self.manager.filter(**{
+            self.ct_field: self.content_type_id(),
+            '{0}__in'.format(self.fk_field): [donor.pk for donor in donors],
+        })
+    
+    def merge(self, receiver, donor):
+        return self.merge_many(receiver, [donor])
+    
+    def merge_many(self, receiver, donors):
+        donors = [donor for donor in donors if donor.pk != receiver.pk]
+        if not donors:
+            return 0
+        return self.queryset(donors).update(**{self.fk_field: receiver.pk})
+    
+    def merge_recording(self, receiver, donor):
+        moved = []
+        if receiver.pk != donor.pk:
+            moved = update_returning(self.queryset([donor]),
+                                     **{self.fk_field: receiver.pk})
+        return len(moved), (self.manager.model, self.fk_field, moved)
+    
+    def update_statement(self, receiver, donors, using):
+        donors = [donor for donor in donors if donor.pk != receiver.pk]
+        if not donors:
+            return None
+        return update_sql(self.queryset(donors).using(using),
+                          **{self.fk_field: receiver.pk})
+    
+    def merge_chunk(self, receiver, donor, size):
+        if receiver.pk == donor.pk:
+            return 0
+        pks = list(self.queryset([donor]).order_by('pk').values_list(
+            'pk', flat=True)[:size])
+        if pks:
+            self.manager.filter(pk__in=pks).update(**{self.fk_field: receiver.pk})
+        return len(pks)
     
-    
\ No newline at end of file
+    def dry_run(self, receiver, donor):
+        queryset = self.queryset([donor])
+        return {
+            'strategy': 'single UPDATE of the object id',
+            'queryset': queryset,
+            'statements': [update_sql(queryset, **{self.fk_field: receiver.pk})],
+        }
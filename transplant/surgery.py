@@ -3,8 +3,11 @@ This module contains Surgery class.
 '''
 import importlib
 
+
 from django.core.exceptions import ImproperlyConfigured
 
+from utils import explain
+
 class Surgery:
     '''
     This class initializes proper Manager and Surgeon basing on given strings
@@ -53,4 +56,44 @@ class Surgery:
         return (modulepath, classname)
     
     def merge(self, receiver, donor):
-        self.surgeon.merge(receiver, donor)
\ No newline at end of file
+        return self.surgeon.merge(receiver, donor)
+    
+    def merge_recording(self, receiver, donor):
+        return self.surgeon.merge_recording(receiver, donor)
+    
+    def merge_many(self, receiver, donors):
+        return self.surgeon.merge_many(receiver, donors)
+    
+    def merge_mapping(self, mapping):
+        return self.surgeon.merge_mapping(mapping)
+    
+    def update_statement(self, receiver, donors, using):
+        return self.surgeon.update_statement(receiver, donors, using)
+    
+    def merge_chunk(self, receiver, donor, size):
+        return self.surgeon.merge_chunk(receiver, donor, size)
+    
+    def start_chunks(self, receiver, donor):
+        return self.surgeon.start_chunks(receiver, donor)
+    
+    def dry_run(self, receiver, donor):
+        '''
+        Returns a report of what merge() would do: the model and surgeon
+        names, the surgeon's strategy, the number of donor's rows to change,
+        statements that would be issued and the database's query plan of
+        the donor's rows lookup. Nothing is written to the database.
+        '''
+        description = self.surgeon.dry_run(receiver, donor)
+        queryset = description['queryset']
+        rows, plan = None, None
+        if queryset is not None:
+            rows = queryset.count()
+            plan = explain(queryset)
+        return {
+            'model': '{0}.{1}'.format(self.model.__module__, self.model.__name__),
+            'surgeon': self.surgeon.__class__.__name__,
+            'strategy': description['strategy'],
+            'rows': rows,
+            'statements': description['statements'],
+            'explain': plan,
+        }
@@ -1,12 +1,19 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.contrib.contenttypes.generic import GenericForeignKey
+from django.contrib.contenttypes.models import ContentType
 
 class OtherManager(models.Manager):
     pass
 
+class SavedManager(models.Manager):
+    def get_query_set(self):
+        return super(SavedManager, self).get_query_set().filter(was_saved=True)
+
 class TestModel(models.Model):
     objects = models.Manager()
     other_manager = OtherManager()
+    saved = SavedManager()
 
     user = models.ForeignKey(User)
     was_saved = models.BooleanField(default=False)
@@ -17,4 +24,37 @@ class TestModel(models.Model):
         
 
 class CustomUserFieldNameModel(models.Model):
-    person = models.ForeignKey(User)
\ No newline at end of file
+    person = models.ForeignKey(User)
+
+class Team(models.Model):
+    members = models.ManyToManyField(User, related_name='teams')
+    was_saved = models.BooleanField(default=False)
+    
+    objects = models.Manager()
+    saved = SavedManager()
+
+class Club(models.Model):
+    members = models.ManyToManyField(User, through='Membership', related_name='clubs')
+
+class Membership(models.Model):
+    club = models.ForeignKey(Club)
+    user = models.ForeignKey(User)
+    role = models.CharField(max_length=10)
+
+class Profile(models.Model):
+    user = models.OneToOneField(User)
+    bio = models.TextField(blank=True)
+    modified = models.IntegerField(null=True)
+
+class Rating(models.Model):
+    user = models.ForeignKey(User)
+    item = models.CharField(max_length=10)
+    score = models.IntegerField(default=0)
+    
+    class Meta:
+        unique_together = ('user', 'item')
+
+class Activity(models.Model):
+    content_type = models.ForeignKey(ContentType)
+    object_pk = models.TextField()
+    content_object = GenericForeignKey('content_type', 'object_pk')
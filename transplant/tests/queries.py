@@ -0,0 +1,69 @@
+from itertools import count
+
+from django.contrib.auth.models import User
+
+from ..instrumentation import QueryCounter
+
+class QueryCurveAssertions(object):
+    '''
+    Mixin for TestCase asserting how the number of queries issued by a merge
+    grows with the number of donor's rows.
+    '''
+    users = count()
+    
+    def queryCurve(self, sizes, populate, merge, statement=None, using='default'):
+        '''
+        For each size creates a receiver and a donor, calls
+        populate(receiver, donor, size) and then merge(receiver, donor).
+        Returns a list of (size, number of queries issued by merge). If
+        statement is given (e.g. 'SELECT') only queries starting with it are
+        counted.
+        '''
+        curve = []
+        for size in sizes:
+            number = next(self.users)
+            receiver = User.objects.create_user(
+                username='curve-receiver{0}'.format(number), password='r')
+            donor = User.objects.create_user(
+                username='curve-donor{0}'.format(number), password='d')
+            populate(receiver, donor, size)
+            with QueryCounter(using, keep_queries=True) as counter:
+                merge(receiver, donor)
+            queries = [sql for sql in counter.queries
+                       if statement is None or sql.upper().startswith(statement)]
+            curve.append((size, len(queries)))
+        return curve
+    
+    def assertQueryCurve(self, expected, sizes, populate, merge, **kwargs):
+        '''
+        Asserts that merge issues expected(size) queries for each size (see
+        queryCurve()).
+        '''
+        curve = self.queryCurve(sizes, populate, merge, **kwargs)
+        self.assertEquals(
+            [(size, expected(size)) for size in sizes], curve,
+            'Expected (rows, queries) curve {0}, got {1}.'.format(
+                [(size, expected(size)) for size in sizes], curve)
+        )
+    
+    def assertConstantQueries(self, sizes, populate, merge, **kwargs):
+        '''
+        Asserts that merge issues the same number of queries for each size.
+        '''
+        curve = self.queryCurve(sizes, populate, merge, **kwargs)
+        self.assertEquals(
+            1, len(set(count for _, count in curve)),
+            'Expected the same number of queries for each size, got {0}.'.format(curve)
+        )
+
+class ParamsCounter(QueryCounter):
+    '''
+    QueryCounter also recording the largest number of query parameters of
+    a single statement as max_params (SQLite builds differ in how many they
+    accept, so tests cannot rely on the database rejecting a statement).
+    '''
+    max_params = 0
+    
+    def executed(self, cursor, sql, params=None):
+        QueryCounter.executed(self, cursor, sql, params)
+        self.max_params = max(self.max_params, len(params or ()))
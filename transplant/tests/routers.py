@@ -0,0 +1,13 @@
+class OtherDatabaseRouter(object):
+    '''
+    Sends CustomUserFieldNameModel to the 'other' database.
+    '''
+    def db_for_read(self, model, **hints):
+        if model._meta.object_name == 'CustomUserFieldNameModel':
+            return 'other'
+        return None
+
+    db_for_write = db_for_read
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
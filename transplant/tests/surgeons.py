@@ -1,6 +1,37 @@
-from ..surgeons import NopSurgeon
+from django.db import DatabaseError
+
+from ..surgeons import NopSurgeon, BatchSurgeon
 
 class FaultySurgeon(NopSurgeon):
     
     def merge(self, receiver, donor):
         raise RuntimeError("Hello faulty surgeon!")
+
+class DeadlockingSurgeon(BatchSurgeon):
+    '''
+    Fails with a deadlock error on the first 'deadlocks' merges.
+    '''
+    def __init__(self, manager, deadlocks=1, **kwargs):
+        BatchSurgeon.__init__(self, manager, **kwargs)
+        self.deadlocks = deadlocks
+    
+    def merge(self, receiver, donor):
+        rows = BatchSurgeon.merge(self, receiver, donor)
+        if self.deadlocks:
+            self.deadlocks -= 1
+            raise DatabaseError('deadlock detected')
+        return rows
+
+class InterruptedSurgeon(BatchSurgeon):
+    '''
+    Moves 'chunks' chunks of objects, then fails.
+    '''
+    def __init__(self, manager, chunks=1, **kwargs):
+        BatchSurgeon.__init__(self, manager, **kwargs)
+        self.chunks = chunks
+    
+    def merge_chunk(self, receiver, donor, size):
+        if not self.chunks:
+            raise RuntimeError('Interrupted')
+        self.chunks -= 1
+        return BatchSurgeon.merge_chunk(self, receiver, donor, size)
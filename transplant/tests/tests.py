@@ -1,32 +1,125 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+from StringIO import StringIO
+
 from django.test import TestCase, TransactionTestCase
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.test.client import RequestFactory
+from django.db import router, DatabaseError
+from django.db.models.signals import post_save
+from django.test.client import Client, RequestFactory
+from django.http import Http404
 from django.core.exceptions import ImproperlyConfigured
-from mock import Mock
+from django.core.management import call_command
+from django.core.cache import cache
+from django.contrib.sessions.models import Session
+from mock import Mock, patch
+
+from django.contrib.auth import logout
+from django.contrib.auth.models import Group
+from django.contrib.contenttypes.models import ContentType
 
-from .models import TestModel, CustomUserFieldNameModel
-from ..surgeons import NopSurgeon, DefaultSurgeon, BatchSurgeon
+from .models import TestModel, CustomUserFieldNameModel, Team, Club, Membership
+from .models import Profile, Rating, Activity
+from .queries import ParamsCounter, QueryCurveAssertions
+from .routers import OtherDatabaseRouter
+from .surgeons import DeadlockingSurgeon
+from ..surgeons import NopSurgeon, DefaultSurgeon, BatchSurgeon, NotifyingBatchSurgeon
+from ..surgeons import ManyToManySurgeon, UniqueSurgeon, GenericForeignKeySurgeon
+from ..signals import post_batch_merge, merge_started, operation_started
+from ..signals import operation_finished, merge_committed, merge_rolled_back
 from ..surgery import Surgery
-from ..views import TransplantMergeView
+from ..plan import MergePlan, get_merge_plan, resolve_mapping
+from ..models import MergeJob, MergeCheckpoint, MergeJournal, UserSession
+from ..models import MergeRequest
+from ..guard import MergeFailed, start_merge, finish_merge
+from ..journal import unmerge
+from ..cleanup import revoke_sessions
+from ..discovery import discover_operations
+from ..utils import is_retryable, pack_pks, unpack_ranges, combined_sql
+from ..utils import SQLITE_MAX_PARAMS
+from ..jobs import enqueue_merge, run_job, run_next_job, merge_in_progress, resume_jobs
+from ..jobs import record_progress
+from ..views import TransplantMergeView, TransplantJobStatusView
+from ..forms import UserMergeForm
+from ..instrumentation import QueryCounter, LoggingAdapter, StatsdAdapter
+from ..conf import app_settings
+from ..checks import check_operations, validate_settings
 
 class AppPropertiesTest(TestCase):
     
     def testAppSettingsShouldBePresent(self):
-        try:
-            settings.TRANSPLANT_OPERATIONS
-        except AttributeError:
-            self.fail("No TRANSPLANT_OPERATIONS in settings")
-        
-        try:
-            settings.TRANSPLANT_SUCCESS_URL
-        except AttributeError:
-            self.fail("No TRANSPLANT_SUCCESS_URL")
-        
-        try:
-            settings.TRANSPLANT_FAILURE_URL
-        except AttributeError:
-            self.fail("No TRANSPLANT_FAILURE_URL")
+        for name in ('TRANSPLANT_OPERATIONS', 'TRANSPLANT_SUCCESS_URL',
+                     'TRANSPLANT_FAILURE_URL'):
+            try:
+                getattr(app_settings, name)
+            except AttributeError:
+                self.fail("No {0} in app settings".format(name))
+    
+    def testDefaultsShouldNotBeCopiedToSettings(self):
+        self.assertFalse(hasattr(settings, 'TRANSPLANT_ASYNC'))
+        self.assertFalse(app_settings.TRANSPLANT_ASYNC)
+        with self.assertRaises(AttributeError):
+            app_settings.TRANSPLANT_NO_SUCH_SETTING
+    
+    def testSettingsShouldBeResolvedLazilyAndInvalidated(self):
+        self.assertEquals(settings.LOGIN_REDIRECT_URL, app_settings.TRANSPLANT_SUCCESS_URL)
+        with self.settings(LOGIN_REDIRECT_URL='/home/'):
+            self.assertEquals('/home/', app_settings.TRANSPLANT_SUCCESS_URL)
+            with self.settings(TRANSPLANT_SUCCESS_URL='/merged/'):
+                self.assertEquals('/merged/', app_settings.TRANSPLANT_SUCCESS_URL)
+                self.assertEquals('/merged/', TransplantMergeView().get_success_url())
+        self.assertEquals(settings.LOGIN_REDIRECT_URL, app_settings.TRANSPLANT_SUCCESS_URL)
+
+class SettingsValidationTest(TestCase):
+    
+    def testValidOperationsShouldPass(self):
+        self.assertEquals([], check_operations((
+            ('transplant.tests.models.TestModel', 'transplant.surgeons.BatchSurgeon', {}),
+            ('transplant.tests.models.Team', 'transplant.surgeons.ManyToManySurgeon',
+                {'user_field': 'members'}),
+            ('transplant.tests.models.Profile', 'transplant.tests.surgeons.FaultySurgeon',
+                {'user_field': 'nothing'}),
+        )))
+    
+    def testInvalidOperationsShouldBeReported(self):
+        errors = check_operations((
+            ('transplant.tests.models.NoModel', 'transplant.surgeons.BatchSurgeon', {}),
+            ('transplant.tests.models.TestModel', 'transplant.surgeons.NoSurgeon', {}),
+            ('transplant.tests.models.TestModel', 'transplant.surgeons.BatchSurgeon',
+                {'manager': 'nothing'}),
+            ('transplant.tests.models.TestModel', 'transplant.surgeons.BatchSurgeon',
+                {'user_field': 'nothing'}),
+            ('transplant.tests.models.Profile', 'transplant.surgeons.DefaultSurgeon',
+                {'user_field': 'bio'}),
+            ('transplant.tests.models.TestModel', 'transplant.surgeons.BatchSurgeon',
+                {'no_such_option': 1}),
+            ('transplant.tests.models.TestModel', 'transplant.surgeons.BatchSurgeon', {}),
+        ))
+        self.assertEquals(6, len(errors))
+        self.assertTrue(errors[0].startswith('TRANSPLANT_OPERATIONS[0]: '))
+        self.assertEquals("TRANSPLANT_OPERATIONS[3]: Model 'TestModel' has no field 'nothing'.",
+                          errors[3])
+        self.assertEquals("TRANSPLANT_OPERATIONS[4]: Field 'bio' of model 'Profile' is "
+                          "not a ForeignKey to User.", errors[4])
+    
+    def testCommandShouldFailOnInvalidSettings(self):
+        with self.settings(TRANSPLANT_OPERATIONS=(
+            ('transplant.tests.models.TestModel', 'transplant.surgeons.BatchSurgeon',
+                {'user_field': 'nothing'}),
+        )):
+            with self.assertRaises(ImproperlyConfigured):
+                validate_settings()
+            stderr = StringIO()
+            with self.assertRaises(SystemExit):
+                call_command('transplant_check', stderr=stderr)
+            self.assertTrue('nothing' in stderr.getvalue())
+        stdout = StringIO()
+        call_command('transplant_check', stdout=stdout)
+        self.assertEquals('Transplant settings are valid.\n', stdout.getvalue())
 
 class NopSurgeonTest(TestCase):
     
@@ -71,11 +164,10 @@ class DefaultSurgeonTest(TestCase):
             password = 'd'
         )
     
-    def testMergeShouldSetDonorInactive(self):
+    def testMergeShouldNotDeactivateDonor(self):
         s = DefaultSurgeon(TestModel.objects)
         s.merge(self.receiver, self.donor)
-        self.assertTrue(self.receiver.is_active)
-        self.assertFalse(self.donor.is_active)
+        self.assertTrue(User.objects.get(pk=self.donor.pk).is_active)
     
     def testMergeShouldSetUserOnAllObjectsFromManagerToReceiver(self):
         for i in range(0,10):
@@ -119,6 +211,96 @@ class DefaultSurgeonTest(TestCase):
         for m in TestModel.objects.all():
             self.assertTrue(m.was_saved)
 
+    def testChunkedMergeShouldSetUserOnAllObjectsFromManagerToReceiver(self):
+        stranger = User.objects.create_user(username='s', password='p')
+        for i in range(0,10):
+            TestModel(user=self.donor).save()
+            TestModel(user=stranger).save()
+        s = DefaultSurgeon(TestModel.objects, chunk_size=3)
+        s.merge(self.receiver, self.donor)
+        self.assertEquals(10, TestModel.objects.filter(user=self.receiver).count())
+        self.assertEquals(10, TestModel.objects.filter(user=stranger).count())
+    
+    def testChunkedMergeShouldCallSaveOnEachMatchingObjectInManager(self):
+        for _ in range(0,10):
+            TestModel(user=self.donor).save()
+        s = DefaultSurgeon(TestModel.objects, chunk_size=4)
+        s.merge(self.receiver, self.donor)
+        for m in TestModel.objects.all():
+            self.assertTrue(m.was_saved)
+    
+    def testChunkedMergeShouldFetchOneChunkPerQuery(self):
+        for _ in range(0,10):
+            CustomUserFieldNameModel(person=self.donor).save()
+        s = DefaultSurgeon(CustomUserFieldNameModel.objects, user_field='person')
+        chunked = DefaultSurgeon(
+            CustomUserFieldNameModel.objects, user_field='person', chunk_size=5
+        )
+        # each save() takes two queries, chunks of 5, 5 and 0 objects
+        with self.assertNumQueries(1 + 2 * 10):
+            s.merge(self.receiver, self.donor)
+        with self.assertNumQueries(3 + 2 * 10):
+            chunked.merge(self.donor, self.receiver)
+    
+    def testChunkSizeShouldBePassedFromSurgery(self):
+        surgery = Surgery(
+            'transplant.tests.models.TestModel',
+            'transplant.surgeons.DefaultSurgeon',
+            **{'chunk_size': 100}
+        )
+        self.assertEquals(100, surgery.surgeon.chunk_size)
+
+    def testNarrowMergeShouldSetUserOnAllObjectsFromManagerToReceiver(self):
+        stranger = User.objects.create_user(username='s', password='p')
+        for i in range(0,10):
+            u = self.receiver if i % 2 == 0 else self.donor
+            TestModel(user=u).save()
+            TestModel(user=stranger).save()
+        s = DefaultSurgeon(TestModel.objects, narrow=True, chunk_size=2)
+        s.merge(self.receiver, self.donor)
+        self.assertEquals(10, TestModel.objects.filter(user=self.receiver).count())
+        self.assertEquals(10, TestModel.objects.filter(user=stranger).count())
+    
+    def testNarrowMergeShouldOnlyWriteUserField(self):
+        for _ in range(0,10):
+            TestModel(user=self.donor).save()
+        s = DefaultSurgeon(TestModel.objects, narrow=True)
+        s.merge(self.receiver, self.donor)
+        for m in TestModel.objects.all():
+            self.assertEquals(self.receiver, m.user)
+            self.assertFalse(m.was_saved)
+    
+    def testNarrowMergeShouldIssueOneUpdatePerObject(self):
+        for _ in range(0,10):
+            CustomUserFieldNameModel(person=self.donor).save()
+        s = DefaultSurgeon(
+            CustomUserFieldNameModel.objects, user_field='person', narrow=True
+        )
+        with self.assertNumQueries(1 + 10):
+            s.merge(self.receiver, self.donor)
+    
+    def testNarrowMergeShouldSendSignalsForEachObject(self):
+        for _ in range(0,10):
+            TestModel(user=self.donor).save()
+        saved = []
+        def on_save(sender, instance, **kwargs):
+            saved.append((instance.pk, instance.was_saved, instance.user))
+        post_save.connect(on_save, sender=TestModel)
+        try:
+            s = DefaultSurgeon(
+                TestModel.objects, narrow=True, signal_fields=('was_saved',)
+            )
+            with self.assertNumQueries(1 + 10):
+                s.merge(self.receiver, self.donor)
+        finally:
+            post_save.disconnect(on_save, sender=TestModel)
+        self.assertEquals(
+            sorted(TestModel.objects.values_list('pk', flat=True)),
+            sorted(pk for pk, _, _ in saved)
+        )
+        for _, _, user in saved:
+            self.assertEquals(self.receiver, user)
+
 class BatchSurgeonTest(TestCase):
     
     def setUp(self):
@@ -144,11 +326,10 @@ class BatchSurgeonTest(TestCase):
         for m in TestModel.objects.all():
             self.assertFalse(m.was_saved)
     
-    def testMergeShouldSetDonorInactive(self):
-        s = DefaultSurgeon(TestModel.objects)
+    def testMergeShouldNotDeactivateDonor(self):
+        s = BatchSurgeon(TestModel.objects)
         s.merge(self.receiver, self.donor)
-        self.assertTrue(self.receiver.is_active)
-        self.assertFalse(self.donor.is_active)
+        self.assertTrue(User.objects.get(pk=self.donor.pk).is_active)
     
     def testMergeShouldSetUserOnAllObjectsFromManagerToReceiver(self):
         for i in range(0,10):
@@ -168,6 +349,285 @@ class BatchSurgeonTest(TestCase):
         for testmodel in CustomUserFieldNameModel.objects.all():
             self.assertEquals(self.receiver, testmodel.person)
 
+class NotifyingBatchSurgeonTest(TestCase):
+    
+    def setUp(self):
+        self.receiver = User.objects.create_user(
+            username = 'receiver',
+            password = 'r'
+        )
+        self.donor = User.objects.create_user(
+            username = 'donor',
+            password = 'd'
+        )
+        self.batches = []
+        post_batch_merge.connect(self.on_batch_merge)
+    
+    def tearDown(self):
+        post_batch_merge.disconnect(self.on_batch_merge)
+    
+    def on_batch_merge(self, sender, **kwargs):
+        self.batches.append((sender, kwargs))
+    
+    def testMergeShouldSetUserOnAllObjectsFromManagerToReceiver(self):
+        for i in range(0,10):
+            u = self.receiver if i % 2 == 0 else self.donor
+            CustomUserFieldNameModel(person=u).save()
+        s = NotifyingBatchSurgeon(CustomUserFieldNameModel.objects, user_field='person')
+        s.merge(self.receiver, self.donor)
+        for testmodel in CustomUserFieldNameModel.objects.all():
+            self.assertEquals(self.receiver, testmodel.person)
+    
+    def testMergeShoulNotCallSaveOnEachMatchingObjectInManager(self):
+        for _ in range(0,10):
+            TestModel(user=self.donor).save()
+        s = NotifyingBatchSurgeon(TestModel.objects)
+        s.merge(self.receiver, self.donor)
+        for m in TestModel.objects.all():
+            self.assertFalse(m.was_saved)
+    
+    def testMergeShouldSendOneSignalWithAllMovedPks(self):
+        moved = [TestModel.objects.create(user=self.donor).pk for _ in range(0,10)]
+        TestModel.objects.create(user=self.receiver)
+        s = NotifyingBatchSurgeon(TestModel.objects)
+        with self.assertNumQueries(2):
+            s.merge(self.receiver, self.donor)
+        self.assertEquals(1, len(self.batches))
+        sender, kwargs = self.batches[0]
+        self.assertEquals(TestModel, sender)
+        self.assertEquals(self.receiver, kwargs['receiver'])
+        self.assertEquals(self.donor, kwargs['donor'])
+        self.assertEquals(sorted(moved), sorted(kwargs['pks']))
+    
+    def testMergeShouldNotSendSignalIfNothingWasMoved(self):
+        s = NotifyingBatchSurgeon(TestModel.objects)
+        s.merge(self.receiver, self.donor)
+        self.assertEquals([], self.batches)
+
+class ManyToManySurgeonTest(TestCase):
+    
+    def setUp(self):
+        self.receiver = User.objects.create_user(username='receiver', password='r')
+        self.donor = User.objects.create_user(username='donor', password='d')
+        self.teams = [Team.objects.create() for _ in range(0, 3)]
+        self.teams[0].members.add(self.receiver)
+        self.teams[1].members.add(self.receiver, self.donor)
+        self.teams[2].members.add(self.donor)
+    
+    def testMergeShouldMoveRelationsWithoutDuplicates(self):
+        s = ManyToManySurgeon(Team.objects, user_field='members')
+        with self.assertNumQueries(2):
+            s.merge(self.receiver, self.donor)
+        self.assertEquals(self.teams, list(self.receiver.teams.order_by('pk')))
+        self.assertEquals([], list(self.donor.teams.all()))
+        self.assertEquals(3, Team.members.through.objects.count())
+    
+    def testMergeShouldIssueSameNumberOfStatementsForAnyNumberOfRows(self):
+        for _ in range(0, 20):
+            Team.objects.create().members.add(self.donor, self.receiver)
+        s = ManyToManySurgeon(Team.objects, user_field='members')
+        with self.assertNumQueries(2):
+            s.merge(self.receiver, self.donor)
+        self.assertEquals(23, self.receiver.teams.count())
+    
+    def testMergeShouldOnlyMoveRelationsOfObjectsFromManager(self):
+        Team.objects.filter(pk=self.teams[2].pk).update(was_saved=True)
+        extra = Team.objects.create()
+        extra.members.add(self.donor)
+        s = ManyToManySurgeon(Team.saved, user_field='members')
+        s.merge(self.receiver, self.donor)
+        self.assertEquals(self.teams, list(self.receiver.teams.order_by('pk')))
+        self.assertEquals([self.teams[1], extra], list(self.donor.teams.order_by('pk')))
+    
+    def testMergeShouldKeepExtraColumnsOfThroughModel(self):
+        clubs = [Club.objects.create() for _ in range(0, 2)]
+        Membership.objects.create(club=clubs[0], user=self.receiver, role='member')
+        Membership.objects.create(club=clubs[0], user=self.donor, role='owner')
+        Membership.objects.create(club=clubs[1], user=self.donor, role='owner')
+        s = ManyToManySurgeon(Club.objects, user_field='members')
+        s.merge(self.receiver, self.donor)
+        self.assertEquals(
+            [(clubs[0].pk, 'member'), (clubs[1].pk, 'owner')],
+            list(Membership.objects.filter(user=self.receiver).order_by('club').values_list(
+                'club', 'role'
+            ))
+        )
+        self.assertEquals(0, Membership.objects.filter(user=self.donor).count())
+    
+    def testMergeShouldWorkForFieldsDefinedOnUser(self):
+        groups = [Group.objects.create(name='g{0}'.format(i)) for i in range(0, 3)]
+        self.receiver.groups.add(groups[0], groups[1])
+        self.donor.groups.add(groups[1], groups[2])
+        s = ManyToManySurgeon(User.objects, user_field='groups')
+        s.merge(self.receiver, self.donor)
+        self.assertEquals(groups, list(self.receiver.groups.order_by('pk')))
+        self.assertEquals([], list(self.donor.groups.all()))
+    
+    def testImproperlyConfiguredShouldBeRaisedForOtherFields(self):
+        with self.assertRaises(ImproperlyConfigured):
+            ManyToManySurgeon(TestModel.objects, user_field='user')
+        with self.assertRaises(ImproperlyConfigured):
+            ManyToManySurgeon(Group.objects, user_field='permissions')
+    
+    def testSameAccountMergeShouldNotChangeAnything(self):
+        s = ManyToManySurgeon(Team.objects, user_field='members')
+        s.merge(self.receiver, self.receiver)
+        self.assertEquals(2, self.receiver.teams.count())
+
+class UniqueSurgeonTest(TestCase):
+    
+    def setUp(self):
+        self.receiver = User.objects.create_user(username='receiver', password='r')
+        self.donor = User.objects.create_user(username='donor', password='d')
+        self.stranger = User.objects.create_user(username='stranger', password='s')
+        for user, items in [
+                (self.receiver, 'abc'), (self.donor, 'cde'), (self.stranger, 'ae')]:
+            for score, item in enumerate(items):
+                Rating.objects.create(user=user, item=item, score=score)
+    
+    def ratings(self, user):
+        return list(Rating.objects.filter(user=user).order_by('item').values_list(
+            'item', 'score'
+        ))
+    
+    def testKeepReceiverShouldDeleteConflictingObjectsOfDonor(self):
+        s = UniqueSurgeon(Rating.objects)
+        s.merge(self.receiver, self.donor)
+        self.assertEquals(
+            [('a', 0), ('b', 1), ('c', 2), ('d', 1), ('e', 2)], self.ratings(self.receiver)
+        )
+        self.assertEquals([], self.ratings(self.donor))
+        self.assertEquals([('a', 0), ('e', 1)], self.ratings(self.stranger))
+    
+    def testKeepDonorShouldDeleteConflictingObjectsOfReceiver(self):
+        s = UniqueSurgeon(Rating.objects, policy='keep_donor')
+        s.merge(self.receiver, self.donor)
+        self.assertEquals(
+            [('a', 0), ('b', 1), ('c', 0), ('d', 1), ('e', 2)], self.ratings(self.receiver)
+        )
+    
+    def testNewestShouldKeepObjectWithGreaterNewestField(self):
+        Profile.objects.create(user=self.receiver, bio='receiver', modified=10)
+        Profile.objects.create(user=self.donor, bio='donor', modified=20)
+        s = UniqueSurgeon(Profile.objects, policy='newest', newest_field='modified')
+        s.merge(self.receiver, self.donor)
+        self.assertEquals('donor', Profile.objects.get(user=self.receiver).bio)
+        self.assertEquals(1, Profile.objects.count())
+    
+    def testCallablePolicyShouldChooseObjectToKeep(self):
+        def higher_score(receivers, donors):
+            return donors if donors.score > receivers.score else receivers
+        s = UniqueSurgeon(Rating.objects, policy=higher_score)
+        s.merge(self.receiver, self.donor)
+        self.assertEquals(
+            [('a', 0), ('b', 1), ('c', 2), ('d', 1), ('e', 2)], self.ratings(self.receiver)
+        )
+        Rating.objects.filter(user=self.stranger, item='e').update(score=5)
+        s.merge(self.stranger, self.receiver)
+        self.assertEquals(
+            [('a', 0), ('b', 1), ('c', 2), ('d', 1), ('e', 5)], self.ratings(self.stranger)
+        )
+    
+    def testMergeShouldUseBoundedNumberOfQueries(self):
+        for i in range(0, 20):
+            Rating.objects.create(user=self.receiver, item='r{0}'.format(i))
+            Rating.objects.create(user=self.donor, item='r{0}'.format(i))
+        s = UniqueSurgeon(Rating.objects)
+        # conflicts, delete (collect and delete) and update
+        with self.assertNumQueries(4):
+            s.merge(self.receiver, self.donor)
+        self.assertEquals(25, Rating.objects.filter(user=self.receiver).count())
+    
+    def testConflictsShouldBeResolvedOnceInJournaledMerge(self):
+        job = enqueue_merge(self.receiver, self.donor, journaled=True)
+        job.claim()
+        plan = MergePlan((
+            ('transplant.tests.models.Rating', 'transplant.surgeons.UniqueSurgeon', {}),
+        ))
+        surgeon = plan.surgeries[0].surgeon
+        surgeon.conflicts = Mock(wraps=surgeon.conflicts)
+        plan.merge_journaled(job, chunk_size=1)
+        self.assertEquals(1, surgeon.conflicts.call_count)
+        self.assertEquals(
+            [('a', 0), ('b', 1), ('c', 2), ('d', 1), ('e', 2)], self.ratings(self.receiver)
+        )
+        self.assertEquals((3, 2), MergeCheckpoint.objects.values_list(
+            'chunks', 'rows').get())
+    
+    def testOneToOneWithoutConflictShouldBeMoved(self):
+        Profile.objects.create(user=self.donor, bio='donor')
+        s = UniqueSurgeon(Profile.objects)
+        with self.assertNumQueries(2):
+            s.merge(self.receiver, self.donor)
+        self.assertEquals('donor', Profile.objects.get(user=self.receiver).bio)
+    
+    def testImproperlyConfiguredShouldBeRaisedForNonUniqueFields(self):
+        with self.assertRaises(ImproperlyConfigured):
+            UniqueSurgeon(TestModel.objects)
+        with self.assertRaises(ImproperlyConfigured):
+            UniqueSurgeon(Rating.objects, policy='whatever')
+    
+    def testMergeManyShouldResolveConflictsBetweenDonors(self):
+        s = UniqueSurgeon(Rating.objects)
+        s.merge_many(self.receiver, [self.donor, self.stranger])
+        self.assertEquals(
+            [('a', 0), ('b', 1), ('c', 2), ('d', 1), ('e', 2)], self.ratings(self.receiver)
+        )
+        self.assertEquals(5, Rating.objects.count())
+
+class GenericForeignKeySurgeonTest(TestCase):
+    
+    def setUp(self):
+        self.receiver = User.objects.create_user(username='receiver', password='r')
+        self.donor = User.objects.create_user(username='donor', password='d')
+        self.group = Group.objects.create(name='group')
+        for _ in range(0, 3):
+            Activity.objects.create(content_object=self.donor)
+        Activity.objects.create(content_object=self.receiver)
+        # an object of another model sharing donor's primary key
+        Activity.objects.create(content_type=ContentType.objects.get_for_model(Group),
+                                object_pk=str(self.donor.pk))
+    
+    def owners(self, user):
+        return Activity.objects.filter(
+            content_type=ContentType.objects.get_for_model(User),
+            object_pk=str(user.pk)).count()
+    
+    def testMergeShouldMoveObjectsWithSingleUpdate(self):
+        s = GenericForeignKeySurgeon(Activity.objects)
+        s.content_type_id()
+        with self.assertNumQueries(1):
+            self.assertEquals(3, s.merge(self.receiver, self.donor))
+        self.assertEquals(4, self.owners(self.receiver))
+        self.assertEquals(0, self.owners(self.donor))
+        self.assertEquals(1, Activity.objects.filter(object_pk=str(self.donor.pk)).count())
+    
+    def testMergeManyShouldMoveObjectsOfAllDonors(self):
+        other = User.objects.create_user(username='other', password='o')
+        Activity.objects.create(content_object=other)
+        s = GenericForeignKeySurgeon(Activity.objects)
+        self.assertEquals(4, s.merge_many(self.receiver, [self.donor, other, self.receiver]))
+        self.assertEquals(5, self.owners(self.receiver))
+    
+    def testContentTypeShouldBeCached(self):
+        s = GenericForeignKeySurgeon(Activity.objects)
+        s.merge(self.receiver, self.donor)
+        with self.assertNumQueries(1):
+            s.merge(self.donor, self.receiver)
+    
+    def testMergeShouldBeRecordedAndChunked(self):
+        s = GenericForeignKeySurgeon(Activity.objects)
+        self.assertEquals(2, s.merge_chunk(self.receiver, self.donor, 2))
+        rows, (model, field, pks) = s.merge_recording(self.receiver, self.donor)
+        self.assertEquals((1, Activity, 'object_pk'), (rows, model, field))
+        self.assertEquals(4, self.owners(self.receiver))
+    
+    def testImproperlyConfiguredShouldBeRaisedForOtherFields(self):
+        with self.assertRaises(ImproperlyConfigured):
+            GenericForeignKeySurgeon(Activity.objects, user_field='content_type')
+        with self.assertRaises(ImproperlyConfigured):
+            GenericForeignKeySurgeon(TestModel.objects)
+
 class SurgeryTest(TestCase):
 
     def testSplitPathShouldReturnTupleWithModuleAndClassname(self):
@@ -238,6 +698,1254 @@ class SurgeryTest(TestCase):
         surgery.merge(receiver, donor)
         surgery.surgeon.merge.assert_called_with(receiver, donor)
 
+class MergePlanTest(TestCase):
+    
+    def setUp(self):
+        self.receiver = User.objects.create_user(username='receiver', password='p')
+        self.donor = User.objects.create_user(username='donor', password='p')
+    
+    def testPlanShouldBuildSurgeryForEachOperation(self):
+        plan = MergePlan((
+            ('transplant.tests.models.TestModel', 'transplant.surgeons.DefaultSurgeon', {}),
+            (
+                'transplant.tests.models.CustomUserFieldNameModel',
+                'transplant.surgeons.BatchSurgeon',
+                {'user_field': 'person'}
+            ),
+        ))
+        self.assertEquals(2, len(plan))
+        self.assertEquals(
+            ['DefaultSurgeon', 'BatchSurgeon'],
+            [s.surgeon.__class__.__name__ for s in plan]
+        )
+    
+    def testImproperlyConfiguredShouldBeRaisedWhenPlanIsBuilt(self):
+        with self.assertRaises(ImproperlyConfigured):
+            MergePlan((
+                ('non.existing.Model', 'transplant.surgeons.NopSurgeon', {}),
+            ))
+    
+    def testPlanShouldNotModifyOperationKwargs(self):
+        kwargs = {'manager': 'other_manager'}
+        MergePlan((
+            ('transplant.tests.models.TestModel', 'transplant.surgeons.NopSurgeon', kwargs),
+        ))
+        self.assertEquals({'manager': 'other_manager'}, kwargs)
+    
+    def testMergeShouldCallMergeOnEachSurgery(self):
+        plan = MergePlan((
+            ('transplant.tests.models.TestModel', 'transplant.surgeons.NopSurgeon', {}),
+            ('transplant.tests.models.TestModel', 'transplant.surgeons.NopSurgeon', {}),
+        ))
+        for surgery in plan:
+            surgery.surgeon = Mock(surgery.surgeon)
+        plan.merge(self.receiver, self.donor)
+        for surgery in plan:
+            surgery.surgeon.merge.assert_called_with(self.receiver, self.donor)
+    
+    def testMergeShouldDeactivateDonorOnce(self):
+        plan = MergePlan((
+            ('transplant.tests.models.TestModel', 'transplant.surgeons.DefaultSurgeon', {}),
+            ('transplant.tests.models.TestModel', 'transplant.surgeons.BatchSurgeon', {}),
+        ))
+        saved = []
+        def on_save(sender, instance, **kwargs):
+            saved.append(instance)
+        post_save.connect(on_save, sender=User)
+        try:
+            plan.merge(self.receiver, self.donor)
+        finally:
+            post_save.disconnect(on_save, sender=User)
+        self.assertEquals([self.donor], saved)
+        self.assertTrue(self.receiver.is_active)
+        self.assertFalse(self.donor.is_active)
+        self.assertFalse(User.objects.get(pk=self.donor.pk).is_active)
+    
+    def testMergeShouldOnlyWriteIsActiveOfDonor(self):
+        plan = MergePlan(())
+        self.donor.username = 'changed'
+        plan.merge(self.receiver, self.donor)
+        donor = User.objects.get(pk=self.donor.pk)
+        self.assertEquals('donor', donor.username)
+        self.assertFalse(donor.is_active)
+    
+    def testSameAccountMergeDoesNotDeactivateTheUser(self):
+        plan = MergePlan(())
+        plan.merge(self.receiver, User.objects.get(pk=self.receiver.pk))
+        self.assertTrue(User.objects.get(pk=self.receiver.pk).is_active)
+    
+    def testGetMergePlanShouldBeCached(self):
+        with self.settings(TRANSPLANT_OPERATIONS = (
+            ('transplant.tests.models.TestModel', 'transplant.surgeons.NopSurgeon', {}),
+        )):
+            self.assertTrue(get_merge_plan() is get_merge_plan())
+    
+    def testGetMergePlanShouldBeRebuiltWhenSettingsChange(self):
+        with self.settings(TRANSPLANT_OPERATIONS = (
+            ('transplant.tests.models.TestModel', 'transplant.surgeons.NopSurgeon', {}),
+        )):
+            plan = get_merge_plan()
+            self.assertEquals(1, len(plan))
+        with self.settings(TRANSPLANT_OPERATIONS = ()):
+            self.assertFalse(plan is get_merge_plan())
+            self.assertEquals(0, len(get_merge_plan()))
+
+class MultiDonorMergeTest(TestCase):
+    
+    def setUp(self):
+        self.receiver = User.objects.create_user(username='receiver', password='p')
+        self.donors = [
+            User.objects.create_user(username='donor{0}'.format(i), password='p')
+            for i in range(0, 3)
+        ]
+        self.stranger = User.objects.create_user(username='stranger', password='p')
+        for user in [self.receiver, self.stranger] + self.donors:
+            for _ in range(0, 3):
+                TestModel(user=user).save()
+                CustomUserFieldNameModel(person=user).save()
+    
+    def assertMerged(self):
+        self.assertEquals(12, TestModel.objects.filter(user=self.receiver).count())
+        self.assertEquals(3, TestModel.objects.filter(user=self.stranger).count())
+    
+    def testDefaultSurgeonShouldMergeAllDonorsInOneScan(self):
+        s = DefaultSurgeon(
+            CustomUserFieldNameModel.objects, user_field='person', narrow=True
+        )
+        with self.assertNumQueries(1 + 9):
+            s.merge_many(self.receiver, self.donors)
+        self.assertEquals(12, CustomUserFieldNameModel.objects.filter(person=self.receiver).count())
+    
+    def testBatchSurgeonShouldMergeAllDonorsInOneUpdate(self):
+        s = BatchSurgeon(TestModel.objects)
+        with self.assertNumQueries(1):
+            s.merge_many(self.receiver, self.donors)
+        self.assertMerged()
+    
+    def testNotifyingBatchSurgeonShouldSendSignalForEachDonor(self):
+        batches = {}
+        def on_batch_merge(sender, donor, pks, **kwargs):
+            batches[donor] = sorted(pks)
+        post_batch_merge.connect(on_batch_merge)
+        try:
+            s = NotifyingBatchSurgeon(TestModel.objects)
+            with self.assertNumQueries(2):
+                s.merge_many(self.receiver, self.donors)
+        finally:
+            post_batch_merge.disconnect(on_batch_merge)
+        self.assertMerged()
+        self.assertEquals(self.donors, sorted(batches.keys(), key=lambda u: u.pk))
+        for donor in self.donors:
+            self.assertEquals(3, len(batches[donor]))
+    
+    def testBatchSurgeonsShouldSkipRefetchedReceiverAmongDonors(self):
+        donors = self.donors + [User.objects.get(pk=self.receiver.pk)]
+        self.assertEquals(9, BatchSurgeon(TestModel.objects).merge_many(self.receiver, donors))
+        batches = []
+        def on_batch_merge(sender, donor, pks, **kwargs):
+            batches.append(donor.pk)
+        post_batch_merge.connect(on_batch_merge)
+        try:
+            s = NotifyingBatchSurgeon(CustomUserFieldNameModel.objects, user_field='person')
+            self.assertEquals(9, s.merge_many(self.receiver, donors))
+        finally:
+            post_batch_merge.disconnect(on_batch_merge)
+        self.assertEquals([donor.pk for donor in self.donors], sorted(batches))
+        self.assertMerged()
+    
+    def testNopSurgeonShouldMergeEachDonor(self):
+        s = NopSurgeon(TestModel.objects)
+        s.merge = Mock(return_value=2)
+        rows = s.merge_many(self.receiver, self.donors)
+        self.assertEquals(2 * len(self.donors), rows)
+        self.assertEquals(
+            [((self.receiver, donor), {}) for donor in self.donors],
+            s.merge.call_args_list
+        )
+    
+    def testPlanShouldMergeAllDonorsAndDeactivateThemInOneStatement(self):
+        plan = MergePlan((
+            ('transplant.tests.models.TestModel', 'transplant.surgeons.BatchSurgeon', {}),
+            (
+                'transplant.tests.models.CustomUserFieldNameModel',
+                'transplant.surgeons.BatchSurgeon',
+                {'user_field': 'person'}
+            ),
+        ))
+        with self.assertNumQueries(3):
+            plan.merge_many(self.receiver, self.donors)
+        self.assertMerged()
+        self.assertEquals(
+            ['receiver', 'stranger'],
+            sorted(User.objects.filter(is_active=True).values_list('username', flat=True))
+        )
+        for donor in self.donors:
+            self.assertFalse(donor.is_active)
+    
+    def testPlanShouldSkipReceiverAmongDonors(self):
+        plan = MergePlan((
+            ('transplant.tests.models.TestModel', 'transplant.surgeons.BatchSurgeon', {}),
+        ))
+        plan.merge_many(self.receiver, self.donors + [self.receiver])
+        self.assertMerged()
+        self.assertTrue(User.objects.get(pk=self.receiver.pk).is_active)
+
+class MappingMergeTest(TestCase):
+    
+    def setUp(self):
+        self.users = [
+            User.objects.create_user(username='user{0}'.format(i), password='p')
+            for i in range(0, 6)
+        ]
+        for user in self.users:
+            for _ in range(0, 2):
+                TestModel(user=user).save()
+                CustomUserFieldNameModel(person=user).save()
+        u = self.users
+        self.mapping = {u[1]: u[0], u[2]: u[0], u[4]: u[3]}
+    
+    def owners(self, model=TestModel, field='user'):
+        return [
+            getattr(m, field).username for m in model.objects.order_by('pk')
+        ]
+    
+    def assertMerged(self, model=TestModel, field='user'):
+        self.assertEquals(
+            ['user0'] * 6 + ['user3'] * 4 + ['user5'] * 2,
+            self.owners(model, field)
+        )
+    
+    def testBatchSurgeonShouldMergeMappingWithSingleUpdate(self):
+        s = BatchSurgeon(TestModel.objects)
+        with self.assertNumQueries(1):
+            s.merge_mapping(self.mapping)
+        self.assertMerged()
+    
+    def testBatchSurgeonShouldSplitMappingIntoChunks(self):
+        s = BatchSurgeon(CustomUserFieldNameModel.objects, user_field='person')
+        s.mapping_chunk_size = 2
+        with self.assertNumQueries(2):
+            s.merge_mapping(self.mapping)
+        self.assertMerged(CustomUserFieldNameModel, 'person')
+    
+    def testBatchSurgeonShouldOnlyMergeObjectsFromManager(self):
+        TestModel.objects.filter(pk__in=TestModel.objects.order_by('pk')[:4]).update(
+            was_saved=True
+        )
+        s = BatchSurgeon(TestModel.saved)
+        s.merge_mapping(self.mapping)
+        self.assertEquals(
+            ['user0', 'user0', 'user0', 'user0', 'user2', 'user2'],
+            self.owners()[:6]
+        )
+    
+    def testDefaultSurgeonShouldMergeMappingInOneScan(self):
+        s = DefaultSurgeon(TestModel.objects)
+        with self.assertNumQueries(1 + 2 * 6):
+            s.merge_mapping(self.mapping)
+        self.assertMerged()
+    
+    def testNotifyingBatchSurgeonShouldSendSignalForEachPair(self):
+        batches = []
+        def on_batch_merge(sender, receiver, donor, pks, **kwargs):
+            batches.append((receiver.username, donor.username, len(pks)))
+        post_batch_merge.connect(on_batch_merge)
+        try:
+            s = NotifyingBatchSurgeon(TestModel.objects)
+            with self.assertNumQueries(2):
+                s.merge_mapping(self.mapping)
+        finally:
+            post_batch_merge.disconnect(on_batch_merge)
+        self.assertMerged()
+        self.assertEquals(
+            [('user0', 'user1', 2), ('user0', 'user2', 2), ('user3', 'user4', 2)],
+            sorted(batches)
+        )
+    
+    def large_mapping(self, count=1100):
+        '''
+        Maps count new donors, each with a saved TestModel, to user0: more
+        donors than SQLite allows query parameters in a single statement.
+        '''
+        for start in range(0, count, 100):
+            User.objects.bulk_create([
+                User(username='donor{0}'.format(i))
+                for i in range(start, min(start + 100, count))
+            ])
+        donors = list(User.objects.filter(username__startswith='donor'))
+        for start in range(0, count, 100):
+            TestModel.objects.bulk_create([
+                TestModel(user=donor, was_saved=True)
+                for donor in donors[start:start + 100]
+            ])
+        return dict((donor, self.users[0]) for donor in donors)
+    
+    def mergeLargeMapping(self, merge_mapping):
+        '''
+        Calls merge_mapping with a large mapping, asserting that no statement
+        exceeds the limit of query parameters of SQLite. Returns its result.
+        '''
+        mapping = self.large_mapping()
+        with ParamsCounter('default') as counter:
+            rows = merge_mapping(mapping)
+        self.assertTrue(counter.max_params <= SQLITE_MAX_PARAMS, counter.max_params)
+        self.assertEquals(
+            1100, TestModel.objects.filter(user=self.users[0], was_saved=True).count()
+        )
+        return rows
+    
+    def testBatchSurgeonShouldSplitLargeMappingByQueryParams(self):
+        s = BatchSurgeon(TestModel.saved)
+        def merge_mapping(mapping):
+            # four params per pair and the manager's own: 249 pairs per statement
+            with self.assertNumQueries(5):
+                return s.merge_mapping(mapping)
+        self.assertEquals(1100, self.mergeLargeMapping(merge_mapping))
+    
+    def testNotifyingBatchSurgeonShouldMergeLargeMapping(self):
+        s = NotifyingBatchSurgeon(TestModel.saved)
+        self.assertEquals(1100, self.mergeLargeMapping(s.merge_mapping))
+    
+    def testDefaultSurgeonShouldMergeLargeMapping(self):
+        s = DefaultSurgeon(TestModel.saved, chunk_size=500, narrow=True)
+        self.assertEquals(1100, self.mergeLargeMapping(s.merge_mapping))
+    
+    def testPlanShouldDeactivateDonorsOfLargeMapping(self):
+        plan = MergePlan((
+            ('transplant.tests.models.TestModel', 'transplant.surgeons.BatchSurgeon',
+             {'manager': 'saved'}),
+        ))
+        self.mergeLargeMapping(plan.merge_mapping)
+        self.assertFalse(
+            User.objects.filter(username__startswith='donor', is_active=True).exists()
+        )
+    
+    def testResolveMappingShouldFollowChains(self):
+        u = self.users
+        self.assertEquals(
+            {u[0]: u[2], u[1]: u[2], u[3]: u[4]},
+            resolve_mapping({u[0]: u[1], u[1]: u[2], u[3]: u[4], u[5]: u[5]})
+        )
+    
+    def testResolveMappingShouldRejectCycles(self):
+        u = self.users
+        with self.assertRaises(ValueError):
+            resolve_mapping({u[0]: u[1], u[1]: u[2], u[2]: u[0]})
+    
+    def testPlanShouldMergeMappingAndDeactivateDonorsInOneStatement(self):
+        plan = MergePlan((
+            ('transplant.tests.models.TestModel', 'transplant.surgeons.BatchSurgeon', {}),
+            (
+                'transplant.tests.models.CustomUserFieldNameModel',
+                'transplant.surgeons.BatchSurgeon',
+                {'user_field': 'person'}
+            ),
+        ))
+        with self.assertNumQueries(3):
+            plan.merge_mapping(self.mapping)
+        self.assertMerged()
+        self.assertMerged(CustomUserFieldNameModel, 'person')
+        self.assertEquals(
+            ['user0', 'user3', 'user5'],
+            list(User.objects.filter(is_active=True).order_by('pk').values_list(
+                'username', flat=True
+            ))
+        )
+
+class DryRunTest(TransactionTestCase):
+    
+    def setUp(self):
+        self.receiver = User.objects.create_user(username='receiver', password='r')
+        self.donor = User.objects.create_user(username='donor', password='d')
+        for _ in range(0, 3):
+            TestModel(user=self.donor).save()
+        TestModel(user=self.receiver).save()
+        team = Team.objects.create()
+        team.members.add(self.receiver, self.donor)
+        Rating.objects.create(user=self.receiver, item='a', score=1)
+        Rating.objects.create(user=self.donor, item='a', score=2)
+        Rating.objects.create(user=self.donor, item='b', score=3)
+        self.plan = MergePlan((
+            ('transplant.tests.models.TestModel', 'transplant.surgeons.BatchSurgeon', {}),
+            ('transplant.tests.models.TestModel', 'transplant.surgeons.DefaultSurgeon',
+                {'narrow': True}),
+            ('transplant.tests.models.Team', 'transplant.surgeons.ManyToManySurgeon',
+                {'user_field': 'members'}),
+            ('transplant.tests.models.Rating', 'transplant.surgeons.UniqueSurgeon', {}),
+            ('transplant.tests.models.TestModel', 'transplant.surgeons.NopSurgeon', {}),
+        ))
+    
+    def testDryRunShouldReportEachOperation(self):
+        reports = self.plan.dry_run(self.receiver, self.donor)
+        self.assertEquals(
+            ['BatchSurgeon', 'DefaultSurgeon', 'ManyToManySurgeon', 'UniqueSurgeon',
+             'NopSurgeon'],
+            [r['surgeon'] for r in reports]
+        )
+        self.assertEquals([3, 3, 1, 2, None], [r['rows'] for r in reports])
+        self.assertEquals('transplant.tests.models.TestModel', reports[0]['model'])
+        self.assertEquals([1, 1, 2, 2, 0], [len(r['statements']) for r in reports])
+        self.assertTrue(reports[0]['statements'][0][0].startswith('UPDATE'))
+        self.assertTrue(reports[3]['statements'][0][0].startswith('DELETE'))
+        self.assertEquals(
+            'DELETE of 1 conflicting objects (keep_receiver) and single UPDATE',
+            reports[3]['strategy']
+        )
+    
+    def testDefaultSurgeonShouldReportStatementOfEachObject(self):
+        narrow = DefaultSurgeon(TestModel.objects, narrow=True).dry_run(
+            self.receiver, self.donor)
+        self.assertEquals(
+            [('UPDATE "tests_testmodel" SET "user_id" = %s WHERE "id" = %s',
+              [self.receiver.pk, '<pk>'])], narrow['statements'])
+        self.assertTrue(narrow['strategy'].endswith('statements repeat once per object'))
+        report = DefaultSurgeon(TestModel.objects).dry_run(self.receiver, self.donor)
+        self.assertEquals(
+            [('UPDATE "tests_testmodel" SET "user_id" = %s, "was_saved" = %s '
+              'WHERE "id" = %s', [self.receiver.pk, '<was_saved>', '<pk>'])],
+            report['statements'])
+    
+    def testDryRunShouldExplainDonorRowsLookup(self):
+        reports = self.plan.dry_run(self.receiver, self.donor)
+        self.assertTrue(reports[0]['explain'])
+        self.assertEquals(None, reports[4]['explain'])
+    
+    def testDryRunShouldNotChangeAnything(self):
+        self.plan.dry_run(self.receiver, self.donor)
+        self.assertEquals(3, TestModel.objects.filter(user=self.donor).count())
+        self.assertEquals(1, self.donor.teams.count())
+        self.assertEquals(2, Rating.objects.filter(user=self.donor).count())
+        self.assertTrue(User.objects.get(pk=self.donor.pk).is_active)
+    
+    def testManyToManyStatementsShouldMergeRelations(self):
+        s = ManyToManySurgeon(Team.objects, user_field='members')
+        report = s.dry_run(self.receiver, self.donor)
+        self.assertEquals(1, report['queryset'].count())
+        with self.assertNumQueries(2):
+            s.merge(self.receiver, self.donor)
+        self.assertEquals(1, self.receiver.teams.count())
+        self.assertEquals(0, self.donor.teams.count())
+
+class InstrumentationTest(TestCase):
+    
+    def setUp(self):
+        self.receiver = User.objects.create_user(username='receiver', password='r')
+        self.donor = User.objects.create_user(username='donor', password='d')
+        for _ in range(0, 3):
+            TestModel(user=self.donor).save()
+        self.plan = MergePlan((
+            ('transplant.tests.models.TestModel', 'transplant.surgeons.BatchSurgeon', {}),
+            ('transplant.tests.models.TestModel', 'transplant.surgeons.NopSurgeon', {}),
+        ))
+        self.faulty_plan = MergePlan((
+            ('transplant.tests.models.TestModel', 'transplant.surgeons.BatchSurgeon', {}),
+            (
+                'transplant.tests.models.CustomUserFieldNameModel',
+                'transplant.tests.surgeons.FaultySurgeon',
+                {'user_field': 'person'}
+            ),
+        ))
+        self.events = []
+        self.signals = [merge_started, operation_started, operation_finished,
+                        merge_committed, merge_rolled_back]
+        for signal in self.signals:
+            signal.connect(self.record)
+    
+    def tearDown(self):
+        for signal in self.signals:
+            signal.disconnect(self.record)
+    
+    def record(self, signal, sender, **kwargs):
+        self.events.append((signal, kwargs))
+    
+    def testMergeShouldReturnStatsOfEachOperation(self):
+        stats = self.plan.merge(self.receiver, self.donor)
+        self.assertEquals({self.donor: self.receiver}, stats.mapping)
+        self.assertEquals(
+            [('tests.TestModel', 'BatchSurgeon', 3, 1), ('tests.TestModel', 'NopSurgeon', 0, 0)],
+            [(o['model'], o['surgeon'], o['rows'], o['queries']) for o in stats.operations]
+        )
+        self.assertEquals(3, stats.rows)
+        self.assertEquals(1, stats.queries)
+        self.assertTrue(stats.time >= sum(o['time'] for o in stats.operations))
+    
+    def testMergeShouldSendSignalsInOrder(self):
+        stats = self.plan.merge(self.receiver, self.donor)
+        self.assertEquals(
+            [merge_started, operation_started, operation_finished,
+             operation_started, operation_finished, merge_committed],
+            [signal for signal, _ in self.events]
+        )
+        self.assertTrue(all(kwargs['stats'] is stats for _, kwargs in self.events))
+        self.assertEquals(stats.operations[1], self.events[4][1]['operation'])
+    
+    def testRollbackShouldBeSignalled(self):
+        with self.assertRaises(Exception):
+            self.faulty_plan.merge(self.receiver, self.donor)
+        signal, kwargs = self.events[-1]
+        self.assertEquals(merge_rolled_back, signal)
+        self.assertEquals('Hello faulty surgeon!', str(kwargs['exception']))
+        self.assertEquals(1, len(kwargs['stats'].operations))
+    
+    def testFailingCommitReceiverShouldNotFailMerge(self):
+        def fail(**kwargs):
+            raise RuntimeError('cache is down')
+        merge_committed.connect(fail)
+        try:
+            stats = self.plan.merge(self.receiver, self.donor)
+        finally:
+            merge_committed.disconnect(fail)
+        self.assertEquals(3, stats.rows)
+        self.assertFalse(User.objects.get(pk=self.donor.pk).is_active)
+        self.assertEquals(merge_committed, self.events[-1][0])
+    
+    def testPerformShouldNotSendTransactionSignals(self):
+        stats = self.plan.perform(self.receiver, self.donor)
+        self.assertEquals(2, len(stats.operations))
+        self.assertNotIn(merge_committed, [signal for signal, _ in self.events])
+    
+    def testQueryCounterShouldNotKeepQueriesUnlessDebugging(self):
+        from django.db import connection
+        logged = len(connection.queries)
+        with QueryCounter('default') as counter:
+            list(TestModel.objects.all())
+            list(User.objects.all())
+        self.assertEquals(2, counter.count)
+        self.assertEquals([], counter.queries)
+        self.assertEquals(logged, len(connection.queries))
+        self.assertFalse(connection.use_debug_cursor)
+    
+    def testQueryCounterShouldKeepQueriesIfAsked(self):
+        with QueryCounter('default') as outer:
+            with QueryCounter('default', keep_queries=True) as counter:
+                list(TestModel.objects.filter(pk=1))
+            list(User.objects.all())
+        self.assertEquals(1, counter.count)
+        self.assertEquals(1, len(counter.queries))
+        self.assertTrue(counter.queries[0].startswith('SELECT'))
+        self.assertEquals(2, outer.count)
+    
+    def testLoggingAdapterShouldLogOperationsAndMerges(self):
+        logger = Mock()
+        adapter = LoggingAdapter(logger)
+        adapter.connect()
+        try:
+            self.plan.merge(self.receiver, self.donor)
+            with self.assertRaises(Exception):
+                self.faulty_plan.merge(self.receiver, self.donor)
+        finally:
+            adapter.disconnect()
+        self.assertEquals(3, logger.debug.call_count)
+        self.assertEquals(1, logger.info.call_count)
+        self.assertEquals(1, logger.warning.call_count)
+    
+    def testStatsdAdapterShouldReportOperationsAndMerges(self):
+        client = Mock()
+        adapter = StatsdAdapter(client, prefix='merges')
+        adapter.connect()
+        try:
+            self.plan.merge(self.receiver, self.donor)
+        finally:
+            adapter.disconnect()
+        self.assertIn((('merges.tests.TestModel.rows', 3), {}), client.incr.call_args_list)
+        self.assertIn((('merges.merge.committed', 1), {}), client.incr.call_args_list)
+        self.assertEquals(
+            ['merges.tests.TestModel.time', 'merges.tests.TestModel.time', 'merges.merge.time'],
+            [args[0] for args, _ in client.timing.call_args_list]
+        )
+
+class QueryComplexityTest(QueryCurveAssertions, TestCase):
+    SIZES = (1, 10, 40)
+    
+    def populateTestModels(self, receiver, donor, size):
+        for _ in range(0, size):
+            TestModel.objects.create(user=donor)
+        TestModel.objects.create(user=receiver)
+    
+    def populateRatings(self, receiver, donor, size):
+        for i in range(0, size):
+            Rating.objects.create(user=donor, item=str(i))
+        for i in range(0, size, 5):
+            Rating.objects.create(user=receiver, item=str(i))
+    
+    def populateTeams(self, receiver, donor, size):
+        for i in range(0, size):
+            team = Team.objects.create()
+            team.members.add(donor)
+            if i % 3 == 0:
+                team.members.add(receiver)
+    
+    def surgeryMerge(self, model, surgeon, **kwargs):
+        def merge(receiver, donor):
+            Surgery(model, surgeon, **kwargs).merge(receiver, donor)
+        return merge
+    
+    def testBatchSurgeonShouldIssueSingleQuery(self):
+        s = BatchSurgeon(TestModel.objects)
+        self.assertQueryCurve(lambda n: 1, self.SIZES, self.populateTestModels, s.merge)
+    
+    def testBatchSurgeonShouldMergeManyDonorsWithSingleQuery(self):
+        s = BatchSurgeon(TestModel.objects)
+        def populate(receiver, donor, size):
+            self.others = [User.objects.create_user(
+                username='other{0}-{1}'.format(donor.pk, i), password='o') for i in range(0, 3)]
+            for user in self.others + [donor]:
+                self.populateTestModels(receiver, user, size)
+        self.assertQueryCurve(
+            lambda n: 1, self.SIZES, populate,
+            lambda receiver, donor: s.merge_many(receiver, self.others + [donor])
+        )
+        self.assertQueryCurve(
+            lambda n: 1, self.SIZES, populate,
+            lambda receiver, donor: s.merge_mapping(
+                dict((user, receiver) for user in self.others + [donor]))
+        )
+    
+    def testNotifyingBatchSurgeonShouldIssueTwoQueries(self):
+        s = NotifyingBatchSurgeon(TestModel.objects)
+        self.assertQueryCurve(lambda n: 2, self.SIZES, self.populateTestModels, s.merge)
+    
+    def testManyToManySurgeonShouldIssueTwoQueries(self):
+        s = ManyToManySurgeon(Team.objects, user_field='members')
+        self.assertQueryCurve(lambda n: 2, self.SIZES, self.populateTeams, s.merge)
+    
+    def testUniqueSurgeonShouldIssueConstantNumberOfQueries(self):
+        s = UniqueSurgeon(Rating.objects)
+        self.assertConstantQueries(self.SIZES, self.populateRatings, s.merge)
+    
+    def testChunkedSurgeonShouldIssueOneSelectPerChunk(self):
+        s = DefaultSurgeon(TestModel.objects, chunk_size=10, narrow=True)
+        self.assertQueryCurve(
+            lambda n: n // 10 + 1, self.SIZES, self.populateTestModels, s.merge,
+            statement='SELECT'
+        )
+    
+    def testNarrowSurgeonShouldIssueOneUpdatePerObject(self):
+        s = DefaultSurgeon(TestModel.objects, narrow=True)
+        self.assertQueryCurve(
+            lambda n: n + 1, self.SIZES, self.populateTestModels, s.merge
+        )
+    
+    def testDefaultSurgeonShouldIssueOneSavePerObject(self):
+        s = DefaultSurgeon(TestModel.objects)
+        self.assertQueryCurve(
+            lambda n: 2 * n + 1, self.SIZES, self.populateTestModels, s.merge
+        )
+    
+    def testSurgeryShouldNotAddQueries(self):
+        merge = self.surgeryMerge(
+            'transplant.tests.models.TestModel', 'transplant.surgeons.BatchSurgeon')
+        self.assertQueryCurve(lambda n: 1, self.SIZES, self.populateTestModels, merge)
+    
+    def testPlanShouldIssueConstantNumberOfQueries(self):
+        plan = MergePlan((
+            ('transplant.tests.models.TestModel', 'transplant.surgeons.BatchSurgeon', {}),
+            ('transplant.tests.models.Rating', 'transplant.surgeons.UniqueSurgeon', {}),
+            ('transplant.tests.models.Team', 'transplant.surgeons.ManyToManySurgeon',
+                {'user_field': 'members'}),
+        ))
+        def populate(receiver, donor, size):
+            self.populateTestModels(receiver, donor, size)
+            self.populateRatings(receiver, donor, size)
+            self.populateTeams(receiver, donor, size)
+        self.assertConstantQueries(self.SIZES, populate, plan.merge)
+
+class MultiDatabaseMergeTest(TransactionTestCase):
+    multi_db = True
+    
+    def setUp(self):
+        self.router = OtherDatabaseRouter()
+        router.routers.insert(0, self.router)
+        self.receiver = User.objects.create_user(username='receiver', password='r')
+        self.donor = User.objects.create_user(username='donor', password='d')
+        for _ in range(0, 3):
+            TestModel(user=self.donor).save()
+            CustomUserFieldNameModel.objects.create(person_id=self.donor.pk)
+        self.threads = {}
+    
+    def tearDown(self):
+        router.routers.remove(self.router)
+    
+    def callback(self, index, surgery):
+        self.threads[index] = threading.current_thread().name
+    
+    def plan(self, default_surgeon, other_surgeon):
+        return MergePlan((
+            ('transplant.tests.models.TestModel', default_surgeon, {}),
+            ('transplant.tests.models.CustomUserFieldNameModel', other_surgeon,
+                {'user_field': 'person'}),
+        ))
+    
+    def owners(self):
+        return (
+            set(TestModel.objects.values_list('user', flat=True)),
+            set(CustomUserFieldNameModel.objects.values_list('person', flat=True)),
+        )
+    
+    def testPlanShouldGroupSurgeriesByDatabase(self):
+        plan = self.plan('transplant.surgeons.BatchSurgeon',
+                         'transplant.surgeons.BatchSurgeon')
+        self.assertEquals(
+            [('default', [(0, plan.surgeries[0])]), ('other', [(1, plan.surgeries[1])])],
+            plan.groups()
+        )
+    
+    def testMergeShouldCommitAllDatabases(self):
+        plan = self.plan('transplant.surgeons.BatchSurgeon',
+                         'transplant.surgeons.BatchSurgeon')
+        stats = plan.merge(self.receiver, self.donor, callback=self.callback)
+        self.assertEquals((set([self.receiver.pk]), set([self.receiver.pk])), self.owners())
+        self.assertFalse(User.objects.get(pk=self.donor.pk).is_active)
+        self.assertEquals('transplant-other', self.threads[1])
+        self.assertNotEquals('transplant-other', self.threads[0])
+        self.assertEquals([0, 1], [o['index'] for o in stats.operations])
+        self.assertEquals(6, stats.rows)
+    
+    def testFailureOnOtherDatabaseShouldRollBackAllDatabases(self):
+        plan = self.plan('transplant.surgeons.BatchSurgeon',
+                         'transplant.tests.surgeons.FaultySurgeon')
+        with self.assertRaises(RuntimeError):
+            plan.merge(self.receiver, self.donor)
+        self.assertEquals((set([self.donor.pk]), set([self.donor.pk])), self.owners())
+        self.assertTrue(User.objects.get(pk=self.donor.pk).is_active)
+    
+    def testFailureOnDefaultDatabaseShouldRollBackAllDatabases(self):
+        plan = self.plan('transplant.tests.surgeons.FaultySurgeon',
+                         'transplant.surgeons.BatchSurgeon')
+        with self.assertRaises(RuntimeError):
+            plan.merge(self.receiver, self.donor)
+        self.assertEquals((set([self.donor.pk]), set([self.donor.pk])), self.owners())
+    
+    def testCheckpointShouldBeSavedAfterChunkOnOtherDatabaseIsCommitted(self):
+        from django.db import transaction
+        commit = transaction.commit
+        def failing_commit(using=None):
+            if using == 'other':
+                transaction.rollback(using=using)
+                raise DatabaseError('commit failed')
+            return commit(using=using)
+        job = enqueue_merge(self.receiver, self.donor, journaled=True)
+        job.claim()
+        plan = self.plan('transplant.surgeons.BatchSurgeon',
+                         'transplant.surgeons.BatchSurgeon')
+        with patch('transplant.plan.transaction.commit', failing_commit):
+            with self.assertRaises(DatabaseError):
+                plan.merge_journaled(job, chunk_size=10)
+        self.assertEquals([(0, 1, True)], list(MergeCheckpoint.objects.filter(
+            job=job).values_list('operation', 'chunks', 'done')))
+        self.assertEquals(set([self.donor.pk]), self.owners()[1])
+        stats = plan.merge_journaled(job, chunk_size=10)
+        self.assertEquals(3, stats.rows)
+        self.assertEquals((set([self.receiver.pk]), set([self.receiver.pk])), self.owners())
+        self.assertEquals([(0, 1, True), (1, 1, True)], list(MergeCheckpoint.objects.filter(
+            job=job).values_list('operation', 'chunks', 'done')))
+    
+    def testUndoJournalShouldRecordOperationsOfAllDatabases(self):
+        plan = self.plan('transplant.surgeons.BatchSurgeon',
+                         'transplant.surgeons.BatchSurgeon')
+        with self.settings(TRANSPLANT_UNDO_JOURNAL=True):
+            for i in range(0, 5):
+                receiver = User.objects.create_user(username='r{0}'.format(i), password='r')
+                TestModel(user=self.donor).save()
+                CustomUserFieldNameModel.objects.create(person_id=self.donor.pk)
+                stats = plan.merge(receiver, self.donor, callback=self.callback)
+                self.assertEquals('transplant-other', self.threads[1])
+                self.assertEquals([(0, 'tests.TestModel'), (1, 'tests.CustomUserFieldNameModel')],
+                                  list(stats.journal.entries.values_list('operation', 'model')))
+                self.donor = User.objects.get(pk=self.donor.pk)
+                self.assertFalse(self.donor.is_active)
+                self.donor.is_active = True
+                self.donor.save()
+    
+    def testDatabasesShouldBeUsedFromCallingThreadIfNotConcurrent(self):
+        plan = self.plan('transplant.surgeons.BatchSurgeon',
+                         'transplant.surgeons.BatchSurgeon')
+        with self.settings(TRANSPLANT_CONCURRENT_ALIASES=False):
+            plan.merge(self.receiver, self.donor, callback=self.callback)
+        self.assertEquals(self.threads[0], self.threads[1])
+        self.assertEquals((set([self.receiver.pk]), set([self.receiver.pk])), self.owners())
+
+class DeadlockRetryTest(TestCase):
+    
+    def setUp(self):
+        self.receiver = User.objects.create_user(username='receiver', password='r')
+        self.donor = User.objects.create_user(username='donor', password='d')
+        for _ in range(0, 3):
+            TestModel(user=self.donor).save()
+    
+    def plan(self, deadlocks):
+        return MergePlan((
+            ('transplant.tests.models.TestModel',
+                'transplant.tests.surgeons.DeadlockingSurgeon', {'deadlocks': deadlocks}),
+        ))
+    
+    def testMergeShouldBeRetriedAfterDeadlock(self):
+        with self.settings(TRANSPLANT_RETRY_DELAY=0):
+            stats = self.plan(2).merge(self.receiver, self.donor)
+        self.assertEquals(2, stats.retries)
+        self.assertEquals(1, len(stats.operations))
+        self.assertEquals(3, TestModel.objects.filter(user=self.receiver).count())
+        self.assertFalse(User.objects.get(pk=self.donor.pk).is_active)
+    
+    def testMergeShouldFailWhenRetriesAreExhausted(self):
+        rolled_back = []
+        def on_rollback(sender, stats, **kwargs):
+            rolled_back.append(stats.retries)
+        merge_rolled_back.connect(on_rollback)
+        try:
+            with self.settings(TRANSPLANT_RETRY_DELAY=0, TRANSPLANT_DEADLOCK_RETRIES=2):
+                with self.assertRaises(DatabaseError):
+                    self.plan(3).merge(self.receiver, self.donor)
+        finally:
+            merge_rolled_back.disconnect(on_rollback)
+        self.assertEquals([2], rolled_back)
+    
+    def testOtherErrorsShouldNotBeRetried(self):
+        plan = MergePlan((
+            ('transplant.tests.models.TestModel', 'transplant.tests.surgeons.FaultySurgeon', {}),
+        ))
+        plan.retry_delay = Mock()
+        with self.assertRaises(RuntimeError):
+            plan.merge(self.receiver, self.donor)
+        self.assertFalse(plan.retry_delay.called)
+    
+    def testRetryDelayShouldGrowWithJitter(self):
+        plan = self.plan(0)
+        with self.settings(TRANSPLANT_RETRY_DELAY=1.0):
+            for retries in range(0, 3):
+                delay = plan.retry_delay(retries)
+                self.assertTrue(0.5 * 2 ** retries <= delay <= 1.5 * 2 ** retries)
+    
+    def testRetryableErrorsShouldBeRecognized(self):
+        self.assertTrue(is_retryable(DatabaseError('deadlock detected\n')))
+        self.assertTrue(is_retryable(DatabaseError(
+            'could not serialize access due to concurrent update')))
+        self.assertTrue(is_retryable(DatabaseError(1213, 'Deadlock found')))
+        self.assertFalse(is_retryable(DatabaseError('no such table: foo')))
+        self.assertFalse(is_retryable(RuntimeError('deadlock')))
+    
+    def testUsersShouldBeLockedInPrimaryKeyOrder(self):
+        from django.db import connection
+        features, ops = connection.features, connection.ops
+        features.has_select_for_update = True
+        ops.for_update_sql = lambda nowait=False: '/* FOR UPDATE */'
+        try:
+            with QueryCounter('default', keep_queries=True) as counter:
+                self.plan(0).lock_users('default', {self.donor: self.receiver})
+        finally:
+            features.has_select_for_update = False
+            del ops.for_update_sql
+        self.assertEquals(1, counter.count)
+        self.assertTrue(counter.queries[0].endswith('ORDER BY "auth_user"."id" ASC /* FOR UPDATE */'))
+    
+    def testUsersShouldNotBeLockedWithoutRowLocks(self):
+        with self.assertNumQueries(0):
+            self.plan(0).lock_users('default', {self.donor: self.receiver})
+
+class JournaledMergeTest(TransactionTestCase):
+    
+    def setUp(self):
+        self.receiver = User.objects.create_user(username='receiver', password='r')
+        self.donor = User.objects.create_user(username='donor', password='d')
+        for _ in range(0, 25):
+            TestModel(user=self.donor).save()
+        for _ in range(0, 5):
+            CustomUserFieldNameModel(person=self.donor).save()
+        self.job = enqueue_merge(self.receiver, self.donor, journaled=True)
+        self.job.claim()
+    
+    def checkpoints(self):
+        return list(MergeCheckpoint.objects.filter(job=self.job).values_list(
+            'operation', 'chunks', 'rows', 'done'))
+    
+    def testMergeShouldBeCommittedInChunks(self):
+        plan = MergePlan((
+            ('transplant.tests.models.TestModel', 'transplant.surgeons.BatchSurgeon', {}),
+            ('transplant.tests.models.CustomUserFieldNameModel',
+                'transplant.surgeons.DefaultSurgeon', {'user_field': 'person'}),
+        ))
+        stats = plan.merge_journaled(self.job, chunk_size=10)
+        self.assertEquals([(0, 3, 25, True), (1, 1, 5, True)], self.checkpoints())
+        self.assertEquals(30, stats.rows)
+        self.assertEquals(25, TestModel.objects.filter(user=self.receiver).count())
+        self.assertEquals(5, CustomUserFieldNameModel.objects.filter(
+            person=self.receiver).count())
+        self.assertFalse(User.objects.get(pk=self.donor.pk).is_active)
+        self.assertEquals(MergeJob.DONE, MergeJob.objects.get(pk=self.job.pk).status)
+        self.assertFalse(merge_in_progress(self.donor))
+    
+    def testInterruptedMergeShouldBeResumedFromCheckpoints(self):
+        with self.settings(TRANSPLANT_JOURNAL_CHUNK_SIZE=10):
+            run_job(self.job, MergePlan((
+                ('transplant.tests.models.CustomUserFieldNameModel',
+                    'transplant.surgeons.BatchSurgeon', {'user_field': 'person'}),
+                ('transplant.tests.models.TestModel',
+                    'transplant.tests.surgeons.InterruptedSurgeon', {'chunks': 2}),
+            )))
+            self.assertEquals([(0, 1, 5, True), (1, 2, 20, False)], self.checkpoints())
+            self.assertEquals(20, TestModel.objects.filter(user=self.receiver).count())
+            self.assertTrue(User.objects.get(pk=self.donor.pk).is_active)
+            self.assertTrue(merge_in_progress(self.donor))
+            self.assertTrue(merge_in_progress(self.receiver))
+            
+            # the first operation is done, and must not run again
+            with self.settings(TRANSPLANT_OPERATIONS=(
+                ('transplant.tests.models.CustomUserFieldNameModel',
+                    'transplant.tests.surgeons.FaultySurgeon', {'user_field': 'person'}),
+                ('transplant.tests.models.TestModel', 'transplant.surgeons.BatchSurgeon', {}),
+            )):
+                self.assertEquals([self.job], resume_jobs())
+        self.assertEquals([(0, 1, 5, True), (1, 3, 25, True)], self.checkpoints())
+        self.assertEquals(25, TestModel.objects.filter(user=self.receiver).count())
+        self.assertFalse(User.objects.get(pk=self.donor.pk).is_active)
+        self.assertEquals(MergeJob.DONE, MergeJob.objects.get(pk=self.job.pk).status)
+        self.assertFalse(merge_in_progress(self.donor))
+    
+    def testOnlyJournaledJobsShouldBeInProgress(self):
+        job = enqueue_merge(self.donor, self.receiver)
+        job.claim()
+        self.assertFalse(job.journaled)
+        self.assertTrue(merge_in_progress(self.donor))
+        self.job.delete()
+        self.assertFalse(merge_in_progress(self.donor))
+    
+    def testChunkOfSurgeonsShouldBeIdempotent(self):
+        self.assertEquals(10, BatchSurgeon(TestModel.objects).merge_chunk(
+            self.receiver, self.donor, 10))
+        self.assertEquals(5, NotifyingBatchSurgeon(CustomUserFieldNameModel.objects,
+            user_field='person').merge_chunk(self.receiver, self.donor, 10))
+        self.assertEquals(10, DefaultSurgeon(TestModel.objects, narrow=True).merge_chunk(
+            self.receiver, self.donor, 10))
+        self.assertEquals(5, BatchSurgeon(TestModel.objects).merge_chunk(
+            self.receiver, self.donor, 10))
+        self.assertEquals(0, BatchSurgeon(TestModel.objects).merge_chunk(
+            self.receiver, self.donor, 10))
+
+class UndoJournalTest(TestCase):
+    
+    def setUp(self):
+        self.receiver = User.objects.create_user(username='receiver', password='r')
+        self.donor = User.objects.create_user(username='donor', password='d')
+        self.kept = TestModel.objects.create(user=self.receiver)
+        self.moved = [TestModel.objects.create(user=self.donor) for _ in range(0, 5)]
+        self.person = CustomUserFieldNameModel.objects.create(person=self.donor)
+        self.plan = MergePlan((
+            ('transplant.tests.models.TestModel', 'transplant.surgeons.BatchSurgeon', {}),
+            ('transplant.tests.models.CustomUserFieldNameModel',
+                'transplant.surgeons.DefaultSurgeon', {'user_field': 'person'}),
+            ('transplant.tests.models.Profile', 'transplant.surgeons.NopSurgeon', {}),
+        ))
+    
+    def testPksShouldBePackedAsRanges(self):
+        self.assertEquals('1-3,7,9-10', pack_pks([10, 2, 1, 3, 7, 9, 2]))
+        self.assertEquals([(1, 3), (7, 7), (9, 10)], unpack_ranges('1-3,7,9-10'))
+        self.assertEquals([('a', 'a'), ('b', 'b')], unpack_ranges(pack_pks(['b', 'a'])))
+        self.assertEquals('', pack_pks([]))
+    
+    def testMergeShouldNotBeRecordedByDefault(self):
+        stats = self.plan.merge(self.receiver, self.donor)
+        self.assertEquals(None, stats.journal)
+        self.assertEquals(0, MergeJournal.objects.count())
+    
+    def testMergeShouldRecordMovedPks(self):
+        with self.settings(TRANSPLANT_UNDO_JOURNAL=True):
+            stats = self.plan.merge(self.receiver, self.donor)
+        journal = MergeJournal.objects.get()
+        self.assertEquals(journal, stats.journal)
+        self.assertTrue(journal.complete)
+        self.assertEquals(
+            [(0, 'tests.TestModel', 'user', pack_pks([o.pk for o in self.moved]), 5),
+             (1, 'tests.CustomUserFieldNameModel', 'person', str(self.person.pk), 1)],
+            list(journal.entries.values_list('operation', 'model', 'field', 'pks', 'rows'))
+        )
+    
+    def testUnmergeShouldMoveObjectsBackToDonor(self):
+        with self.settings(TRANSPLANT_UNDO_JOURNAL=True):
+            journal = self.plan.merge(self.receiver, self.donor).journal
+        # objects moved away from receiver since the merge are left alone
+        TestModel.objects.filter(pk=self.moved[0].pk).update(user=self.kept.user_id + 100)
+        with self.assertNumQueries(5):
+            self.assertEquals(5, unmerge(journal))
+        self.assertEquals([self.kept], list(TestModel.objects.filter(user=self.receiver)))
+        self.assertEquals(self.moved[1:], list(TestModel.objects.filter(
+            user=self.donor).order_by('pk')))
+        self.assertEquals(1, CustomUserFieldNameModel.objects.filter(person=self.donor).count())
+        self.assertTrue(User.objects.get(pk=self.donor.pk).is_active)
+        self.assertNotEquals(None, MergeJournal.objects.get().undone)
+        with self.assertRaises(ValueError):
+            unmerge(journal)
+    
+    def testDeletedObjectsShouldMakeJournalIncomplete(self):
+        Rating.objects.create(user=self.receiver, item='a')
+        Rating.objects.create(user=self.donor, item='a')
+        Rating.objects.create(user=self.donor, item='b')
+        plan = MergePlan((
+            ('transplant.tests.models.Rating', 'transplant.surgeons.UniqueSurgeon', {}),
+        ))
+        with self.settings(TRANSPLANT_UNDO_JOURNAL=True):
+            journal = plan.merge(self.receiver, self.donor).journal
+        self.assertFalse(journal.complete)
+        self.assertEquals(1, unmerge(journal))
+        self.assertEquals(['b'], list(Rating.objects.filter(
+            user=self.donor).values_list('item', flat=True)))
+    
+    def testManyToManyRelationsShouldBeRecorded(self):
+        teams = [Team.objects.create() for _ in range(0, 3)]
+        teams[0].members.add(self.receiver, self.donor)
+        teams[1].members.add(self.donor)
+        teams[2].members.add(self.donor)
+        plan = MergePlan((
+            ('transplant.tests.models.Team', 'transplant.surgeons.ManyToManySurgeon',
+                {'user_field': 'members'}),
+        ))
+        with self.settings(TRANSPLANT_UNDO_JOURNAL=True):
+            journal = plan.merge(self.receiver, self.donor).journal
+        self.assertFalse(journal.complete)
+        self.assertEquals(2, unmerge(journal))
+        self.assertEquals(teams[1:], list(self.donor.teams.order_by('pk')))
+        self.assertEquals([teams[0]], list(self.receiver.teams.all()))
+    
+    def testCommandShouldUnmergeJournals(self):
+        with self.settings(TRANSPLANT_UNDO_JOURNAL=True):
+            journal = self.plan.merge(self.receiver, self.donor).journal
+        stdout = StringIO()
+        call_command('transplant_unmerge', str(journal.pk), stdout=stdout)
+        self.assertEquals('Merge journal {0}: moved back 6 objects.\n'.format(journal.pk),
+                          stdout.getvalue())
+        self.assertEquals(6, TestModel.objects.filter(user=self.donor).count() +
+                          CustomUserFieldNameModel.objects.filter(person=self.donor).count())
+
+class CombinedUpdatesTest(TestCase):
+    
+    def setUp(self):
+        self.receiver = User.objects.create_user(username='receiver', password='r')
+        self.donor = User.objects.create_user(username='donor', password='d')
+        for _ in range(0, 3):
+            TestModel.objects.create(user=self.donor)
+        CustomUserFieldNameModel.objects.create(person=self.donor)
+        Rating.objects.create(user=self.donor, item='a')
+        self.plan = MergePlan((
+            ('transplant.tests.models.TestModel', 'transplant.surgeons.BatchSurgeon', {}),
+            ('transplant.tests.models.CustomUserFieldNameModel',
+                'transplant.surgeons.BatchSurgeon', {'user_field': 'person'}),
+            ('transplant.tests.models.Rating', 'transplant.surgeons.UniqueSurgeon', {}),
+        ))
+    
+    def testOnlyPlainBatchSurgeonsShouldBeCombined(self):
+        s = BatchSurgeon(TestModel.objects)
+        sql, params = s.update_statement(self.receiver, [self.donor], 'default')
+        self.assertTrue(sql.startswith('UPDATE'))
+        self.assertEquals([self.receiver.pk, self.donor.pk], list(params))
+        self.assertEquals(None, s.update_statement(self.receiver, [self.receiver], 'default'))
+        for s in (NopSurgeon(TestModel.objects), DefaultSurgeon(TestModel.objects),
+                  NotifyingBatchSurgeon(TestModel.objects), UniqueSurgeon(Rating.objects),
+                  DeadlockingSurgeon(TestModel.objects)):
+            self.assertEquals(None, s.update_statement(self.receiver, [self.donor], 'default'))
+    
+    def testStatementsShouldBeChainedAsCtes(self):
+        sql, params = combined_sql([('UPDATE a SET x = %s', [1]),
+                                    ('UPDATE b SET y = %s WHERE z = %s', [2, 3])])
+        self.assertEquals(
+            'WITH u0 AS (UPDATE a SET x = %s RETURNING 1), '
+            'u1 AS (UPDATE b SET y = %s WHERE z = %s RETURNING 1) '
+            'SELECT (SELECT COUNT(*) FROM u0), (SELECT COUNT(*) FROM u1)', sql)
+        self.assertEquals([1, 2, 3], params)
+    
+    def testCombinedMergeShouldReportRowsOfEachOperation(self):
+        with self.settings(TRANSPLANT_COMBINE_UPDATES=True):
+            stats = self.plan.merge(self.receiver, self.donor)
+        self.assertEquals([3, 1, 1], [o['rows'] for o in stats.operations])
+        # the batch is sent by the first operation
+        self.assertEquals(2, stats.operations[0]['queries'])
+        self.assertEquals(0, stats.operations[1]['queries'])
+        self.assertEquals(3, TestModel.objects.filter(user=self.receiver).count())
+        self.assertEquals(1, CustomUserFieldNameModel.objects.filter(
+            person=self.receiver).count())
+        self.assertEquals(1, Rating.objects.filter(user=self.receiver).count())
+    
+    def testCombinedMergeShouldHandleManyDonors(self):
+        other = User.objects.create_user(username='other', password='o')
+        TestModel.objects.create(user=other)
+        with self.settings(TRANSPLANT_COMBINE_UPDATES=True):
+            stats = self.plan.merge_many(self.receiver, [self.donor, other])
+        self.assertEquals([4, 1, 1], [o['rows'] for o in stats.operations])
+        self.assertEquals(4, TestModel.objects.filter(user=self.receiver).count())
+    
+    def testCombinedMergeShouldKeepPlanOrder(self):
+        plan = MergePlan((
+            ('transplant.tests.models.TestModel', 'transplant.surgeons.DefaultSurgeon', {}),
+            ('transplant.tests.models.TestModel', 'transplant.surgeons.BatchSurgeon', {}),
+            ('transplant.tests.models.CustomUserFieldNameModel',
+                'transplant.surgeons.BatchSurgeon', {'user_field': 'person'}),
+        ))
+        saved = []
+        def record(sender, instance, **kwargs):
+            saved.append(instance.pk)
+        post_save.connect(record, sender=TestModel)
+        try:
+            with self.settings(TRANSPLANT_COMBINE_UPDATES=True):
+                stats = plan.merge(self.receiver, self.donor)
+        finally:
+            post_save.disconnect(record, sender=TestModel)
+        self.assertEquals(
+            [('DefaultSurgeon', 3), ('BatchSurgeon', 0), ('BatchSurgeon', 1)],
+            [(o['surgeon'], o['rows']) for o in stats.operations]
+        )
+        self.assertEquals(3, len(saved))
+        self.assertEquals(2, stats.operations[1]['queries'])
+
+class SessionRevocationTest(TestCase):
+    
+    def setUp(self):
+        self.receiver = User.objects.create_user(username='receiver', password='r')
+        self.donor = User.objects.create_user(username='donor', password='d')
+        self.plan = MergePlan((
+            ('transplant.tests.models.TestModel', 'transplant.surgeons.BatchSurgeon', {}),
+        ))
+    
+    def login(self, username, password):
+        client = Client()
+        self.assertTrue(client.login(username=username, password=password))
+        return client
+    
+    def testSessionsShouldBeIndexedOnlyIfEnabled(self):
+        self.login('donor', 'd')
+        self.assertEquals(0, UserSession.objects.count())
+        with self.settings(TRANSPLANT_REVOKE_SESSIONS=True):
+            clients = [self.login('donor', 'd') for _ in range(0, 2)]
+            self.assertEquals(2, UserSession.objects.filter(user=self.donor).count())
+            request = RequestFactory().get('/')
+            request.session, request.user = clients[0].session, self.donor
+            logout(request)
+            self.assertEquals(
+                [clients[1].session.session_key],
+                list(UserSession.objects.values_list('session_key', flat=True))
+            )
+    
+    def testDonorSessionsShouldBeDeletedAfterMerge(self):
+        with self.settings(TRANSPLANT_REVOKE_SESSIONS=True):
+            for _ in range(0, 3):
+                self.login('donor', 'd')
+            receiver_key = self.login('receiver', 'r').session.session_key
+            self.assertEquals(4, Session.objects.count())
+            self.plan.merge(self.receiver, self.donor)
+        self.assertEquals([receiver_key],
+                          list(Session.objects.values_list('session_key', flat=True)))
+        self.assertEquals([self.receiver.pk],
+                          list(UserSession.objects.values_list('user', flat=True)))
+    
+    def testSessionsShouldBeRevokedWithConstantNumberOfQueries(self):
+        with self.settings(TRANSPLANT_REVOKE_SESSIONS=True):
+            for _ in range(0, 5):
+                self.login('donor', 'd')
+            # index lookup, DELETE of sessions and DELETE of the index
+            with self.assertNumQueries(3):
+                self.assertEquals([], revoke_sessions([self.donor]))
+        self.assertEquals(0, Session.objects.count())
+    
+    def testSessionsShouldBeKeptIfNotEnabled(self):
+        with self.settings(TRANSPLANT_REVOKE_SESSIONS=True):
+            self.login('donor', 'd')
+        self.plan.merge(self.receiver, self.donor)
+        self.assertEquals(1, Session.objects.count())
+    
+    def testCacheKeysOfBothUsersShouldBeDeletedAfterMerge(self):
+        for user in (self.receiver, self.donor):
+            cache.set('profile:{0}'.format(user.pk), 'p')
+            cache.set('menu:{0}'.format(user.username), 'm')
+        cache.set('other', 'o')
+        with self.settings(TRANSPLANT_CACHE_KEYS=('profile:{user.pk}', 'menu:{user.username}')):
+            self.plan.merge(self.receiver, self.donor)
+        for user in (self.receiver, self.donor):
+            self.assertEquals(None, cache.get('profile:{0}'.format(user.pk)))
+            self.assertEquals(None, cache.get('menu:{0}'.format(user.username)))
+        self.assertEquals('o', cache.get('other'))
+    
+    def testCacheKeysShouldNotBeDeletedIfMergeFails(self):
+        cache.set('profile:{0}'.format(self.donor.pk), 'p')
+        plan = MergePlan((
+            ('transplant.tests.models.TestModel', 'transplant.tests.surgeons.FaultySurgeon', {}),
+        ))
+        with self.settings(TRANSPLANT_CACHE_KEYS=('profile:{user.pk}',)):
+            with self.assertRaises(RuntimeError):
+                plan.merge(self.receiver, self.donor)
+        self.assertEquals('p', cache.get('profile:{0}'.format(self.donor.pk)))
+
+class DiscoveryTest(TestCase):
+    
+    def testShouldDiscoverForeignKeysPointingAtUser(self):
+        operations = discover_operations()
+        self.assertTrue((
+            'transplant.tests.models.TestModel',
+            'transplant.surgeons.BatchSurgeon',
+            {'user_field': 'user', 'manager': '_base_manager'}
+        ) in operations)
+        self.assertTrue((
+            'transplant.tests.models.CustomUserFieldNameModel',
+            'transplant.surgeons.BatchSurgeon',
+            {'user_field': 'person', 'manager': '_base_manager'}
+        ) in operations)
+    
+    def testShouldDiscoverManyToManyFieldsPointingAtUser(self):
+        operations = discover_operations()
+        self.assertTrue((
+            'transplant.tests.models.Team',
+            'transplant.surgeons.ManyToManySurgeon',
+            {'user_field': 'members', 'manager': '_base_manager'}
+        ) in operations)
+        self.assertTrue((
+            'transplant.tests.models.Membership',
+            'transplant.surgeons.BatchSurgeon',
+            {'user_field': 'user', 'manager': '_base_manager'}
+        ) in operations)
+        self.assertFalse('transplant.tests.models.Club' in [o[0] for o in operations])
+    
+    def testShouldDiscoverUniqueFieldsWithUniqueSurgeon(self):
+        operations = discover_operations()
+        for model in ['Profile', 'Rating']:
+            self.assertTrue((
+                'transplant.tests.models.{0}'.format(model),
+                'transplant.surgeons.UniqueSurgeon',
+                {'user_field': 'user', 'manager': '_base_manager'}
+            ) in operations)
+    
+    def testShouldNotDiscoverTransplantModels(self):
+        for model, _, _ in discover_operations():
+            self.assertFalse(model.startswith('transplant.models.'))
+    
+    def testShouldNotDiscoverExcludedModels(self):
+        for model, _, _ in discover_operations(exclude=[TestModel]):
+            self.assertNotEquals('transplant.tests.models.TestModel', model)
+    
+    def testPlanShouldIncludeDiscoveredOperationsIfAutodiscoverIsOn(self):
+        with self.settings(TRANSPLANT_AUTODISCOVER = True):
+            models = [s.model for s in get_merge_plan()]
+        self.assertTrue(TestModel in models)
+        self.assertTrue(CustomUserFieldNameModel in models)
+        with self.settings(TRANSPLANT_AUTODISCOVER = False):
+            self.assertEquals([], list(get_merge_plan()))
+    
+    def testConfiguredOperationShouldOverrideDiscoveredOne(self):
+        with self.settings(
+            TRANSPLANT_AUTODISCOVER = True,
+            TRANSPLANT_OPERATIONS = (
+                ('transplant.tests.models.TestModel', 'transplant.surgeons.NopSurgeon', {}),
+            )
+        ):
+            surgeries = [s for s in get_merge_plan() if s.model is TestModel]
+        self.assertEquals(1, len(surgeries))
+        self.assertEquals('NopSurgeon', surgeries[0].surgeon.__class__.__name__)
+    
+    def testDiscoveredPlanShouldMergeUsers(self):
+        receiver = User.objects.create_user(username='receiver', password='p')
+        donor = User.objects.create_user(username='donor', password='p')
+        TestModel(user=donor).save()
+        CustomUserFieldNameModel(person=donor).save()
+        with self.settings(TRANSPLANT_AUTODISCOVER = True):
+            get_merge_plan().merge(receiver, donor)
+        self.assertEquals(receiver, TestModel.objects.get().user)
+        self.assertEquals(receiver, CustomUserFieldNameModel.objects.get().person)
+
 class TransplantMergeViewTest(TransactionTestCase):
     urls = 'transplant.urls'
     
@@ -268,6 +1976,23 @@ class TransplantMergeViewTest(TransactionTestCase):
             for m in TestModel.objects.all():
                 self.assertEquals(self.receiver, m.user)
     
+    def testFormValidShouldAttachMergeStatsToResponse(self):
+        request = self.factory.post('/')
+        request.user = self.receiver
+        v = TransplantMergeView()
+        v.request = request
+        
+        with self.settings(
+            TRANSPLANT_OPERATIONS = (
+                ('transplant.tests.models.TestModel', 'transplant.surgeons.BatchSurgeon', {}),
+            )
+        ):
+            form = v.form_class(request)
+            form.user_cache = self.donor
+            response = v.form_valid(form)
+        self.assertEquals(5, response.merge_stats.rows)
+        self.assertEquals(5, v.get_context_data(form=form)['merge_stats'].rows)
+    
     def testFormValidShouldRollackIfAnyExceptionOccurs(self):
         request = self.factory.post('/',
           {'merge-username': 'donor', 'merge-password': 'p', 'merge-warning_accepted': 'True'}
@@ -346,4 +2071,345 @@ class TransplantMergeViewTest(TransactionTestCase):
             DEBUG = False
         ):
             response = TransplantMergeView.as_view()(request)
-        self.assertEquals(302, response.status_code)
\ No newline at end of file
+        self.assertEquals(302, response.status_code)
+
+class MergeGuardTest(TransactionTestCase):
+    
+    def setUp(self):
+        self.receiver = User.objects.create_user(username='receiver', password='p')
+        self.donor = User.objects.create_user(username='donor', password='p')
+        for _ in range(0, 3):
+            TestModel(user=self.donor).save()
+        self.factory = RequestFactory()
+        self.operations = (
+            ('transplant.tests.models.TestModel', 'transplant.surgeons.BatchSurgeon', {}),
+        )
+    
+    def post(self, token, **settings):
+        request = self.factory.post('/', {
+            'merge-username': 'donor', 'merge-password': 'p',
+            'merge-warning_accepted': 'True', 'merge-token': token,
+        })
+        request.user = self.receiver
+        settings.setdefault('TRANSPLANT_OPERATIONS', self.operations)
+        with self.settings(**settings):
+            return TransplantMergeView.as_view()(request)
+    
+    def testFormShouldCarryNewTokens(self):
+        self.assertNotEquals(UserMergeForm().fields['token'].initial,
+                             UserMergeForm().fields['token'].initial)
+    
+    def testSameTokenShouldStartMergeOnce(self):
+        request, created = start_merge(self.receiver, self.donor, 'abc')
+        self.assertTrue(created)
+        self.assertEquals((request, False), start_merge(self.receiver, self.donor, 'abc'))
+        # another token for the running merge of the pair
+        self.assertEquals((request, False), start_merge(self.receiver, self.donor, 'def'))
+        finish_merge(request, MergeJob.DONE)
+        self.assertEquals((request, False), start_merge(self.receiver, self.donor, 'abc'))
+        other, created = start_merge(self.receiver, self.donor, 'def')
+        self.assertTrue(created)
+        self.assertEquals('{0}:{1}'.format(self.receiver.pk, self.donor.pk), other.lock)
+    
+    def testReverseMergeShouldBeLockedOut(self):
+        request, created = start_merge(self.receiver, self.donor, 'abc')
+        self.assertTrue(created)
+        self.assertEquals((request, False), start_merge(self.donor, self.receiver, 'def'))
+    
+    def testExpiredLockShouldNotBlockPair(self):
+        request, _ = start_merge(self.receiver, self.donor, 'abc')
+        with self.settings(TRANSPLANT_MERGE_LOCK_TIMEOUT=-1):
+            other, created = start_merge(self.receiver, self.donor, 'def')
+        self.assertTrue(created)
+        self.assertEquals(MergeJob.FAILED, MergeRequest.objects.get(pk=request.pk).status)
+    
+    def testDoubleSubmitShouldMergeOnce(self):
+        response = self.post('abc')
+        self.assertEquals(3, response.merge_stats.rows)
+        self.assertFalse(response.has_header('X-Transplant-Merge'))
+        TestModel(user=self.donor).save()
+        response = self.post('abc')
+        self.assertEquals(302, response.status_code)
+        self.assertEquals('done', response['X-Transplant-Merge'])
+        self.assertEquals(1, TestModel.objects.filter(user=self.donor).count())
+        self.assertEquals([('abc', 'done', None)], list(MergeRequest.objects.values_list(
+            'token', 'status', 'lock')))
+    
+    def testRepeatedFailedMergeShouldFailWithoutMerging(self):
+        operations = (
+            ('transplant.tests.models.TestModel', 'transplant.tests.surgeons.FaultySurgeon', {}),
+        )
+        with self.assertRaises(RuntimeError):
+            self.post('abc', TRANSPLANT_OPERATIONS=operations)
+        with self.assertRaises(MergeFailed):
+            self.post('abc')
+        self.assertEquals(3, TestModel.objects.filter(user=self.donor).count())
+    
+    def testInvalidPlanShouldReleaseLock(self):
+        operations = (
+            ('transplant.tests.models.Missing', 'transplant.surgeons.BatchSurgeon', {}),
+        )
+        with self.assertRaises(ImproperlyConfigured):
+            self.post('abc', TRANSPLANT_OPERATIONS=operations)
+        self.assertEquals((MergeJob.FAILED, None), MergeRequest.objects.values_list(
+            'status', 'lock').get())
+        self.assertEquals(302, self.post('def').status_code)
+        self.assertEquals(0, TestModel.objects.filter(user=self.donor).count())
+    
+    def testQueuedMergeShouldBeReturnedUntilJobIsDone(self):
+        response = self.post('abc', TRANSPLANT_ASYNC=True)
+        job = MergeJob.objects.get()
+        self.assertEquals(str(job.pk), response['X-Transplant-Job'])
+        response = self.post('def', TRANSPLANT_ASYNC=True)
+        self.assertEquals('running', response['X-Transplant-Merge'])
+        self.assertEquals(str(job.pk), response['X-Transplant-Job'])
+        self.assertEquals(1, MergeJob.objects.count())
+        with self.settings(TRANSPLANT_OPERATIONS=self.operations):
+            run_next_job()
+        self.assertEquals(('done', None), MergeRequest.objects.values_list(
+            'status', 'lock').get())
+
+    def testQueuedMergeShouldBeReleasedByWorkerFinishingRightAway(self):
+        from .. import views
+        def enqueue_and_run(*args, **kwargs):
+            # a worker finishes the job as soon as it is committed
+            job = enqueue_merge(*args, **kwargs)
+            with self.settings(TRANSPLANT_OPERATIONS=self.operations):
+                run_next_job()
+            return job
+        with patch.object(views, 'enqueue_merge', enqueue_and_run):
+            self.post('abc', TRANSPLANT_ASYNC=True)
+        self.assertEquals(('done', None), MergeRequest.objects.values_list(
+            'status', 'lock').get())
+        self.assertEquals(0, TestModel.objects.filter(user=self.donor).count())
+
+class MergeJobTest(TransactionTestCase):
+    
+    def setUp(self):
+        self.receiver = User.objects.create_user(username='receiver', password='p')
+        self.donor = User.objects.create_user(username='donor', password='p')
+        self.factory = RequestFactory()
+        for i in range(0,10):
+            u = self.receiver if i % 2 == 0 else self.donor
+            TestModel(user=u).save()
+            CustomUserFieldNameModel(person=u).save()
+    
+    def operations(self, faulty=False):
+        return (
+            ('transplant.tests.models.TestModel', 'transplant.surgeons.DefaultSurgeon', {}),
+            (
+                'transplant.tests.models.CustomUserFieldNameModel',
+                'transplant.tests.surgeons.FaultySurgeon' if faulty else
+                'transplant.surgeons.BatchSurgeon',
+                {'user_field': 'person'}
+            ),
+        )
+    
+    def testFormValidShouldQueueMergeIfAsync(self):
+        request = self.factory.post('/')
+        request.user = self.receiver
+        v = TransplantMergeView()
+        v.request = request
+        with self.settings(
+            TRANSPLANT_OPERATIONS = self.operations(),
+            TRANSPLANT_ASYNC = True
+        ):
+            form = v.form_class(request)
+            form.user_cache = self.donor
+            response = v.form_valid(form)
+        job = MergeJob.objects.get()
+        self.assertEquals(str(job.pk), response['X-Transplant-Job'])
+        self.assertEquals(MergeJob.QUEUED, job.status)
+        self.assertEquals((self.receiver, self.donor), (job.receiver, job.donor))
+        self.assertEquals(5, TestModel.objects.filter(user=self.donor).count())
+    
+    def testRunJobShouldPerformMerge(self):
+        with self.settings(TRANSPLANT_OPERATIONS = self.operations()):
+            job = enqueue_merge(self.receiver, self.donor)
+            self.assertTrue(job.claim())
+            self.assertTrue(run_job(job))
+        job = MergeJob.objects.get(pk=job.pk)
+        self.assertEquals(MergeJob.DONE, job.status)
+        self.assertEquals(['done', 'done'], job.operation_statuses())
+        self.assertEquals(0, TestModel.objects.filter(user=self.donor).count())
+        self.assertEquals(0, CustomUserFieldNameModel.objects.filter(person=self.donor).count())
+        self.assertFalse(User.objects.get(pk=self.donor.pk).is_active)
+    
+    def testRunJobShouldRollbackAndRecordFailure(self):
+        with self.settings(TRANSPLANT_OPERATIONS = self.operations(faulty=True)):
+            job = enqueue_merge(self.receiver, self.donor)
+            job.claim()
+            self.assertFalse(run_job(job))
+        job = MergeJob.objects.get(pk=job.pk)
+        self.assertEquals(MergeJob.FAILED, job.status)
+        self.assertEquals(['done', 'failed'], job.operation_statuses())
+        self.assertTrue('Hello faulty surgeon!' in job.error)
+        self.assertEquals(5, TestModel.objects.filter(user=self.donor).count())
+        self.assertTrue(User.objects.get(pk=self.donor.pk).is_active)
+    
+    def testRunJobShouldRecordProgressOfEachOperation(self):
+        progress = []
+        def record(connection, job):
+            progress.append(job.completed_operations)
+        with patch('transplant.jobs.progress_connection', Mock()), \
+                patch('transplant.jobs.record_progress', Mock(side_effect=record)):
+            with self.settings(TRANSPLANT_OPERATIONS = self.operations()):
+                job = enqueue_merge(self.receiver, self.donor)
+                job.claim()
+                self.assertTrue(run_job(job))
+        self.assertEquals([1, 2], progress)
+    
+    def testProgressShouldBeWrittenWithSingleUpdate(self):
+        from django.db import connection
+        job = enqueue_merge(self.receiver, self.donor)
+        job.completed_operations = 1
+        with self.assertNumQueries(1):
+            record_progress(connection, job)
+        self.assertEquals(1, MergeJob.objects.get(pk=job.pk).completed_operations)
+    
+    def testJobCanBeClaimedOnlyOnce(self):
+        job = enqueue_merge(self.receiver, self.donor)
+        self.assertTrue(job.claim())
+        self.assertFalse(MergeJob.objects.get(pk=job.pk).claim())
+    
+    def testRunNextJobShouldReturnNoneIfQueueIsEmpty(self):
+        self.assertEquals(None, run_next_job())
+    
+    def testWorkerCommandShouldPerformQueuedJobs(self):
+        with self.settings(TRANSPLANT_OPERATIONS = self.operations()):
+            job = enqueue_merge(self.receiver, self.donor)
+            call_command('transplant_worker', once=True, verbosity=0)
+        self.assertEquals(MergeJob.DONE, MergeJob.objects.get(pk=job.pk).status)
+        self.assertEquals(0, TestModel.objects.filter(user=self.donor).count())
+    
+    def testStatusViewShouldReturnJobStatusAsJson(self):
+        with self.settings(TRANSPLANT_OPERATIONS = self.operations()):
+            job = enqueue_merge(self.receiver, self.donor)
+            request = self.factory.get('/')
+            request.user = self.receiver
+            response = TransplantJobStatusView.as_view()(request, pk=str(job.pk))
+        self.assertEquals('application/json', response['Content-Type'])
+        data = json.loads(response.content)
+        self.assertEquals(job.pk, data['id'])
+        self.assertEquals('queued', data['status'])
+        self.assertEquals(
+            [
+                {'model': 'tests.TestModel', 'surgeon': 'DefaultSurgeon', 'status': 'pending'},
+                {'model': 'tests.CustomUserFieldNameModel', 'surgeon': 'BatchSurgeon', 'status': 'pending'},
+            ],
+            data['operations']
+        )
+    
+    def testStatusViewShouldNotShowJobsOfOtherUsers(self):
+        job = enqueue_merge(self.receiver, self.donor)
+        request = self.factory.get('/')
+        request.user = self.donor
+        with self.assertRaises(Http404):
+            TransplantJobStatusView.as_view()(request, pk=str(job.pk))
+
+class MergeCommandTest(TransactionTestCase):
+    
+    def setUp(self):
+        self.users = [
+            User.objects.create_user(username='user{0}'.format(i), password='p')
+            for i in range(0, 6)
+        ]
+        for user in self.users:
+            TestModel(user=user).save()
+        self.directory = tempfile.mkdtemp()
+        self.operations = (
+            ('transplant.tests.models.TestModel', 'transplant.surgeons.BatchSurgeon', {}),
+        )
+    
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    
+    def write(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+    
+    def merge(self, *args, **options):
+        options.setdefault('stdout', StringIO())
+        options.setdefault('stderr', StringIO())
+        with self.settings(TRANSPLANT_OPERATIONS = self.operations):
+            call_command('transplant_merge', *args, **options)
+        return options
+    
+    def owners(self):
+        return [m.user.username for m in TestModel.objects.order_by('pk')]
+    
+    def testCommandShouldMergePairsFromCsv(self):
+        path = self.write('pairs.csv', 'user0,user1\nuser0,user2\n\nuser3,user4\n')
+        self.merge(path, field='username', batch_size=2, verbosity=0)
+        self.assertEquals(
+            ['user0', 'user0', 'user0', 'user3', 'user3', 'user5'], self.owners()
+        )
+        self.assertEquals(
+            [True, False, False, True, False, True],
+            [u.is_active for u in User.objects.order_by('pk')]
+        )
+    
+    def testBatchesShouldBeCommittedLikeSingleMerges(self):
+        mappings = []
+        def committed(sender, stats, **kwargs):
+            mappings.append(dict((d.username, r.username) for d, r in stats.mapping.items()))
+        path = self.write('pairs.csv', 'user0,user1\nuser1,user2\nuser3,user4\n')
+        merge_committed.connect(committed)
+        try:
+            self.merge(path, field='username', batch_size=2, verbosity=0)
+        finally:
+            merge_committed.disconnect(committed)
+        self.assertEquals([{'user1': 'user0', 'user2': 'user1'}, {'user4': 'user3'}],
+                          mappings)
+        # pairs are merged one after another, as given
+        self.assertEquals(
+            ['user0', 'user0', 'user1', 'user3', 'user3', 'user5'], self.owners()
+        )
+    
+    def testCommandShouldMergePairsFromJsonLines(self):
+        path = self.write('pairs.jsonl', '\n'.join([
+            json.dumps({'receiver': self.users[5].pk, 'donor': self.users[0].pk}),
+            json.dumps({'receiver': self.users[5].pk, 'donor': self.users[1].pk}),
+        ]))
+        self.merge(path, verbosity=0)
+        self.assertEquals(
+            ['user5', 'user5', 'user2', 'user3', 'user4', 'user5'], self.owners()
+        )
+    
+    def testDryRunShouldPrintReportsWithoutMerging(self):
+        path = self.write('pairs.csv', 'user0,user1\nuser0,nobody\n')
+        stdout = StringIO()
+        self.merge(path, field='username', dry_run=True, stdout=stdout)
+        reports = [json.loads(line) for line in stdout.getvalue().splitlines()]
+        self.assertEquals(1, reports[0]['pair'])
+        self.assertEquals(1, reports[0]['operations'][0]['rows'])
+        self.assertEquals("user 'nobody' does not exist", reports[1]['error'])
+        self.assertEquals(
+            ['user0', 'user1', 'user2', 'user3', 'user4', 'user5'], self.owners()
+        )
+    
+    def testCommandShouldReportPairsThatCouldNotBeMerged(self):
+        path = self.write('pairs.csv', 'user0,user1\nuser0,nobody\nuser2,user3\n')
+        stderr = StringIO()
+        with self.assertRaises(SystemExit):
+            self.merge(path, field='username', batch_size=10, stderr=stderr, verbosity=0)
+        self.assertTrue(stderr.getvalue().startswith(
+            "Pair 2: user 'nobody' does not exist\n"
+        ))
+        self.assertEquals(
+            ['user0', 'user0', 'user2', 'user2', 'user4', 'user5'], self.owners()
+        )
+    
+    def testCommandShouldResumeFromProgressFile(self):
+        path = self.write('pairs.csv', 'user0,user1\nuser2,user3\nuser4,user5\n')
+        progress = self.write('progress', '2\n')
+        stdout = StringIO()
+        self.merge(path, field='username', batch_size=1, progress_file=progress,
+                   resume=True, stdout=stdout)
+        self.assertEquals(
+            ['user0', 'user1', 'user2', 'user3', 'user4', 'user4'], self.owners()
+        )
+        self.assertEquals('Processed 3 pairs, 0 failed.\n', stdout.getvalue())
+        self.assertEquals('3\n', open(progress).read())
@@ -1,7 +1,7 @@
 from django.conf.urls import patterns, url
 from django.contrib.auth.decorators import login_required
 
-from views import TransplantMergeView
+from views import TransplantMergeView, TransplantJobStatusView
 
 urlpatterns = patterns('',
     url(r'^$',
@@ -10,4 +10,8 @@ urlpatterns = patterns('',
         ),
         name='transplant_merge'
     ),
+    url(r'^jobs/(?P<pk>\d+)/$',
+        login_required(TransplantJobStatusView.as_view()),
+        name='transplant_job_status'
+    ),
 )
\ No newline at end of file
@@ -0,0 +1,264 @@
+'''
+Helpers shared by the Surgeon classes and the merge plan.
+'''
+import django
+import json
+
+from django.db import connections, router, transaction, DatabaseError
+from django.db.models import Q
+from django.db.models import signals, sql
+from django.utils.encoding import force_unicode
+
+# MySQL error codes of a lock wait timeout and a deadlock
+RETRYABLE_ERROR_CODES = (1205, 1213)
+# PostgreSQL error codes of a serialization failure and a deadlock
+RETRYABLE_PGCODES = ('40001', '40P01')
+# parts of messages of errors above (Django 1.4 does not keep PostgreSQL
+# error codes), and of SQLite's locking errors
+RETRYABLE_MESSAGES = (
+    'deadlock', 'could not serialize access', 'database is locked',
+)
+# maximum number of query parameters of a single statement on SQLite
+SQLITE_MAX_PARAMS = 999
+
+def model_of(obj):
+    '''
+    Returns the model class of obj, looking through classes created for
+    deferred loading (QuerySet.only() and defer()).
+    '''
+    if obj._deferred:
+        return obj._meta.proxy_for_model
+    return obj.__class__
+
+def max_params(using):
+    '''
+    Returns the maximum number of query parameters of a single statement on
+    database 'using', or None if there is no limit.
+    '''
+    if connections[using].vendor == 'sqlite':
+        return SQLITE_MAX_PARAMS
+    return None
+
+def chunked(items, size):
+    '''
+    Splits items into lists of at most size items (a single list if size is
+    None).
+    '''
+    items = list(items)
+    if size is None:
+        size = len(items) or 1
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+def save_fields(obj, fields, using=None):
+    '''
+    Saves only given fields of obj, issuing an UPDATE of just these columns.
+
+    Django 1.5 and above do it with save(update_fields=...). Older versions
+    send pre_save and post_save around a queryset update, so listeners are
+    notified just like for a regular save(). Note that in this case the
+    model's save() method is not called.
+    '''
+    if django.VERSION >= (1, 5):
+        obj.save(update_fields=fields, using=using)
+        return
+    model = model_of(obj)
+    using = using or router.db_for_write(model, instance=obj)
+    signals.pre_save.send(sender=model, instance=obj, raw=False, using=using)
+    values = dict((name, getattr(obj, name)) for name in fields)
+    model._base_manager.using(using).filter(pk=obj.pk).update(**values)
+    obj._state.db = using
+    signals.post_save.send(sender=model, instance=obj, created=False,
+        raw=False, using=using, update_fields=frozenset(fields))
+
+def update_objects(objs, **values):
+    '''
+    Sets given values on all objs, which must be instances of a single model,
+    and writes them with a single UPDATE of just these columns. Sends
+    pre_save and post_save for each object, the model's save() method is not
+    called. On SQLite objects are split into chunks, so that no statement
+    exceeds its limit of query parameters.
+    '''
+    if not objs:
+        return
+    model = model_of(objs[0])
+    using = router.db_for_write(model, instance=objs[0])
+    for obj in objs:
+        for name, value in values.items():
+            setattr(obj, name, value)
+        signals.pre_save.send(sender=model, instance=obj, raw=False, using=using)
+    limit = max_params(using)
+    size = limit - len(values) if limit else None
+    for chunk in chunked([obj.pk for obj in objs], size):
+        model._base_manager.using(using).filter(pk__in=chunk).update(**values)
+    for obj in objs:
+        obj._state.db = using
+        signals.post_save.send(sender=model, instance=obj, created=False,
+            raw=False, using=using, update_fields=frozenset(values))
+
+def update_sql(queryset, **values):
+    '''
+    Returns (sql, params) of the UPDATE that queryset.update(**values)
+    would issue, without executing it, or None if the update needs more
+    than one statement (fields of parent models are updated).
+    '''
+    query = queryset.query.clone(sql.UpdateQuery)
+    query.add_update_values(values)
+    if query.related_updates:
+        return None
+    return query.get_compiler(queryset.db).as_sql()
+
+def combined_sql(statements):
+    '''
+    Returns (sql, params) of a single PostgreSQL statement running all given
+    (sql, params) UPDATE statements as a chain of data-modifying CTEs, and
+    selecting the number of rows changed by each of them.
+    '''
+    ctes, counts, params = [], [], []
+    for number, (statement, statement_params) in enumerate(statements):
+        ctes.append('u{0} AS ({1} RETURNING 1)'.format(number, statement))
+        counts.append('(SELECT COUNT(*) FROM u{0})'.format(number))
+        params.extend(statement_params)
+    return 'WITH {0} SELECT {1}'.format(', '.join(ctes), ', '.join(counts)), params
+
+def execute_combined(using, statements):
+    '''
+    Executes given (sql, params) UPDATE statements on database 'using',
+    returning a list of numbers of rows changed by each of them. On
+    PostgreSQL they are sent as a single statement (see combined_sql()),
+    costing one round trip. Elsewhere, or if a table is updated by more
+    than one statement (data-modifying CTEs must not update a row twice),
+    they are executed one by one.
+    '''
+    if not statements:
+        return []
+    connection = connections[using]
+    cursor = connection.cursor()
+    tables = [statement.split()[1] for statement, _ in statements]
+    if connection.vendor == 'postgresql' and len(set(tables)) == len(tables):
+        cursor.execute(*combined_sql(statements))
+        rows = [int(count) for count in cursor.fetchone()]
+    else:
+        rows = []
+        for statement, params in statements:
+            cursor.execute(statement, params)
+            rows.append(cursor.rowcount)
+    transaction.commit_unless_managed(using=using)
+    return rows
+
+def raw_delete(queryset):
+    '''
+    Deletes rows of queryset with a single DELETE, without fetching them
+    first, collecting related objects or sending signals. Returns the number
+    of deleted rows.
+    '''
+    using = router.db_for_write(queryset.model)
+    query = sql.DeleteQuery(queryset.model)
+    query.tables = [queryset.model._meta.db_table]
+    query.where = queryset.query.where
+    cursor = query.get_compiler(using).execute_sql(None)
+    transaction.commit_unless_managed(using=using)
+    return cursor.rowcount if cursor is not None else 0
+
+def update_returning(queryset, **values):
+    '''
+    Works like queryset.update(**values), but returns a list of primary
+    keys of updated rows. Uses a single UPDATE ... RETURNING on PostgreSQL,
+    elsewhere the primary keys are selected (and locked where supported)
+    before the UPDATE.
+    '''
+    model = queryset.model
+    using = router.db_for_write(model)
+    connection = connections[using]
+    statement = update_sql(queryset.using(using), **values)
+    if connection.vendor != 'postgresql' or statement is None:
+        pks = list(queryset.using(using).select_for_update().values_list('pk', flat=True))
+        if pks:
+            queryset.using(using).update(**values)
+        return pks
+    query_sql, params = statement
+    if not query_sql:
+        return []
+    cursor = connection.cursor()
+    cursor.execute('{0} RETURNING {1}'.format(
+        query_sql, connection.ops.quote_name(model._meta.pk.column)), params)
+    pks = [row[0] for row in cursor.fetchall()]
+    transaction.commit_unless_managed(using=using)
+    return pks
+
+def pack_pks(pks):
+    '''
+    Returns a compact string of a list of primary keys. Integer keys are
+    stored as ranges, e.g. [1, 2, 3, 7, 9, 10] as '1-3,7,9-10'. Other keys
+    are stored as a JSON list.
+    '''
+    pks = sorted(set(pks))
+    if not all(isinstance(pk, (int, long)) for pk in pks):
+        return json.dumps(pks)
+    ranges = []
+    for pk in pks:
+        if ranges and ranges[-1][1] == pk - 1:
+            ranges[-1][1] = pk
+        else:
+            ranges.append([pk, pk])
+    return ','.join(
+        str(start) if start == end else '{0}-{1}'.format(start, end)
+        for start, end in ranges
+    )
+
+def unpack_ranges(packed):
+    '''
+    Returns a list of (first, last) primary key ranges of a string returned
+    by pack_pks().
+    '''
+    if packed.startswith('['):
+        return [(pk, pk) for pk in json.loads(packed)]
+    ranges = []
+    for part in filter(None, packed.split(',')):
+        start, _, end = part.partition('-')
+        ranges.append((int(start), int(end or start)))
+    return ranges
+
+def ranges_q(ranges):
+    '''
+    Returns a Q object matching primary keys in given (first, last) ranges.
+    '''
+    singles = [start for start, end in ranges if start == end]
+    q = Q(pk__in=singles)
+    for start, end in ranges:
+        if start != end:
+            q |= Q(pk__range=(start, end))
+    return q
+
+def explain(queryset):
+    '''
+    Returns the database's query plan for queryset as a list of rows, or
+    None if the backend is not supported. Note that on SQLite the driver
+    commits any pending transaction before issuing the EXPLAIN statement.
+    '''
+    connection = connections[queryset.db]
+    prefix = {
+        'sqlite': 'EXPLAIN QUERY PLAN',
+        'postgresql': 'EXPLAIN',
+        'mysql': 'EXPLAIN',
+    }.get(connection.vendor)
+    if prefix is None:
+        return None
+    query_sql, params = queryset.query.sql_with_params()
+    cursor = connection.cursor()
+    cursor.execute('{0} {1}'.format(prefix, query_sql), params)
+    return [tuple(row) for row in cursor.fetchall()]
+
+def is_retryable(exception):
+    '''
+    Returns True if exception is a database error caused by a deadlock or
+    a serialization failure, so that the transaction may succeed if run
+    again.
+    '''
+    if not isinstance(exception, DatabaseError):
+        return False
+    if getattr(exception, 'pgcode', None) in RETRYABLE_PGCODES:
+        return True
+    if exception.args and exception.args[0] in RETRYABLE_ERROR_CODES:
+        return True
+    message = force_unicode(exception, errors='replace').lower()
+    return any(part in message for part in RETRYABLE_MESSAGES)
@@ -1,10 +1,16 @@
-from django.views.generic import FormView
+import json
+
+from django.views.generic import FormView, View
 from django.conf import settings
-from django.db import transaction
-from django.http import HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect
+from django.shortcuts import get_object_or_404
 
+from conf import app_settings
 from forms import UserMergeForm
-from surgery import Surgery
+from guard import MergeFailed, finish_merge, start_merge
+from jobs import enqueue_merge
+from models import MergeJob, MergeRequest
+from plan import get_merge_plan
 
 class TransplantMergeView(FormView):
     '''
@@ -16,9 +22,24 @@ class TransplantMergeView(FormView):
     
     Uses django.contrib.auth.forms.AuthenticationForm by default, but any
     other Form that will conform to it's API can do (the get_user() method!)
+    
+    If settings.TRANSPLANT_ASYNC is True the merge is only queued as
+    a MergeJob, and the id of the job is returned in X-Transplant-Job header
+    of the response.
+    
+    Otherwise timings, row counts and query counts of the merge (see
+    transplant.instrumentation.MergeStats) are stored as merge_stats
+    attribute of the view and of the response, e.g. for a middleware to
+    report them.
+    
+    A form submitted again (with the same token), or submitted while
+    a merge of the same accounts is running, does not start another merge
+    (see transplant.guard). The outcome of the first one is returned
+    instead, with its status in X-Transplant-Merge header of the response.
     '''
     form_class = UserMergeForm
-    success_url = settings.TRANSPLANT_SUCCESS_URL
+    # settings.TRANSPLANT_SUCCESS_URL is used if not given
+    success_url = None
     template_name = 'transplant/merge.html'
     def __init__(self, **kwargs):
         FormView.__init__(self, **kwargs)
@@ -26,26 +47,65 @@ class TransplantMergeView(FormView):
     def form_valid(self, form):
         receiver = self.request.user
         donor = form.get_user()
-        operations = [o for o in settings.TRANSPLANT_OPERATIONS]
-        with transaction.commit_manually():
-            try:
-                for operation in operations:
-                    Surgery(operation[0], operation[1], **operation[2]).merge(receiver, donor)
-                transaction.commit()
-                return super(TransplantMergeView, self).form_valid(form)
-            except Exception as e:
-                transaction.rollback()
-                return self.dispatch_exception(e)
-        return super(TransplantMergeView, self).form_valid(form)
+        token = getattr(form, 'cleaned_data', {}).get('token')
+        merge_request, created = start_merge(receiver, donor, token)
+        if not created:
+            return self.merge_requested(form, merge_request)
+        # the pair is locked until finish_merge(), whatever fails
+        try:
+            if app_settings.TRANSPLANT_ASYNC:
+                enqueue_merge(receiver, donor, merge_request=merge_request)
+            else:
+                self.merge_stats = get_merge_plan().merge(receiver, donor)
+        except Exception as e:
+            finish_merge(merge_request, MergeJob.FAILED, unicode(e))
+            return self.dispatch_exception(e)
+        response = super(TransplantMergeView, self).form_valid(form)
+        if app_settings.TRANSPLANT_ASYNC:
+            response['X-Transplant-Job'] = str(merge_request.job.pk)
+            return response
+        finish_merge(merge_request, MergeJob.DONE)
+        response.merge_stats = self.merge_stats
+        return response
+    
+    def form_invalid(self, form):
+        '''
+        A form submitted again after the merge is done no longer validates
+        (the donor is inactive), so its token is looked up here too.
+        '''
+        token = form.data.get(form.add_prefix('token'))
+        if token and self.request.user.is_authenticated():
+            requests = list(MergeRequest.objects.filter(
+                token=token, receiver=self.request.user))
+            if requests:
+                return self.merge_requested(form, requests[0])
+        return super(TransplantMergeView, self).form_invalid(form)
+    
+    def merge_requested(self, form, merge_request):
+        '''
+        Returns the outcome of a merge that was already requested: the
+        failure (see dispatch_exception()) if it failed, otherwise the
+        success response.
+        '''
+        if merge_request.status == MergeJob.FAILED:
+            return self.dispatch_exception(MergeFailed(merge_request.error))
+        response = super(TransplantMergeView, self).form_valid(form)
+        response['X-Transplant-Merge'] = merge_request.status
+        if merge_request.job_id is not None:
+            response['X-Transplant-Job'] = str(merge_request.job_id)
+        return response
+    
+    def get_success_url(self):
+        return self.success_url or app_settings.TRANSPLANT_SUCCESS_URL
     
     def dispatch_exception(self, e):
         if settings.DEBUG is True:
             raise e
         else:
-            if settings.TRANSPLANT_FAILURE_URL is None:
+            if app_settings.TRANSPLANT_FAILURE_URL is None:
                 raise e
             else:
-                return HttpResponseRedirect(settings.TRANSPLANT_FAILURE_URL)
+                return HttpResponseRedirect(app_settings.TRANSPLANT_FAILURE_URL)
     
     def get_form_kwargs(self):
         form_kwargs = super(TransplantMergeView, self).get_form_kwargs()
@@ -55,4 +115,31 @@ class TransplantMergeView(FormView):
     def get_context_data(self, **kwargs):
         context_data = super(FormView, self).get_context_data(**kwargs)
         context_data.update({'merge_form': context_data['form']})
-        return context_data
\ No newline at end of file
+        if getattr(self, 'merge_stats', None) is not None:
+            context_data.update({'merge_stats': self.merge_stats})
+        return context_data
+
+class TransplantJobStatusView(View):
+    '''
+    Returns status of a MergeJob requested by current user as JSON, for
+    example::
+    
+      {"id": 1, "status": "done", "operations": [
+          {"model": "myapp.Item", "surgeon": "DefaultSurgeon", "status": "done"}
+      ]}
+    '''
+    def get(self, request, pk):
+        job = get_object_or_404(MergeJob, pk=pk, receiver=request.user)
+        plan = list(get_merge_plan())
+        operations = []
+        for index, status in enumerate(job.operation_statuses()):
+            operation = {'status': status}
+            if len(plan) == job.operations:
+                operation.update({
+                    'model': '{0}.{1}'.format(plan[index].model._meta.app_label,
+                                              plan[index].model.__name__),
+                    'surgeon': plan[index].surgeon.__class__.__name__,
+                })
+            operations.append(operation)
+        data = {'id': job.pk, 'status': job.status, 'operations': operations}
+        return HttpResponse(json.dumps(data), content_type='application/json')